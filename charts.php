@@ -27,6 +27,21 @@ foreach($media as $attachment) {
             "</p>";
     }
 
+    // plot width of a chart in pixels, see the margins in showChart
+    var chart_width = 560 - 60 - 30;
+
+    // pick the smallest level of detail series with at least one bucket
+    // per pixel, or the full data if no level is detailed enough
+    function chartDataFile(chart, width) {
+        var levels = chart.lod || [];
+        for (var i = 0; i < levels.length; i++) {
+            if (levels[i].buckets >= width) {
+                return levels[i].filename;
+            }
+        }
+        return chart.filename;
+    }
+
     function showChart(chart, data) {
         // set the dimensions and margins of the graph
         var margin = {top: 60, right: 30, bottom: 80, left: 60},
@@ -45,6 +60,12 @@ foreach($media as $attachment) {
         //Read the data
         var csv_data = d3.csvParse(data, d3.autoType);
 
+        // multi_line charts overlay several y columns of the same data
+        var series = chart.y_columns || [{
+          column: chart.y_column,
+          stroke: chart.stroke,
+          stroke_width: chart.stroke_width}];
+
         // select scale function
         var x_scale = d3.scaleLinear;
         var y_scale = d3.scaleLinear;
@@ -133,17 +154,24 @@ foreach($media as $attachment) {
         var line = svg.append('g')
           .attr("clip-path", "url(#clip)");
 
-        // Add the line
-        line.append("path")
-          .datum(csv_data)
-          .attr("class", "line")  // I add the class line to be able to modify this line later on.
-          .attr("fill", chart.fill)
-          .attr("stroke", chart.stroke)
-          .attr("stroke-width", chart.stroke_width)
-          .attr("d", d3.line()
+        // path generator for a series
+        function seriesPath(s) {
+          return d3.line()
             .x(function(d) { return x(d[chart.x_column]) })
-            .y(function(d) { return y(d[chart.y_column]) })
-            );
+            .y(function(d) { return y(d[s.column]) })
+            (csv_data);
+        }
+
+        // Add a line per series
+        line.selectAll(".line")
+          .data(series)
+          .enter()
+          .append("path")
+            .attr("class", "line")  // I add the class line to be able to modify this line later on.
+            .attr("fill", chart.fill)
+            .attr("stroke", function(s) { return s.stroke; })
+            .attr("stroke-width", function(s) { return s.stroke_width; })
+            .attr("d", seriesPath);
 
         // Add the brushing
         line
@@ -173,13 +201,10 @@ foreach($media as $attachment) {
 0         // Update axis and line position
           xAxis.transition().duration(1000).call(d3.axisBottom(x));
           line
-              .select('.line')
+              .selectAll('.line')
               .transition()
               .duration(1000)
-              .attr("d", d3.line()
-                .x(function(d) { return x(d[chart.x_column]) })
-                .y(function(d) { return y(d[chart.y_column]) })
-              );
+              .attr("d", seriesPath);
         }
 
         // If user double click, reinitialize the chart
@@ -187,12 +212,9 @@ foreach($media as $attachment) {
           x.domain(d3.extent(csv_data, function(d) { return d[chart.x_column]; }))
           xAxis.transition().call(d3.axisBottom(x))
           line
-            .select('.line')
+            .selectAll('.line')
             .transition()
-            .attr("d", d3.line()
-              .x(function(d) { return x(d[chart.x_column]) })
-              .y(function(d) { return y(d[chart.y_column]) })
-          );
+            .attr("d", seriesPath);
           //location.reload();
         });
     }
@@ -216,6 +238,11 @@ foreach($media as $attachment) {
                         var chart_data = metadata.chart_data;
                         for(var chart_idx = 0; chart_idx < chart_data.length; chart_idx++) {
                           var chart = chart_data[chart_idx];
+                          if("mimetype" in chart && chart.mimetype != "text/csv"){
+                            // binary chart data can't be parsed here
+                            showText(elt, chart.title + ": unsupported chart data format " + chart.mimetype);
+                            continue;
+                          }
                           const module = {
                             chart: chart,
                             loadChart: function(data) {
@@ -224,7 +251,7 @@ foreach($media as $attachment) {
 
                           const load_chart = module.loadChart;
 
-                          zip.file(chart.filename).async("string").then(
+                          zip.file(chartDataFile(chart, chart_width)).async("string").then(
                             load_chart.bind(module));
                         }
 
@@ -1,10 +1,10 @@
-import csv
 import datetime
 import json
-import math
 import uuid
 import zipfile
 
+from oval.synth import generate_signal
+
 
 OUTFILE_CSVS = {
     "inst0.csv": {
@@ -35,16 +35,10 @@ def gen_chart(
     """
     Generate sinusoid.
     """
-    with open(filename, 'w', newline='') as csvfile:
-        inst_writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        inst_writer.writerow(['time', 'sample'])
-        sample_time = start_time
-        inc = (end_time - start_time)/num_samples
-        while sample_time < end_time:
-            yt = amplitude * math.sin(
-                2*math.pi * freq * sample_time + phase) + y_offset
-            inst_writer.writerow([sample_time, yt])
-            sample_time += inc
+    df = generate_signal(
+        num_samples=num_samples, start_time=start_time, end_time=end_time,
+        amplitude=amplitude, frequency=freq, phase=phase, y_offset=y_offset)
+    df.to_csv(filename, index=False)
 
     return {
         "chart_type": "line",
@@ -1,24 +1,33 @@
-import csv
+import contextlib
+import glob
+import io
 import logging
-import math
 import os
-import shutil
+import shlex
 import subprocess
 import sys
-import tempfile
-import unittest
-import uuid
+import time
 
 import click
 
 import oval.core
-
-import pandas as pd
+import oval.synth
 
 from tabulate import tabulate
 
 logger = logging.getLogger(__name__)
 
+# commands that can't run inside a batch because they need committed
+# bundle contents or aren't bundle operations
+BATCH_EXCLUDED_COMMANDS = (
+    "batch", "publish", "test", "flake8", "bench", "map", "ingest-daemon",
+    "outbox", "index", "find", "compact")
+
+# commands that don't act on the bundle and so can't be mapped over bundles
+MAP_EXCLUDED_COMMANDS = (
+    "map", "test", "flake8", "bench", "gen-bundles", "ingest-daemon",
+    "outbox", "index", "find")
+
 
 @click.group(context_settings={"help_option_names": ['-h', '--help']})
 @click.option(
@@ -33,8 +42,22 @@ logger = logging.getLogger(__name__)
 @click.option(
     "--bundle", default="session.zip",
     help="oval.bio session data bundle file.")
+@click.option(
+    "--metrics-json", default=None,
+    help="Write timing spans of the command's phases to this JSON file.")
+@click.option(
+    "--compression", envvar="OVAL_COMPRESSION", default=None,
+    help="Compress new bundle entries with METHOD[:LEVEL], one of "
+         "stored, deflate, bzip2 or lzma. Only stored and deflate bundles "
+         "can be rendered on the website.")
+@click.option(
+    "--compress-rule", multiple=True,
+    help="PATTERN=METHOD[:LEVEL] compression of entries matching a glob "
+         "pattern, may be repeated.")
 @click.pass_context
-def root(context, log, log_level, profiling, bundle):
+def root(
+        context, log, log_level, profiling, bundle, metrics_json,
+        compression, compress_rule):
     """
     oval.bio session bundle utilities.
     """
@@ -46,6 +69,29 @@ def root(context, log, log_level, profiling, bundle):
     obj.log_level = log_level
     obj.profiling = profiling
     obj.bundle = bundle
+    obj.batch_bundle = None
+    obj.command = context.invoked_subcommand
+    obj.compression = None
+    obj.compression_args = []
+    if compression is not None or compress_rule:
+        try:
+            obj.compression = oval.core.CompressionPolicy.parse(
+                compression, compress_rule)
+        except (oval.core.BundleError, ValueError) as e:
+            raise click.BadParameter(str(e), param_hint="--compression")
+        obj.compression_args = [
+            "--compression", compression or "stored",
+            *[arg for rule in compress_rule
+              for arg in ("--compress-rule", rule)]]
+
+    if metrics_json is not None:
+        recorder = oval.core.SpanRecorder()
+        oval.core.add_span_collector(recorder)
+
+        def write_metrics():
+            oval.core.remove_span_collector(recorder)
+            recorder.write_json(metrics_json)
+        context.call_on_close(write_metrics)
 
     level = getattr(logging, obj.log_level.upper())
     oval.core.setup_logging(obj.log, level)
@@ -61,6 +107,8 @@ def test(obj, pattern):
     """
     Run test suite.
     """
+    import unittest
+
     with oval.core.cli_context(obj):
         loader = unittest.TestLoader()
         suite = loader.discover(
@@ -140,10 +188,8 @@ def set_text(obj, filename):
     Set bundle text that shows up on published reports. Copies the file
     specified into the bundle and points metadata to it.
     """
-    arcname = os.path.basename(filename)
-    with oval.core.edit_archive(obj.bundle) as arc_dir:
-        shutil.copy2(filename, os.path.join(arc_dir, arcname))
-    with oval.core.cli_context(obj) as bundle:
+    with oval.core.cli_context(obj) as bundle, bundle.transaction():
+        arcname = bundle.add_file(filename)
         bundle.write_attribute("text", arcname)
 
 
@@ -155,13 +201,333 @@ def set_html(obj, filename):
     """
     Set bundle html that shows up on published reports.
     """
-    arcname = os.path.basename(filename)
-    with oval.core.edit_archive(obj.bundle) as arc_dir:
-        shutil.copy2(filename, os.path.join(arc_dir, arcname))
-    with oval.core.cli_context(obj) as bundle:
+    with oval.core.cli_context(obj) as bundle, bundle.transaction():
+        arcname = bundle.add_file(filename)
         bundle.write_attribute("html", arcname)
 
 
+@root.command()
+@click.pass_context
+@click.argument('filename', type=click.File('r'), default='-')
+def batch(context, filename):
+    """
+    Run the oval commands listed in FILENAME, one per line, against the
+    bundle in a single process, committing all of their changes at once.
+    Reads stdin by default. Blank lines and #-comments are ignored, e.g.
+
+    \b
+        set -k client -v Smith
+        add-chart -f data.csv time y1 y2
+        edit-chart 0 title Pulse
+    """
+    obj = context.obj
+    root_context = context.parent
+    with oval.core.cli_context(obj) as bundle, bundle.transaction():
+        obj.batch_bundle = bundle
+        try:
+            for lineno, line in enumerate(filename, 1):
+                args = shlex.split(line, comments=True)
+                if not args:
+                    continue
+                name, args = args[0], args[1:]
+                command = root.get_command(root_context, name)
+                if command is None or name in BATCH_EXCLUDED_COMMANDS:
+                    raise click.UsageError(
+                        "line {}: can't run '{}' in a batch".format(
+                            lineno, name))
+                logger.debug("batch line {}: {}".format(lineno, line.strip()))
+                with command.make_context(
+                        name, args, parent=root_context) as sub_context:
+                    command.invoke(sub_context)
+        finally:
+            obj.batch_bundle = None
+
+
+@root.command()
+@click.pass_obj
+@click.argument('config')
+@click.option(
+    '--once/--no-once', default=False,
+    help="Ingest the files found by one scan, then exit")
+@click.option(
+    '--workers', '-j', type=int, default=None,
+    help="Number of worker processes, overrides the config")
+@click.option(
+    '--stats-file', default=None,
+    help="Keep the daemon counters in this JSON file, overrides the config")
+def ingest_daemon(obj, config, once, workers, stats_file):
+    """
+    Watch directories for CSV files and add them to bundles as charts,
+    as configured by the JSON file CONFIG, e.g.
+
+    \b
+        {"watch": ["incoming"], "window": 5.0, "done_dir": "processed",
+         "rules": [{"pattern": "rig*/*.csv",
+                    "bundle": "bundles/{parent}.zip",
+                    "chart": {"x_column": "time", "y_column": "sample"}}]}
+    """
+    import asyncio
+
+    import oval.daemon
+
+    daemon_config = oval.daemon.load_config(config)
+    if workers is not None:
+        daemon_config["workers"] = workers
+    if stats_file is not None:
+        daemon_config["stats_file"] = os.path.abspath(stats_file)
+    if obj.compression is not None:
+        daemon_config["compression"] = obj.compression
+    daemon = oval.daemon.IngestDaemon(daemon_config)
+    stats = asyncio.run(daemon.run(once=once))
+    print(tabulate(stats.items()))
+
+
+@root.group()
+@click.option(
+    '--outbox', envvar="OVAL_OUTBOX", default="outbox.sqlite",
+    help="Outbox file")
+@click.pass_obj
+def outbox(obj, outbox):
+    """
+    Send the bundles queued with 'oval publish --queue'.
+    """
+    obj.outbox = outbox
+
+
+@outbox.command(name="run")
+@click.pass_obj
+@click.option(
+    '--workers', '-j', type=int, default=4,
+    help="Number of messages sent concurrently")
+@click.option(
+    '--rate', type=float, default=None,
+    help="Max messages per second sent to each SMTP host")
+@click.option(
+    '--max-attempts', type=int, default=8,
+    help="Attempts to send a message before it's failed")
+@click.option(
+    '--retry-delay', type=float, default=30.0,
+    help="Seconds before the first retry, doubled for each later one")
+@click.option(
+    '--wait/--no-wait', default=True,
+    help="Wait for scheduled retries, or exit once the due messages "
+         "are sent")
+@click.option(
+    '--smtp-password', '-P', envvar="OVAL_SMTP_PASSWORD", default=None,
+    help="SMTP password")
+def outbox_run(
+        obj, workers, rate, max_attempts, retry_delay, wait, smtp_password):
+    """
+    Send the queued messages, retrying failed sends with exponential
+    backoff.
+    """
+    import oval.outbox
+
+    runner = oval.outbox.OutboxRunner(
+        obj.outbox, workers=workers, rate=rate, smtp_password=smtp_password,
+        max_attempts=max_attempts, retry_delay=retry_delay)
+    try:
+        runner.run(wait=wait)
+    except KeyboardInterrupt:
+        runner.stop()
+    with oval.outbox.Outbox(obj.outbox) as queued:
+        print(tabulate(queued.stats().items()))
+
+
+@outbox.command(name="stats")
+@click.pass_obj
+@click.option(
+    '--failed/--no-failed', default=False,
+    help="List the failed messages and their errors")
+def outbox_stats(obj, failed):
+    """
+    Print the outbox queue depth, message counts and send latency.
+    """
+    import oval.outbox
+
+    with oval.outbox.Outbox(obj.outbox) as queued:
+        print(tabulate(queued.stats().items()))
+        if failed:
+            print(tabulate(
+                [(message["id"], message["bundle"], message["attempts"],
+                  message["errors"]) for message in queued.messages("failed")],
+                headers=["id", "bundle", "attempts", "errors"]))
+
+
+@root.command()
+@click.pass_obj
+@click.argument('directory')
+@click.option(
+    '--catalog', envvar="OVAL_CATALOG", default="catalog.sqlite",
+    help="Catalog file")
+@click.option(
+    '--pattern', default="*.zip", help="Glob pattern of bundle file names")
+def index(obj, directory, catalog, pattern):
+    """
+    Add the bundles under DIRECTORY to the catalog searched by 'oval find',
+    re-reading only the bundles that changed since the last index.
+    """
+    import oval.catalog
+
+    with oval.catalog.Catalog(catalog) as indexed:
+        counts = indexed.index(directory, pattern=pattern)
+        counts.update(indexed.stats())
+    print(tabulate(counts.items()))
+
+
+@root.command()
+@click.pass_obj
+@click.option(
+    '--catalog', envvar="OVAL_CATALOG", default="catalog.sqlite",
+    help="Catalog file")
+@click.option(
+    '--attr', '-a', 'attributes', multiple=True,
+    help="NAME=PATTERN glob pattern an attribute matches, may be repeated")
+@click.option('--uuid', default=None, help="Bundle uuid")
+@click.option(
+    '--title', default=None, help="Glob pattern the bundle title matches")
+@click.option(
+    '--chart', default=None, help="Glob pattern a chart title matches")
+@click.option(
+    '--column', default=None, help="Column a chart has")
+@click.option(
+    '--min-rows', type=int, default=None, help="Rows a chart has at least")
+@click.option(
+    '--after', default=None,
+    help="Bundles created at or after this ISO date or time")
+@click.option(
+    '--before', default=None,
+    help="Bundles created before this ISO date or time")
+@click.option(
+    '--charts/--no-charts', default=False,
+    help="List the matching charts of each bundle")
+def find(
+        obj, catalog, attributes, uuid, title, chart, column, min_rows,
+        after, before, charts):
+    """
+    Find bundles in the catalog built by 'oval index' without opening
+    them, e.g. oval find -a client=acme* --column temperature.
+    """
+    import oval.catalog
+
+    parsed = []
+    for attribute in attributes:
+        name, sep, pattern = attribute.partition("=")
+        if not sep:
+            raise click.BadParameter(
+                "expected NAME=PATTERN: {}".format(attribute))
+        parsed.append((name, pattern))
+    with oval.catalog.Catalog(catalog) as indexed:
+        bundles = indexed.find(
+            attributes=parsed, uuid=uuid, title=title, chart_title=chart,
+            column=column, created_after=after, created_before=before,
+            min_rows=min_rows)
+    if charts:
+        print(tabulate(
+            [(bundle["path"], c["chart_index"], c["title"], c["num_rows"],
+              ",".join(c["columns"]), c["x_min"], c["x_max"], c["y_min"],
+              c["y_max"]) for bundle in bundles for c in bundle["charts"]],
+            headers=["path", "index", "chart", "rows", "columns", "x_min",
+                     "x_max", "y_min", "y_max"]))
+    else:
+        print(tabulate(
+            [(bundle["path"], bundle["uuid"], bundle["title"],
+              bundle["create_time"], bundle["num_charts"])
+             for bundle in bundles],
+            headers=["path", "uuid", "title", "created", "charts"]))
+
+
+def _map_bundle(task):
+    """
+    Process pool entry point for map, running one command against one
+    bundle. Returns the bundle's status, timing and captured output.
+    """
+    bundle, root_args, args = task
+    output = io.StringIO()
+    error = None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            root.main(
+                args=[*root_args, "--bundle", bundle, *args],
+                prog_name="oval", standalone_mode=False)
+    except (Exception, SystemExit) as e:
+        logger.debug("map failed on {}".format(bundle), exc_info=True)
+        error = str(e) or type(e).__name__
+    return {
+        "bundle": bundle,
+        "status": "ok" if error is None else "error",
+        "seconds": time.perf_counter() - start,
+        "output": output.getvalue(),
+        "error": error}
+
+
+@root.command(name="map")
+@click.pass_context
+@click.option(
+    '--jobs', '-j', type=int, default=None,
+    help="Number of worker processes, defaults to one per cpu")
+@click.option(
+    '--output/--no-output', default=True,
+    help="Print the output of the command for each bundle")
+@click.argument('pattern')
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+def map_bundles(context, jobs, output, pattern, args):
+    """
+    Run an oval command against every bundle matching the quoted glob
+    PATTERN with a pool of worker processes, e.g.
+
+    \b
+        oval map -j 8 'sessions/**/*.zip' -- set -k site -v lab2
+
+    Every bundle is processed even if some fail. Exits with an error if
+    any did.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    obj = context.obj
+    if not args or args[0] in MAP_EXCLUDED_COMMANDS or \
+       root.get_command(context.parent, args[0]) is None:
+        raise click.UsageError("map needs an oval command to run")
+    bundles = sorted(glob.glob(pattern, recursive=True))
+    # workers would truncate each other's log files, so they log to stderr
+    # even when map logs to a file
+    root_args = [
+        "--log", "-" if obj.log else "", "--log-level", obj.log_level,
+        *obj.compression_args]
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_map_bundle, (bundle, root_args, args))
+            for bundle in bundles]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print("{} {:.3f}s {}{}".format(
+                result["status"], result["seconds"], result["bundle"],
+                "" if result["error"] is None else ": " + result["error"]))
+            if output and result["output"]:
+                print(result["output"], end="")
+
+    failed = len([r for r in results if r["status"] != "ok"])
+    print("{} bundles, {} failed in {:.3f}s".format(
+        len(results), failed, time.perf_counter() - start))
+    if failed:
+        context.exit(1)
+
+
+@root.command()
+@click.pass_obj
+def compact(obj):
+    """
+    Rewrite the bundle, dropping entries shadowed by later edits.
+    """
+    with oval.core.cli_context(obj) as bundle:
+        print("reclaimed {} bytes".format(bundle.compact()))
+
+
 @root.command()
 @click.pass_obj
 @click.argument('args', nargs=-1)
@@ -196,31 +562,62 @@ def list(obj):
 @click.option(
     '--stroke-width', '-w', multiple=True,
     help="brush stroke to use for chart line", default=[1.5])
+@click.option(
+    '--data-format', '-d', default=oval.core.DEFAULT_CHART_FORMAT,
+    type=click.Choice(sorted(oval.core.CHART_FORMATS)),
+    help="Storage format of the chart data in the bundle")
+@click.option(
+    '--chunksize', '-c', type=int, default=None,
+    help="Stream the csv into the bundle this many rows at a time")
+@click.option(
+    '--multi/--no-multi', '-m', default=False,
+    help="Add one chart overlaying all y columns")
+@click.option(
+    '--lod/--no-lod', default=False,
+    help="Also store downsampled level of detail series for rendering")
 @click.argument('x_column')
 @click.argument('y_column', nargs=-1)
 def add_chart(
-        obj, filename, remove_zero, stroke, stroke_width, x_column, y_column):
+        obj, filename, remove_zero, stroke, stroke_width, data_format,
+        chunksize, multi, lod, x_column, y_column):
     """
     Add chart data to the bundle. If multiple y_columns are specified,
-    then multiple charts will be added.
+    then multiple charts will be added, or with --multi one chart
+    overlaying them that shares a single copy of the data.
     """
-    with oval.core.cli_context(obj) as bundle:
-        for i, y_col in enumerate(y_column):
-            if i < len(stroke):
-                st = stroke[i]
-            else:
-                st = stroke[-1]
-            if i < len(stroke_width):
-                st_w = stroke_width[i]
-            else:
-                st_w = stroke_width[-1]
-            chart_kwargs = {
-                "remove_zero": remove_zero,
-                "x_column": x_column,
-                "y_column": y_col,
-                "stroke": st,
-                "stroke_width": st_w}
-            bundle.add_chart(filename, **chart_kwargs)
+    y_series = []
+    for i, y_col in enumerate(y_column):
+        if i < len(stroke):
+            st = stroke[i]
+        else:
+            st = stroke[-1]
+        if i < len(stroke_width):
+            st_w = stroke_width[i]
+        else:
+            st_w = stroke_width[-1]
+        y_series.append({
+            "column": y_col,
+            "stroke": st,
+            "stroke_width": st_w})
+
+    with oval.core.cli_context(obj) as bundle, bundle.transaction():
+        chart_kwargs = {
+            "remove_zero": remove_zero,
+            "x_column": x_column,
+            "data_format": data_format,
+            "lod": lod}
+        if chunksize:
+            chart_kwargs["chunksize"] = chunksize
+        if multi:
+            bundle.add_chart(filename, y_columns=y_series, **chart_kwargs)
+            return
+        for series in y_series:
+            bundle.add_chart(
+                filename,
+                y_column=series["column"],
+                stroke=series["stroke"],
+                stroke_width=series["stroke_width"],
+                **chart_kwargs)
 
 
 @root.command()
@@ -256,41 +653,53 @@ def copy_chart(obj, index, filename):
 @click.argument('index')
 @click.argument('column', nargs=-1)
 @click.option(
-    '--range-min', '-i', help="Range minimum", default=0)
+    '--range-min', '-i', type=float, help="Range minimum", default=0)
+@click.option(
+    '--range-max', '-j', type=float, help="Range maximum", default=1)
 @click.option(
-    '--range-max', '-j', help="Range maximum", default=1)
+    '--column-range', '-c', type=(str, float, float), multiple=True,
+    help="Range minimum and maximum of one column, may be repeated")
+@click.option(
+    '--mode', '-m', type=click.Choice(oval.core.RESCALE_MODES),
+    default="minmax", help="Rescale to the range, from zero or to z-scores")
 @click.option(
     '--relative/--no-relative', '-r',
     help="Set range min/max such that the value space starts at zero",
     default=False)
 def rescale_chart_data(
-        obj, index, column, range_min, range_max, relative):
+        obj, index, column, range_min, range_max, column_range, mode,
+        relative):
     """
-    Rescales the COLUMNs of chart INDEX to be between
-    RANGE_MIN and RANGE_MAX. Using the relative flag
-    forces min to be zero and max to be the column max/min
+    Rescales the COLUMNs of charts INDEX, a comma separated list of chart
+    indices, to be between RANGE_MIN and RANGE_MAX. Using the relative
+    flag forces min to be zero and max to be the column max/min
     difference.
     """
+    if relative:
+        mode = "relative"
     with oval.core.cli_context(obj) as bundle:
-        if relative:
-            metadata = bundle._get_metadata()
-            with bundle.edit_archive() as arc_dir:
-                chart_data_filename = metadata[
-                    "chart_data"][int(index)]["filename"]
-                fn = os.path.join(arc_dir, chart_data_filename)
-                df = pd.read_csv(fn)
-
-            for col in column:
-                col_min, col_max = df[col].min(), df[col].max()
-                logger.debug(
-                    "relative rescaling: {} {}".format(col_min, col_max))
-                bundle.rescale_chart_data(
-                    int(index), *[col],
-                    feature_range=(
-                        type(col_min)(0.0), col_max - col_min))
-        else:
-            bundle.rescale_chart_data(
-                int(index), *column, feature_range=(range_min, range_max))
+        bundle.rescale_charts(
+            {int(i): column for i in index.split(",")}, mode=mode,
+            feature_range=(range_min, range_max),
+            column_ranges={c: (low, high) for c, low, high in column_range})
+
+
+@root.command()
+@click.pass_obj
+@click.argument('index', nargs=-1)
+@click.option(
+    '--buckets', '-b', type=int, multiple=True,
+    default=oval.core.DEFAULT_LOD_BUCKETS,
+    help="Bucket count of a level of detail series, may be repeated")
+def build_lod(obj, index, buckets):
+    """
+    Build downsampled level of detail series of the charts at INDEX for
+    rendering, or of all charts if none are specified.
+    """
+    with oval.core.cli_context(obj) as bundle, bundle.transaction():
+        indices = [int(i) for i in index] or range(bundle.num_charts())
+        for i in indices:
+            bundle.build_lod(i, buckets)
 
 
 @root.command()
@@ -326,36 +735,158 @@ def chart_data_columns(obj, index):
     '--x-label', '-i', default="Time (s)", help="x axis chart label")
 @click.option(
     '--y-label', '-j', default="Sample", help="y axis chart label")
+@click.option(
+    '--data-format', '-d', default=oval.core.DEFAULT_CHART_FORMAT,
+    type=click.Choice(sorted(oval.core.CHART_FORMATS)),
+    help="Storage format of the chart data in the bundle")
+@click.option(
+    '--waveform', default="sine",
+    type=click.Choice(oval.synth.WAVEFORMS),
+    help="Signal waveform")
+@click.option(
+    '--noise', default=0.0, help="Standard deviation of gaussian noise")
+@click.option(
+    '--seed', type=int, default=None, help="Noise random seed")
+@click.option(
+    '--start-datetime', default=None,
+    help="Use timestamps counting from this date and time for the x axis")
 def gen_chart(
         obj, title, start_time, end_time,
         num_samples, amplitude, frequency, phase, y_offset,
-        x_label, y_label):
+        x_label, y_label, data_format, waveform, noise, seed,
+        start_datetime):
     """
     Generate sinusoidal chart data for testing.
     """
+    df = oval.synth.generate_signal(
+        num_samples=num_samples, start_time=start_time, end_time=end_time,
+        waveform=waveform, amplitude=amplitude, frequency=frequency,
+        phase=phase, y_offset=y_offset, noise=noise, seed=seed,
+        start_datetime=start_datetime)
+    x_scale = "linear" if start_datetime is None else "time"
+
+    chart_kwargs = {} if title is None else {"title": title}
     with oval.core.cli_context(obj) as bundle:
-        with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as f:
-            temp_filename = f.name
+        bundle.add_chart_frame(
+            df, x_scale=x_scale, x_label=x_label, y_label=y_label,
+            data_format=data_format, **chart_kwargs)
 
-        with open(temp_filename, 'w', newline='') as csvfile:
-            inst_writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-            inst_writer.writerow(['time', 'sample'])
-            sample_time = start_time
-            inc = (end_time - start_time)/num_samples
-            while sample_time < end_time:
-                yt = amplitude * math.sin(
-                    2*math.pi * frequency * sample_time + phase) + y_offset
-                inst_writer.writerow([sample_time, yt])
-                sample_time += inc
 
-        if title is None:
-            title = os.path.basename(temp_filename)
+@root.command()
+@click.pass_obj
+@click.argument('directory')
+@click.option(
+    '--count', '-c', default=10, help="How many bundles to generate")
+@click.option(
+    '--num-charts', '-k', default=4, help="Charts per bundle")
+@click.option(
+    '--num-samples', '-n', default=1000, help="Rows per chart")
+@click.option(
+    '--jobs', '-j', type=int, default=None,
+    help="Worker processes, defaults to one per cpu")
+@click.option(
+    '--data-format', '-d', default=oval.core.DEFAULT_CHART_FORMAT,
+    type=click.Choice(sorted(oval.core.CHART_FORMATS)),
+    help="Storage format of the chart data in the bundles")
+@click.option(
+    '--waveform', default="sine",
+    type=click.Choice(oval.synth.WAVEFORMS),
+    help="Signal waveform")
+@click.option(
+    '--noise', default=0.0, help="Standard deviation of gaussian noise")
+@click.option(
+    '--seed', type=int, default=None, help="Noise random seed")
+@click.option(
+    '--start-datetime', default=None,
+    help="Use timestamps counting from this date and time for the x axis")
+def gen_bundles(
+        obj, directory, count, num_charts, num_samples, jobs, data_format,
+        waveform, noise, seed, start_datetime):
+    """
+    Generate COUNT synthetic bundles in DIRECTORY in parallel, for
+    reproducing production scale data locally.
+    """
+    filenames = oval.synth.gen_bundles(
+        directory, count, jobs=jobs, seed=seed, num_charts=num_charts,
+        num_samples=num_samples, data_format=data_format,
+        waveform=waveform, noise=noise, start_datetime=start_datetime,
+        compression=obj.compression)
+    print("generated {} bundles in {}".format(len(filenames), directory))
 
-        bundle.add_chart(
-            temp_filename, title=title,
-            x_label=x_label, y_label=y_label)
 
-        os.remove(temp_filename)
+@root.command()
+@click.pass_obj
+@click.option(
+    '--charts', '-k', multiple=True, type=int,
+    help="Number of charts per bundle, may be repeated")
+@click.option(
+    '--rows', '-n', multiple=True, type=int,
+    help="Number of rows per chart, may be repeated")
+@click.option(
+    '--repeat', '-r', default=3, type=int,
+    help="Timed runs of each operation")
+@click.option(
+    '--output', '-o', default=None,
+    help="Write JSON results to this file")
+@click.option(
+    '--baseline', '-b', default=None,
+    help="JSON results of a previous run to compare against")
+@click.option(
+    '--threshold', default=0.25, type=float,
+    help="Fractional slowdown or memory growth counted as a regression")
+@click.option(
+    '--publish/--no-publish', default=True,
+    help="Benchmark publishing to a local SMTP stub")
+@click.option(
+    '--compression', '-z', multiple=True,
+    help="Bundle compression METHOD[:LEVEL], may be repeated")
+def bench(
+        obj, charts, rows, repeat, output, baseline, threshold, publish,
+        compression):
+    """
+    Benchmark bundle operations across chart and row counts, exiting with
+    an error if a baseline comparison finds regressions.
+    """
+    import oval.bench
+
+    results = oval.bench.run_benchmarks(
+        charts=charts or oval.bench.DEFAULT_BENCH_CHARTS,
+        rows=rows or oval.bench.DEFAULT_BENCH_ROWS,
+        repeat=repeat, publish=publish,
+        compressions=compression or oval.bench.DEFAULT_BENCH_COMPRESSIONS)
+    if output is not None:
+        oval.bench.save_results(results, output)
+
+    table = []
+    for case in results["cases"]:
+        for name, measured in case["operations"].items():
+            table.append([
+                case["num_charts"], case["num_rows"], case["compression"],
+                name, measured["median_seconds"], measured["min_seconds"],
+                measured["peak_memory_bytes"]])
+    print(tabulate(table, headers=[
+        "charts", "rows", "compression", "operation", "median s", "min s",
+        "peak bytes"]))
+    print(tabulate(
+        [[case["num_charts"], case["num_rows"], case["compression"],
+          case["bundle_size"]] for case in results["cases"]],
+        headers=["charts", "rows", "compression", "bundle bytes"]))
+
+    if baseline is not None:
+        regressions = oval.bench.compare_results(
+            results, oval.bench.load_results(baseline), threshold)
+        if regressions:
+            print(tabulate(
+                [[r["num_charts"], r["num_rows"], r["compression"],
+                  r["operation"], r["metric"], r["baseline"], r["result"],
+                  r["ratio"]]
+                 for r in regressions],
+                headers=["charts", "rows", "compression", "operation",
+                         "metric", "baseline", "result", "ratio"]))
+            raise click.ClickException(
+                "{} regressions over {:.0%} threshold".format(
+                    len(regressions), threshold))
+        print("no regressions over {:.0%} threshold".format(threshold))
 
 
 @root.command()
@@ -377,60 +908,96 @@ def chart_info(obj, idx):
     Print chart information.
     """
     with oval.core.cli_context(obj) as bundle:
-        print(tabulate(bundle.get_chart(int(idx)).items()))
+        chart = bundle.get_chart(int(idx))
+        column_stats = chart.pop("column_stats", None)
+        print(tabulate(chart.items()))
+        if column_stats:
+            keys = ["count", "nan_count", "min", "max", "mean", "std",
+                    "monotonic"]
+            print(tabulate(
+                [[column] + [stats[k] for k in keys]
+                 for column, stats in column_stats.items()],
+                headers=["column"] + keys))
+
+
+@root.command()
+@click.pass_obj
+@click.argument('index')
+@click.option(
+    '--axis', '-a', multiple=True, type=click.Choice(["x", "y"]),
+    help="Axis to rescale, defaults to both")
+def autoscale_chart(obj, index, axis):
+    """
+    Set the bounds of chart INDEX to the range of its x and y columns.
+    """
+    with oval.core.cli_context(obj) as bundle:
+        bundle.autoscale_chart(int(index), axis or "xy")
 
 
 @root.command()
 @click.pass_obj
 @click.option(
-    '--from-addr', '-f', help="From email address.")
+    '--from-addr', '-f', required=True, help="From email address.")
+@click.option(
+    '--to-addr', '-t', required=True, multiple=True,
+    help="To email address, may be repeated.")
 @click.option(
-    '--to-addr', '-t', help="To email address.")
+    '--smtp-host', '-s', default="localhost", help="SMTP host")
 @click.option(
-    '--smtp-host', '-s', help="SMTP host")
+    '--smtp-port', '-p', type=int, default=587, help="SMTP port")
 @click.option(
-    '--smtp-port', '-p', help="SMTP port")
+    '--smtp-user', '-u', default=None, help="SMTP user")
 @click.option(
-    '--smtp-user', '-u', help="SMTP user")
+    '--smtp-password', '-P', envvar="OVAL_SMTP_PASSWORD", default=None,
+    help="SMTP password")
 @click.option(
-    '--smtp-password', '-p', help="SMTP password")
+    '--starttls/--no-starttls', default=True,
+    help="Secure the SMTP connection with STARTTLS")
 @click.option(
-    '--title', '-t', help="Post title", default=None)
+    '--title', help="Post title", default=None)
+@click.option(
+    '--queue/--no-queue', default=False,
+    help="Add the bundles to the outbox for 'oval outbox run' to send, "
+         "instead of sending them now")
+@click.option(
+    '--outbox', envvar="OVAL_OUTBOX", default="outbox.sqlite",
+    help="Outbox file")
+@click.argument('bundles', nargs=-1)
 def publish(
         obj, from_addr, to_addr, smtp_host, smtp_port,
-        smtp_user, smtp_password, title):
-    """
-    Publish the bundle by email.
-    """
-    with oval.core.cli_context(obj) as bundle:
-        metadata = bundle.read_attributes()
-
-        text = ""
-        html = None
-        uuid_str = None
-        if "text" in metadata:
-            text = bundle.read_file(metadata["text"]).decode()
-        if "html" in metadata:
-            html = bundle.read_file(metadata["html"]).decode()
-        if "uuid" in metadata:
-            uuid_str = metadata["uuid"]
-        else:
-            logger.warning("missing metadata uuid")
-            uuid_str = str(uuid.uuid1())
-
-        if title is None:
-            title = uuid_str
-
-        kwargs = {
-            "smtp_host": smtp_host,
-            "smtp_port": int(smtp_port),
-            "smtp_user": smtp_user,
-            "smtp_password": smtp_password}
-
-        if html is not None:
-            kwargs["html_body"] = html
-
-        files = [(obj.bundle, os.path.basename(obj.bundle), None)]
-        logger.info("Publishing '{}' to {}".format(title, to_addr))
-        oval.core.send_email(
-            from_addr, to_addr, title, text, files=files, **kwargs)
+        smtp_user, smtp_password, starttls, title, queue, outbox, bundles):
+    """
+    Publish the bundle, or the BUNDLES, by email. Every recipient gets
+    one message per bundle, and all bundles are sent over one SMTP
+    connection. With --queue they're added to the outbox instead; the
+    SMTP password isn't stored, pass it to 'oval outbox run'.
+    """
+    import oval.outbox
+
+    if queue:
+        with oval.outbox.Outbox(outbox) as queued:
+            for bundle in bundles or [obj.bundle]:
+                if not os.path.exists(bundle):
+                    raise click.ClickException(
+                        "{} doesn't exist".format(bundle))
+                message_id = queued.enqueue(
+                    bundle, from_addr, [*to_addr], title=title,
+                    smtp_host=smtp_host, smtp_port=smtp_port,
+                    smtp_user=smtp_user, smtp_starttls=starttls)
+                print("queued {} as {}".format(bundle, message_id))
+        return
+
+    failed = 0
+    with oval.core.SMTPSession(
+            smtp_host, smtp_port, smtp_user=smtp_user,
+            smtp_password=smtp_password, smtp_starttls=starttls) as session:
+        for bundle in bundles or [obj.bundle]:
+            errors = oval.core.publish_bundle(
+                bundle, from_addr, [*to_addr], title=title, session=session)
+            for recipient, error in errors.items():
+                if error is not None:
+                    failed += 1
+                    print("failed {} to {}: {}".format(
+                        bundle, recipient, error))
+    if failed:
+        raise click.ClickException("{} deliveries failed".format(failed))
@@ -0,0 +1,219 @@
+"""
+Benchmarks of bundle operations across bundle sizes.
+"""
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import oval
+import oval.core
+import oval.smtpstub
+import oval.synth
+
+
+logger = logging.getLogger(__name__)
+
+BENCH_OPERATIONS = (
+    "create", "add_chart", "edit_chart", "read_attribute", "list_charts",
+    "rescale_chart_data", "copy_chart", "publish")
+
+DEFAULT_BENCH_CHARTS = (1, 10)
+DEFAULT_BENCH_ROWS = (1000, 100000)
+DEFAULT_BENCH_COMPRESSIONS = ("stored", "deflate")
+
+
+def measure(func, repeat=3, setup=None):
+    """
+    Times repeat calls of func, calling setup untimed before each, then
+    makes one more call under tracemalloc to record its peak memory.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "min_seconds": min(times),
+        "median_seconds": statistics.median(times),
+        "max_seconds": max(times),
+        "peak_memory_bytes": peak_memory}
+
+
+def _write_csv(dirname, index, num_rows):
+    """
+    Writes a synthetic chart CSV that differs for each index so the bundle
+    doesn't deduplicate the chart data.
+    """
+    filename = os.path.join(dirname, "bench_{}.csv".format(index))
+    oval.synth.generate_signal(
+        num_samples=num_rows, frequency=index + 1, noise=0.1,
+        seed=index).to_csv(filename, index=False)
+    return filename
+
+
+def bench_case(
+        workdir, num_charts, num_rows, repeat=3, smtp=None,
+        compression="stored"):
+    """
+    Benchmarks each of BENCH_OPERATIONS on a bundle with num_charts charts
+    of num_rows rows, compressed as specified. Mutating operations run on
+    a fresh copy of the bundle every time. Publishing sends to the smtp
+    stub.
+    """
+    csv_filenames = [
+        _write_csv(workdir, i, num_rows) for i in range(num_charts + 1)]
+    base_filename = os.path.join(workdir, "base.zip")
+    with oval.core.Bundle(base_filename, compression=compression) as bundle:
+        bundle.create(title="bench")
+        with bundle.transaction():
+            for csv_filename in csv_filenames[:num_charts]:
+                bundle.add_chart(csv_filename)
+
+    filename = os.path.join(workdir, "bench.zip")
+
+    def new_bundle():
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def copy_bundle():
+        shutil.copyfile(base_filename, filename)
+
+    def run(method, *args, **kwargs):
+        def func():
+            with oval.core.Bundle(
+                    filename, compression=compression) as bundle:
+                getattr(bundle, method)(*args, **kwargs)
+        return func
+
+    def publish():
+        oval.core.send_email(
+            "bench@localhost", ["bench@localhost"], "bench", "bench",
+            files=[(filename, "bench.zip", None)],
+            smtp_host=smtp.host, smtp_port=smtp.port, smtp_starttls=False,
+            mime_cache_dir=os.path.join(workdir, "mime"))
+
+    operations = {
+        "create": (run("create", title="bench"), new_bundle),
+        "add_chart": (run("add_chart", csv_filenames[-1]), copy_bundle),
+        "edit_chart": (run("edit_chart", 0, title="edited"), copy_bundle),
+        "read_attribute": (run("read_attribute", "title"), copy_bundle),
+        "list_charts": (run("list_charts"), copy_bundle),
+        "rescale_chart_data": (
+            run("rescale_chart_data", 0, "sample"), copy_bundle),
+        "copy_chart": (run("copy_chart", 0, "copy.csv"), copy_bundle),
+        "publish": (publish, copy_bundle),
+    }
+
+    results = {}
+    for name in BENCH_OPERATIONS:
+        if name == "publish" and smtp is None:
+            continue
+        func, setup = operations[name]
+        logger.info("bench {} charts={} rows={} compression={}".format(
+            name, num_charts, num_rows, compression))
+        results[name] = measure(func, repeat=repeat, setup=setup)
+
+    return {
+        "num_charts": num_charts,
+        "num_rows": num_rows,
+        "compression": compression,
+        "bundle_size": os.path.getsize(base_filename),
+        "operations": results}
+
+
+def run_benchmarks(
+        charts=DEFAULT_BENCH_CHARTS, rows=DEFAULT_BENCH_ROWS, repeat=3,
+        publish=True, compressions=DEFAULT_BENCH_COMPRESSIONS):
+    """
+    Runs bench_case for every combination of chart count, row count and
+    compression in a temporary directory and returns the results as a
+    json serializable dict. Comparing the bundle sizes and timings of the
+    compressions shows their size versus cpu trade-off.
+    """
+    smtp = oval.smtpstub.SMTPStub(keep_data=False).start() if publish else None
+    try:
+        cases = []
+        for num_charts in charts:
+            for num_rows in rows:
+                for compression in compressions:
+                    with tempfile.TemporaryDirectory() as workdir:
+                        cases.append(bench_case(
+                            workdir, num_charts, num_rows, repeat=repeat,
+                            smtp=smtp, compression=compression))
+    finally:
+        if smtp is not None:
+            smtp.stop()
+
+    return {
+        "oval_version": oval.__version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "created": datetime.datetime.now().isoformat(),
+        "repeat": repeat,
+        "cases": cases}
+
+
+def compare_results(results, baseline, threshold=0.25):
+    """
+    Returns the regressions of results against baseline as dicts, for each
+    operation whose median time or peak memory grew by more than threshold
+    (a fraction) in a case present in both.
+    """
+    def case_key(case):
+        return (case["num_charts"], case["num_rows"],
+                case.get("compression", "stored"))
+
+    baseline_cases = {case_key(case): case for case in baseline["cases"]}
+
+    regressions = []
+    for case in results["cases"]:
+        key = case_key(case)
+        if key not in baseline_cases:
+            continue
+        baseline_operations = baseline_cases[key]["operations"]
+        for name, measured in case["operations"].items():
+            if name not in baseline_operations:
+                continue
+            for metric in ("median_seconds", "peak_memory_bytes"):
+                old = baseline_operations[name][metric]
+                new = measured[metric]
+                if old > 0 and new > old * (1 + threshold):
+                    regressions.append({
+                        "num_charts": key[0],
+                        "num_rows": key[1],
+                        "compression": key[2],
+                        "operation": name,
+                        "metric": metric,
+                        "baseline": old,
+                        "result": new,
+                        "ratio": new / old})
+    return regressions
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_results(results, filename):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2)
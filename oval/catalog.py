@@ -0,0 +1,302 @@
+"""
+SQLite catalog of the attributes and charts of a directory of bundles,
+for finding bundles without opening them.
+"""
+import datetime
+import fnmatch
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import oval.core
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG = os.environ.get("OVAL_CATALOG", "catalog.sqlite")
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    uuid TEXT,
+    title TEXT,
+    create_time TEXT,
+    num_charts INTEGER NOT NULL,
+    index_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bundles_uuid ON bundles (uuid);
+CREATE INDEX IF NOT EXISTS bundles_create_time ON bundles (create_time);
+CREATE TABLE IF NOT EXISTS attributes (
+    bundle_id INTEGER NOT NULL REFERENCES bundles (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS attributes_name ON attributes (name, value);
+CREATE TABLE IF NOT EXISTS charts (
+    bundle_id INTEGER NOT NULL REFERENCES bundles (id) ON DELETE CASCADE,
+    chart_index INTEGER NOT NULL,
+    title TEXT,
+    chart_type TEXT,
+    x_column TEXT,
+    y_column TEXT,
+    x_min REAL,
+    x_max REAL,
+    y_min REAL,
+    y_max REAL,
+    num_rows INTEGER,
+    PRIMARY KEY (bundle_id, chart_index)
+);
+CREATE TABLE IF NOT EXISTS chart_columns (
+    bundle_id INTEGER NOT NULL REFERENCES bundles (id) ON DELETE CASCADE,
+    chart_index INTEGER NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chart_columns_name ON chart_columns (name);
+"""
+
+# bundle attributes kept in their own columns of the bundles table
+BUNDLE_COLUMNS = ("uuid", "title", "create_time")
+
+
+def _attribute_value(value):
+    """
+    Returns the text an attribute is matched against, or None for
+    attributes that aren't indexed such as lists and dicts.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return None
+
+
+def _create_time(value):
+    """
+    Returns an ISO date or time in the format bundle create times are
+    stored in, str of a datetime, so they compare as strings. Partial
+    dates such as 2026-02 are returned as they are.
+    """
+    try:
+        return str(datetime.datetime.fromisoformat(value))
+    except ValueError:
+        return value
+
+
+def _num_rows(chart):
+    """
+    Returns the number of rows of a chart from its column statistics, or
+    None if they weren't computed.
+    """
+    stats = (chart.get("column_stats") or {}).get(chart.get("x_column"))
+    if not stats:
+        return None
+    return stats["count"] + stats.get("nan_count", 0)
+
+
+class Catalog(oval.core.OvalObj):
+    """
+    SQLite index of bundle attributes and chart metadata. Bundles are
+    re-read when their mtime or size changes. Queries are answered from
+    the index alone.
+    """
+    def __init__(self, filename=DEFAULT_CATALOG):
+        self.filename = filename
+        self._db = sqlite3.connect(filename, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.executescript(CATALOG_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def index(self, directory, pattern="*.zip"):
+        """
+        Indexes the bundles matching the glob pattern anywhere under the
+        directory, reading only those that are new or changed since the
+        last index, and drops the bundles under it that were removed.
+        Returns the number of bundles added, updated, unchanged, removed
+        and failed.
+        """
+        counts = dict.fromkeys(
+            ("added", "updated", "unchanged", "removed", "failed"), 0)
+        directory = os.path.abspath(directory)
+        # LIKE ignores ASCII case, so the prefix is compared exactly
+        prefix = os.path.join(directory, "")
+        known = {
+            row["path"]: (row["mtime_ns"], row["size"])
+            for row in self._db.execute(
+                "SELECT path, mtime_ns, size FROM bundles "
+                "WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))}
+
+        found = set()
+        for root, dirs, files in os.walk(directory):
+            for name in fnmatch.filter(files, pattern):
+                filename = os.path.join(root, name)
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                found.add(filename)
+                key = (st.st_mtime_ns, st.st_size)
+                if known.get(filename) == key:
+                    counts["unchanged"] += 1
+                    continue
+                try:
+                    self.add(filename, st)
+                except Exception as e:
+                    logger.warning("can't index {}: {}".format(filename, e))
+                    counts["failed"] += 1
+                    continue
+                counts["updated" if filename in known else "added"] += 1
+
+        removed = [path for path in known if path not in found]
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM bundles WHERE path = ?",
+                [(path,) for path in removed])
+        counts["removed"] = len(removed)
+        return counts
+
+    def add(self, filename, st=None):
+        """
+        Reads the bundle's metadata into the catalog, replacing any
+        earlier entry of it.
+        """
+        filename = os.path.abspath(filename)
+        if st is None:
+            st = os.stat(filename)
+        with oval.core.Bundle(filename) as bundle:
+            metadata = bundle.read_attributes()
+        charts = metadata.get("chart_data") or []
+
+        with self._db:
+            self._db.execute("DELETE FROM bundles WHERE path = ?", (filename,))
+            bundle_id = self._db.execute(
+                "INSERT INTO bundles (path, mtime_ns, size, uuid, title, "
+                "create_time, num_charts, index_time) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (filename, st.st_mtime_ns, st.st_size,
+                 *[_attribute_value(metadata.get(name))
+                   for name in BUNDLE_COLUMNS],
+                 len(charts), time.time())).lastrowid
+            self._db.executemany(
+                "INSERT INTO attributes (bundle_id, name, value) "
+                "VALUES (?, ?, ?)",
+                [(bundle_id, name, _attribute_value(value))
+                 for name, value in metadata.items()
+                 if name != "chart_data" and
+                 _attribute_value(value) is not None])
+            self._db.executemany(
+                "INSERT INTO charts (bundle_id, chart_index, title, "
+                "chart_type, x_column, y_column, x_min, x_max, y_min, y_max, "
+                "num_rows) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(bundle_id, i, chart.get("title"), chart.get("chart_type"),
+                  chart.get("x_column"), chart.get("y_column"),
+                  chart.get("x_min"), chart.get("x_max"),
+                  chart.get("y_min"), chart.get("y_max"), _num_rows(chart))
+                 for i, chart in enumerate(charts)])
+            self._db.executemany(
+                "INSERT INTO chart_columns (bundle_id, chart_index, name) "
+                "VALUES (?, ?, ?)",
+                [(bundle_id, i, column)
+                 for i, chart in enumerate(charts)
+                 for column in chart.get("columns") or []])
+        return bundle_id
+
+    def find(
+            self, attributes=(), uuid=None, title=None, chart_title=None,
+            column=None, created_after=None, created_before=None,
+            min_rows=None):
+        """
+        Returns the bundles matching all of the given criteria as dicts,
+        each with the list of its charts that match the chart criteria
+        (chart_title, column and min_rows). Titles and attribute values
+        are glob patterns, attributes being (name, pattern) pairs. Times
+        are ISO dates or times.
+        """
+        where = []
+        params = []
+        for name, pattern in attributes:
+            if name in BUNDLE_COLUMNS:
+                where.append("b.{} GLOB ?".format(name))
+                params.append(pattern)
+            else:
+                where.append(
+                    "EXISTS (SELECT 1 FROM attributes a WHERE "
+                    "a.bundle_id = b.id AND a.name = ? AND a.value GLOB ?)")
+                params.extend((name, pattern))
+        if uuid is not None:
+            where.append("b.uuid = ?")
+            params.append(uuid)
+        if title is not None:
+            where.append("b.title GLOB ?")
+            params.append(title)
+        if created_after is not None:
+            where.append("b.create_time >= ?")
+            params.append(_create_time(created_after))
+        if created_before is not None:
+            where.append("b.create_time < ?")
+            params.append(_create_time(created_before))
+
+        chart_where = []
+        chart_params = []
+        if chart_title is not None:
+            chart_where.append("c.title GLOB ?")
+            chart_params.append(chart_title)
+        if column is not None:
+            chart_where.append(
+                "EXISTS (SELECT 1 FROM chart_columns cc WHERE "
+                "cc.bundle_id = c.bundle_id AND "
+                "cc.chart_index = c.chart_index AND cc.name = ?)")
+            chart_params.append(column)
+        if min_rows is not None:
+            chart_where.append("c.num_rows >= ?")
+            chart_params.append(min_rows)
+        if chart_where:
+            where.append(
+                "EXISTS (SELECT 1 FROM charts c WHERE c.bundle_id = b.id "
+                "AND {})".format(" AND ".join(chart_where)))
+            params.extend(chart_params)
+
+        bundles = [dict(row) for row in self._db.execute(
+            "SELECT b.id, b.path, b.uuid, b.title, b.create_time, "
+            "b.num_charts FROM bundles b{} ORDER BY b.path".format(
+                " WHERE " + " AND ".join(where) if where else ""),
+            params)]
+        for bundle in bundles:
+            rows = self._db.execute(
+                "SELECT c.chart_index, c.title, c.chart_type, c.x_column, "
+                "c.y_column, c.x_min, c.x_max, c.y_min, c.y_max, c.num_rows, "
+                "(SELECT json_group_array(cc.name) FROM chart_columns cc "
+                "WHERE cc.bundle_id = c.bundle_id AND "
+                "cc.chart_index = c.chart_index) AS columns "
+                "FROM charts c WHERE c.bundle_id = ?{} "
+                "ORDER BY c.chart_index".format(
+                    "".join(" AND " + c for c in chart_where)),
+                (bundle.pop("id"), *chart_params))
+            bundle["charts"] = [
+                dict(row, columns=json.loads(row["columns"])) for row in rows]
+        return bundles
+
+    def stats(self):
+        """
+        Returns the number of bundles and charts in the catalog.
+        """
+        return {
+            "bundles": self._db.execute(
+                "SELECT COUNT(*) FROM bundles").fetchone()[0],
+            "charts": self._db.execute(
+                "SELECT COUNT(*) FROM charts").fetchone()[0]}
@@ -1,79 +1,182 @@
-import cProfile
+import copy
 import datetime
+import fnmatch
+import hashlib
+import io
 import json
-# from email.mime.application import MIMEApplication
 import logging
-import mimetypes
 import os
-import pstats
 import shutil
-import smtplib
-import ssl
 import sys
 import tempfile
+import threading
+import time
 import uuid
+import warnings
 import zipfile
 from contextlib import contextmanager
-from email import encoders
-from email.mime.audio import MIMEAudio
-from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import COMMASPACE, formatdate
-
-import numpy as np
 
 import oval
 
-import pandas as pd
-
-from sklearn.preprocessing import MinMaxScaler
-
 
 logger = logging.getLogger(__name__)
 LOG_FORMAT = '%(asctime)s %(levelname)-8.8s [%(name)s:%(lineno)s] %(message)s'
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# rows of csv chart data parsed at a time when reading an x range
+READ_CHUNK_ROWS = 64 * 1024
+
+# rows between the entries of the block index of csv charts whose x
+# column is increasing
+X_INDEX_BLOCK_ROWS = 4096
+
+# bytes of attachment base64 encoded at a time, a whole number of 76
+# character lines
+ENCODE_CHUNK_SIZE = 57 * 4096
+
+# encoded email attachments are cached in this per user directory, and
+# dropped after a day
+MIME_CACHE_DIR = os.environ.get("OVAL_MIME_CACHE") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"), "oval", "mime")
+MIME_CACHE_MAX_AGE = 24 * 60 * 60
+
+# chart data storage formats: name -> (mimetype, file extension)
+CHART_FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "npz": ("application/x-npz", ".npz"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet")}
+DEFAULT_CHART_FORMAT = "csv"
+
+# chart data entries are named by the sha256 of their contents under this
+# directory, so identical data is only stored once
+CHART_DATA_DIR = "data/"
+
+# bucket counts of the downsampled level of detail series built for charts
+DEFAULT_LOD_BUCKETS = (128, 512, 2048, 8192)
+
+# see rescale_transform
+RESCALE_MODES = ("minmax", "relative", "zscore")
+
+# zip compression methods by name. The website renderer only reads stored
+# and deflate entries.
+COMPRESSION_METHODS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA}
+
+# entries that are already compressed, which CompressionPolicy stores as is
+COMPRESSED_PATTERNS = (
+    "*.parquet", "*.png", "*.jpg", "*.jpeg", "*.gif", "*.gz", "*.bz2",
+    "*.xz", "*.zip")
+
+# callables that receive every finished Span, see add_span_collector
+_span_collectors = []
+_span_stack = threading.local()
 
 
 class BundleError(RuntimeError):
     pass
 
 
+# handler installed by setup_logging
+_log_handler = None
+
+
 def setup_logging(
         log="-", log_level=logging.DEBUG, log_format=LOG_FORMAT):
     """
     Initialize logging for the app.
     """
+    global _log_handler
+
     root = logging.getLogger()
     formatter = logging.Formatter(log_format)
 
+    # replace the handler of a previous call, e.g. in a map worker process
+    if _log_handler is not None:
+        root.removeHandler(_log_handler)
+        _log_handler.close()
+        _log_handler = None
+
     if log == "-":
         sh = logging.StreamHandler()
         sh.setLevel(log_level)
         sh.setFormatter(formatter)
         root.addHandler(sh)
+        _log_handler = sh
     elif log:
         fh = logging.FileHandler(filename=log, mode='w')
         fh.setLevel(log_level)
         fh.setFormatter(formatter)
         root.addHandler(fh)
+        _log_handler = fh
 
     root.setLevel(logging.DEBUG)
 
 
+def add_span_collector(collector):
+    """
+    Registers a callable to be called with every Span that finishes.
+    """
+    _span_collectors.append(collector)
+
+
+def remove_span_collector(collector):
+    """
+    Unregisters a callable registered with add_span_collector.
+    """
+    _span_collectors.remove(collector)
+
+
+@contextmanager
+def span(name, **fields):
+    """
+    Context that times a named phase of a bundle operation, yielding the
+    Span so the phase can count the bytes it reads and writes. Keyword
+    args are recorded with it. Finished spans are passed to the
+    registered collectors.
+    """
+    stack = getattr(_span_stack, "names", None)
+    if stack is None:
+        stack = _span_stack.names = []
+    current = Span(name, fields, stack[-1] if stack else None)
+    stack.append(name)
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - current.start
+        stack.pop()
+        for collector in list(_span_collectors):
+            collector(current)
+
+
 @contextmanager
 def cli_context(obj):
     """
-    Context manager for CLI options.
+    Context manager for CLI options. Commands run by a batch share the
+    batch's bundle.
     """
+    batch_bundle = getattr(obj, "batch_bundle", None)
+    if batch_bundle is not None:
+        yield batch_bundle
+        return
+
     if obj.profiling:
+        import cProfile
         logger.info("enabling profiling")
         pr = cProfile.Profile()
         pr.enable()
 
-    yield Bundle(obj.bundle)
+    with span("command", command=getattr(obj, "command", None)):
+        bundle = Bundle(
+            obj.bundle, compression=getattr(obj, "compression", None))
+        yield bundle
+        bundle.close()
 
     if obj.profiling:
+        import pstats
         pr.disable()
         prof = pstats.Stats(pr, stream=sys.stdout)
         ps = prof.sort_stats('cumulative')
@@ -81,11 +184,13 @@ def cli_context(obj):
 
 
 @contextmanager
-def edit_archive(zip_file):
+def edit_archive(zip_file, compression=None):
     """
     Context to extract zip file to a temp directory,
-    yielding that then re-archiving the directory contents.
+    yielding that then re-archiving the directory contents, compressed
+    according to the compression policy if specified.
     """
+    compression = compression_policy(compression)
     with tempfile.TemporaryDirectory() as extract_dir:
         if os.path.exists(zip_file):
             try:
@@ -97,16 +202,500 @@ def edit_archive(zip_file):
         with zipfile.ZipFile(zip_file, mode="w") as archive:
             for root, dirs, files in os.walk(extract_dir):
                 for name in files:
-                    logger.debug("archiving: {}".format(name))
-                    archive.write(os.path.join(root, name), name)
+                    filename = os.path.join(root, name)
+                    arcname = os.path.relpath(filename, extract_dir)
+                    logger.debug("archiving: {}".format(arcname))
+                    compress_type, level = compression.entry(arcname)
+                    archive.write(
+                        filename, arcname, compress_type=compress_type,
+                        compresslevel=level)
 
 
-def send_email(from_addr, to_addrs, subject, body, files=[], **kwargs):
-    logger.debug("sending email: {} -> {} :: subject: {} :: body: {}".format(
-        from_addr, to_addrs, subject, body))
+@contextmanager
+def append_archive(zip_file):
+    """
+    Context to open a zip file for appending new entries without
+    rewriting existing ones. Writing an entry under an existing name
+    shadows the older entry, which stays in the archive until it is
+    compacted.
+    """
+    mode = "a" if zipfile.is_zipfile(zip_file) else "w"
+    with warnings.catch_warnings():
+        warnings.filterwarnings(
+            "ignore", message="Duplicate name", category=UserWarning)
+        with zipfile.ZipFile(zip_file, mode=mode) as archive:
+            yield archive
+
+
+def latest_entries(archive):
+    """
+    Returns the entries of an open archive that are not shadowed by a
+    later entry of the same name, in archive order.
+    """
+    return [
+        info for info in archive.infolist()
+        if archive.getinfo(info.filename) is info]
+
+
+def copy_entry(src, dst, info, compression=None):
+    """
+    Streams a single entry from one open archive into another, recompressing
+    it according to the compression policy if specified.
+    """
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    if compression is not None:
+        # ZipFile.open only takes the level from the ZipInfo
+        new_info.compress_type, new_info._compresslevel = \
+            compression.entry(info.filename)
+    new_info.external_attr = info.external_attr
+    new_info.comment = info.comment
+    if info.is_dir():
+        dst.writestr(new_info, b"")
+        return
+    force_zip64 = info.file_size > zipfile.ZIP64_LIMIT
+    with src.open(info) as fin, \
+            dst.open(new_info, "w", force_zip64=force_zip64) as fout:
+        shutil.copyfileobj(fin, fout, COPY_CHUNK_SIZE)
+
+
+def compact_archive(zip_file, keep=None, compression=None):
+    """
+    Rewrites the zip file keeping only the latest copy of each entry,
+    and only entries whose names pass the keep predicate if specified.
+    Entries are recompressed according to the compression policy if
+    specified, otherwise they keep their compression. Returns the number
+    of bytes reclaimed.
+    """
+    old_size = os.path.getsize(zip_file)
+    fd, tmp_filename = tempfile.mkstemp(
+        suffix=".tmp", dir=os.path.dirname(os.path.abspath(zip_file)))
+    os.close(fd)
+    with span("compact", filename=zip_file) as s:
+        try:
+            with zipfile.ZipFile(zip_file, mode="r") as src, \
+                    zipfile.ZipFile(tmp_filename, mode="w") as dst:
+                for info in latest_entries(src):
+                    if keep is not None and not keep(info.filename):
+                        logger.debug("dropping: {}".format(info.filename))
+                        continue
+                    logger.debug("compacting: {}".format(info.filename))
+                    copy_entry(src, dst, info, compression)
+            shutil.copymode(zip_file, tmp_filename)
+            os.replace(tmp_filename, zip_file)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        s.bytes_read = old_size
+        s.bytes_written = os.path.getsize(zip_file)
+    return old_size - s.bytes_written
+
+
+def compression_policy(compression):
+    """
+    Returns a CompressionPolicy for a policy, a "method[:level]" string or
+    None, which stores every entry.
+    """
+    if isinstance(compression, CompressionPolicy):
+        return compression
+    if compression is None:
+        return CompressionPolicy()
+    return CompressionPolicy.parse(compression)
+
+
+def chart_data_name(data, extension):
+    """
+    Returns the content addressed archive name for chart data bytes,
+    or for a hashlib object that has consumed them.
+    """
+    if isinstance(data, bytes):
+        data = hashlib.sha256(data)
+    return "{}{}{}".format(CHART_DATA_DIR, data.hexdigest(), extension)
+
+
+def chart_format(mimetype):
+    """
+    Returns the chart data format name for a chart mimetype.
+    """
+    for name, (format_mimetype, _) in CHART_FORMATS.items():
+        if format_mimetype == mimetype:
+            return name
+    raise BundleError("Unsupported chart data mimetype: {}".format(mimetype))
+
+
+def encode_chart_data(df, data_format=DEFAULT_CHART_FORMAT):
+    """
+    Serializes chart data to bytes in the specified storage format.
+    """
+    with span("csv_write", format=data_format) as s:
+        data = _encode_chart_data(df, data_format)
+        s.bytes_written = len(data)
+    return data
+
+
+def _encode_chart_data(df, data_format):
+    import numpy as np
+
+    if data_format == "csv":
+        return df.to_csv().encode()
+
+    buf = io.BytesIO()
+    if data_format == "npz":
+        arrays = {}
+        for column in df.columns:
+            values = df[column].to_numpy()
+            if values.dtype.kind == "O":
+                # store text as fixed width unicode so no pickling is needed
+                values = values.astype(str)
+            arrays[str(column)] = values
+        np.savez(buf, **arrays)
+    elif data_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise BundleError("parquet chart data requires pyarrow")
+        df.to_parquet(buf)
+    else:
+        raise BundleError(
+            "Unsupported chart data format: {}".format(data_format))
+    return buf.getvalue()
+
+
+def decode_chart_data(data, mimetype="text/csv"):
+    """
+    Parses chart data bytes stored with the specified mimetype into a
+    DataFrame.
+    """
+    data_format = chart_format(mimetype)
+    with span("csv_parse", format=data_format) as s:
+        s.bytes_read = len(data)
+        return _decode_chart_data(data, data_format)
+
+
+def _decode_chart_data(data, data_format):
+    import numpy as np
+    import pandas as pd
+
+    if data_format == "csv":
+        df = pd.read_csv(io.BytesIO(data))
+        # csv chart data is stored with its index as an unnamed column
+        if len(df.columns) and df.columns[0] == "Unnamed: 0":
+            df = df.set_index(df.columns[0])
+            df.index.name = None
+        return df
+    if data_format == "npz":
+        with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+            return pd.DataFrame({name: npz[name] for name in npz.files})
+    return pd.read_parquet(io.BytesIO(data))
+
+
+def csv_block_index(data, x_values, first_row=0, offset=0, header=True,
+                    block_rows=None):
+    """
+    Returns [x, row, byte offset] of every block_rows-th row of csv chart
+    data bytes, whose rows are numbered from first_row and whose bytes
+    start at offset in the chart data entry. Returns None if the rows
+    can't be found by their line breaks, because of quoted newlines.
+    """
+    import numpy as np
+
+    block_rows = block_rows or X_INDEX_BLOCK_ROWS
+    newlines = np.flatnonzero(
+        np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+    starts = np.concatenate(([0], newlines[:-1] + 1))
+    if header:
+        starts = starts[1:]
+    if len(starts) != len(x_values):
+        return None
+    rows = np.arange(-first_row % block_rows, len(x_values), block_rows)
+    return [
+        [_json_value(x_values[row]), first_row + int(row),
+         offset + int(starts[row])] for row in rows]
+
+
+def _index_x(chart, blocks=None):
+    """
+    Records in the chart whether its x column is increasing, with the
+    block index of its csv data if so.
+    """
+    stats = (chart.get("column_stats") or {}).get(chart["x_column"]) or {}
+    chart["x_sorted"] = stats.get("monotonic") == "increasing"
+    chart.pop("x_index", None)
+    if chart["x_sorted"] and blocks and len(blocks) > 1:
+        chart["x_index"] = {
+            "block_rows": X_INDEX_BLOCK_ROWS, "blocks": blocks}
+
+
+def _x_range_mask(values, x_range):
+    lo, hi = x_range
+    mask = values == values if lo is None else values >= lo
+    if hi is not None:
+        mask &= values <= hi
+    return mask
+
+
+def _x_range_slice(values, x_range):
+    """
+    Returns the slice of sorted values within x_range, by binary search.
+    """
+    import numpy as np
+
+    lo, hi = x_range
+    start = 0 if lo is None else np.searchsorted(values, lo, side="left")
+    stop = len(values) if hi is None else \
+        np.searchsorted(values, hi, side="right")
+    return slice(int(start), int(max(start, stop)))
 
-    if not isinstance(to_addrs, list):
-        to_addrs = [to_addrs]
+
+def _map_npz_arrays(filename, archive, arcname, names):
+    """
+    Returns read only memory maps of the named arrays of the npz entry of
+    the archive, which is the open zip file filename, or None if the
+    entry or the arrays are compressed or hold python objects.
+    """
+    import struct
+
+    import numpy as np
+
+    info = archive.getinfo(arcname)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    def data_offset(fp, header_offset):
+        # a local file header is 30 bytes then the name and extra field
+        fp.seek(header_offset)
+        header = fp.read(30)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        return header_offset + 30 + name_length + extra_length
+
+    arrays = {}
+    with open(filename, "rb") as fp:
+        entry_offset = data_offset(fp, info.header_offset)
+        with archive.open(arcname) as entry, zipfile.ZipFile(entry) as npz:
+            for name in names:
+                try:
+                    member = npz.getinfo(name + ".npy")
+                except KeyError:
+                    raise BundleError("No such column: {}".format(name))
+                if member.compress_type != zipfile.ZIP_STORED:
+                    return None
+                fp.seek(data_offset(
+                    fp, entry_offset + member.header_offset))
+                version = np.lib.format.read_magic(fp)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(fp)
+                elif version == (2, 0):
+                    header = np.lib.format.read_array_header_2_0(fp)
+                else:
+                    return None
+                shape, fortran_order, dtype = header
+                if dtype.hasobject:
+                    return None
+                if 0 in shape:
+                    # empty files and ranges can't be mapped
+                    arrays[name] = np.empty(shape, dtype=dtype)
+                    continue
+                arrays[name] = np.memmap(
+                    filename, dtype=dtype, mode="r", offset=fp.tell(),
+                    shape=shape, order="F" if fortran_order else "C")
+    return arrays
+
+
+def _empty_chart_frame(chart, columns=None):
+    """
+    Returns an empty DataFrame with the chart's columns and their types.
+    """
+    import pandas as pd
+
+    column_types = chart.get("column_types") or {}
+    series = {}
+    for column in columns or chart["columns"]:
+        try:
+            series[column] = pd.Series(dtype=column_types.get(column))
+        except TypeError:
+            series[column] = pd.Series(dtype=object)
+    return pd.DataFrame(series)
+
+
+def read_chart_entry(
+        fp, mimetype="text/csv", columns=None, x_column=None, x_range=None,
+        x_sorted=False, x_index=None):
+    """
+    Reads chart data stored with the specified mimetype from a file
+    object into a DataFrame indexed by row number, parsing only columns
+    (default all). If x_range (min, max) is given, only the rows whose
+    x_column value is within it, inclusive, are returned; either bound
+    may be None. With x_sorted, the x column is known to be increasing,
+    so csv parsing stops after the range and npz columns are sliced by
+    binary search. The x_index block index of csv data, see
+    csv_block_index, is then binary searched for the block the range
+    starts in, and parsing starts there.
+    """
+    import bisect
+
+    import numpy as np
+    import pandas as pd
+
+    data_format = chart_format(mimetype)
+    read_columns = None if columns is None else list(columns)
+    if x_range is not None and read_columns is not None and \
+       x_column not in read_columns:
+        read_columns.append(x_column)
+
+    if data_format == "csv":
+        wanted = None if read_columns is None else set(read_columns)
+        kwargs = {}
+        if x_sorted and x_index and x_range is not None and \
+           x_range[0] is not None:
+            blocks = x_index["blocks"]
+            block = bisect.bisect_left(
+                [x for x, _, _ in blocks], x_range[0]) - 1
+            if block > 0:
+                names = pd.read_csv(io.BytesIO(fp.readline()), nrows=0)
+                fp.seek(blocks[block][2])
+                kwargs = {"header": None, "names": list(names.columns)}
+        reader = pd.read_csv(
+            fp, chunksize=READ_CHUNK_ROWS if x_range is not None else None,
+            usecols=None if wanted is None else
+            lambda c: c in wanted or c == "Unnamed: 0", **kwargs)
+        if x_range is None:
+            chunks = [reader]
+        else:
+            chunks = []
+            with reader:
+                for chunk in reader:
+                    values = chunk[x_column].to_numpy()
+                    chunks.append(chunk[_x_range_mask(values, x_range)])
+                    if x_sorted and x_range[1] is not None and \
+                       len(values) and values[-1] > x_range[1]:
+                        break
+        df = pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+        # csv chart data is stored with its index as an unnamed column
+        if len(df.columns) and df.columns[0] == "Unnamed: 0":
+            df = df.set_index(df.columns[0])
+            df.index.name = None
+    elif data_format == "npz":
+        with np.load(fp, allow_pickle=False) as npz:
+            names = npz.files if read_columns is None else read_columns
+            rows = slice(None)
+            if x_range is not None:
+                x_values = npz[x_column]
+                rows = _x_range_slice(x_values, x_range) if x_sorted \
+                    else _x_range_mask(x_values, x_range)
+            arrays = {name: npz[name][rows] for name in names}
+            num_rows = len(npz[names[0]]) if names else 0
+        index = np.arange(num_rows)[rows] if x_range is not None else None
+        df = pd.DataFrame(arrays, index=index)
+    else:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise BundleError("parquet chart data requires pyarrow")
+        filters = None
+        if x_range is not None:
+            filters = [
+                (x_column, op, bound)
+                for op, bound in ((">=", x_range[0]), ("<=", x_range[1]))
+                if bound is not None] or None
+        df = pd.read_parquet(fp, columns=read_columns, filters=filters)
+
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def encode_attachment(filename, cache_dir=None):
+    """
+    Returns the name of a file holding the base64 encoding of a file, as
+    CRLF separated lines. The file is encoded a chunk at a time and the
+    encoding is cached, keyed on the file's path, mtime and size, so
+    sending it again doesn't encode it again.
+    """
+    import base64
+
+    cache_dir = _private_dir(cache_dir or MIME_CACHE_DIR)
+    st = os.stat(filename)
+    key = hashlib.sha256("{}:{}:{}".format(
+        os.path.abspath(filename), st.st_mtime_ns, st.st_size).encode())
+    encoded_filename = os.path.join(cache_dir, key.hexdigest() + ".b64")
+    if os.path.exists(encoded_filename):
+        logger.debug("using cached encoding of {}".format(filename))
+        return encoded_filename
+
+    _prune_mime_cache(cache_dir)
+    fd, tmp_filename = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+    try:
+        with span("mime_encode", filename=filename) as s, \
+                open(filename, "rb") as fin, os.fdopen(fd, "wb") as fout:
+            separator = b""
+            while True:
+                chunk = fin.read(ENCODE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                s.bytes_read += len(chunk)
+                fout.write(separator)
+                fout.write(base64.encodebytes(chunk).rstrip(b"\n").replace(
+                    b"\n", b"\r\n"))
+                separator = b"\r\n"
+            s.bytes_written = fout.tell()
+        os.replace(tmp_filename, encoded_filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+    return encoded_filename
+
+
+def _private_dir(dirname):
+    """
+    Creates the directory only the current user can access, if needed,
+    and returns it. Raises BundleError if it's a symlink, or another user
+    owns it or can write to it, since they could plant files in it.
+    """
+    import stat
+
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+    st = os.lstat(dirname)
+    if not stat.S_ISDIR(st.st_mode):
+        raise BundleError("Not a directory: {}".format(dirname))
+    if hasattr(os, "getuid"):
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise BundleError(
+                "Directory isn't private to the current user: {}".format(
+                    dirname))
+        if st.st_mode & 0o077:
+            os.chmod(dirname, 0o700)
+    return dirname
+
+
+def _prune_mime_cache(cache_dir):
+    """
+    Removes cached attachment encodings older than MIME_CACHE_MAX_AGE.
+    """
+    expired = datetime.datetime.now().timestamp() - MIME_CACHE_MAX_AGE
+    for entry in os.scandir(cache_dir):
+        try:
+            if entry.stat().st_mtime < expired:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def build_email(
+        from_addr, to_addrs, subject, body, files=[], html_body=None,
+        cache_dir=None):
+    """
+    Returns a StreamingEmail with plain text and html bodies, the html
+    defaulting to the text in a paragraph, and files attached, given as
+    (filename, attachment name, mimetype or None) tuples. Attachments are
+    base64 encoded to files by encode_attachment instead of in memory.
+    """
+    # email modules are only needed when publishing
+    import mimetypes
+    from email import policy
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.utils import COMMASPACE, formatdate
 
     msg = MIMEMultipart()
     msg['From'] = from_addr
@@ -115,12 +704,13 @@ def send_email(from_addr, to_addrs, subject, body, files=[], **kwargs):
     msg['Subject'] = subject
 
     msg.attach(MIMEText(body, 'plain', 'utf-8'))
-    if "html_body" in kwargs:
-        html_body = kwargs["html_body"]
-    else:
+    if html_body is None:
         html_body = "<p>{}</p>".format(body)
     msg.attach(MIMEText(html_body, 'html', 'utf-8'))
 
+    # attachment payloads are placeholders replaced by their encodings
+    # when the message is streamed
+    placeholders = {}
     for f in files:
         name, realname, mimetype = f
 
@@ -137,54 +727,808 @@ def send_email(from_addr, to_addrs, subject, body, files=[], **kwargs):
         logger.info("attachment: {} : {} : {}/{}".format(
             name, realname, maintype, subtype))
 
-        switch = {
-            "text": MIMEText,
-            "image": MIMEImage,
-            "audio": MIMEAudio,
-        }
-        if maintype in switch:
-            with open(name, "rb") as fil:
-                part = switch[maintype](fil.read(), _subtype=subtype)
-        else:
-            with open(name, "rb") as fil:
-                part = MIMEBase(maintype, subtype)
-                part.set_payload(fil.read())
-            # Encode the payload using Base64
-            encoders.encode_base64(part)
-        # After the file is closed
+        placeholder = "oval-attachment-{}".format(uuid.uuid4().hex)
+        placeholders[placeholder.encode()] = encode_attachment(
+            name, cache_dir)
+        part = MIMEBase(maintype, subtype)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.set_payload(placeholder)
         part.add_header('Content-Disposition', 'attachment', filename=realname)
         msg.attach(part)
 
-    msg_str = msg.as_string()
-    smtp = None
-    try:
-        smtp = smtplib.SMTP(kwargs["smtp_host"], kwargs["smtp_port"])
-        context = ssl.create_default_context()
-        smtp.starttls(context=context)
-        smtp.login(kwargs["smtp_user"], kwargs["smtp_password"])
-        for to_addr in to_addrs:
-            log_msg = "sending email from {} to {}: {}".format(
-                from_addr, to_addr, subject)
-            logger.debug(log_msg)
-            smtp.sendmail(from_addr, to_addr, msg_str)
-    except Exception as e:
-        logger.exception(str(e))
-    finally:
-        if smtp is not None:
-            smtp.quit()
+    parts = [msg.as_bytes(policy=policy.SMTP)]
+    for placeholder, encoded_filename in placeholders.items():
+        head, tail = parts.pop().split(placeholder, 1)
+        parts.extend([head, encoded_filename, tail])
+    return StreamingEmail(parts)
+
+
+def send_email(
+        from_addr, to_addrs, subject, body, files=[], session=None,
+        **kwargs):
+    """
+    Emails all recipients in a single SMTP transaction, over the session
+    if specified, otherwise over a new SMTPSession made from the smtp_*
+    keyword args. Returns a dict of the error of each recipient, None if
+    the message was accepted for it. See build_email for the other
+    arguments, the cache_dir being the mime_cache_dir keyword arg.
+    """
+    logger.debug("sending email: {} -> {} :: subject: {} :: body: {}".format(
+        from_addr, to_addrs, subject, body))
+
+    if not isinstance(to_addrs, list):
+        to_addrs = [to_addrs]
+
+    msg = build_email(
+        from_addr, to_addrs, subject, body, files=files,
+        html_body=kwargs.get("html_body"),
+        cache_dir=kwargs.get("mime_cache_dir"))
+    if session is not None:
+        return session.send(from_addr, to_addrs, msg)
+    with SMTPSession(
+            kwargs["smtp_host"], kwargs["smtp_port"],
+            smtp_user=kwargs.get("smtp_user"),
+            smtp_password=kwargs.get("smtp_password"),
+            smtp_starttls=kwargs.get("smtp_starttls", True)) as session:
+        return session.send(from_addr, to_addrs, msg)
+
+
+def publish_bundle(
+        bundle_filename, from_addr, to_addrs, title=None, session=None,
+        **kwargs):
+    """
+    Emails the bundle as an attachment, with its text and html attributes
+    as the body, titled with its uuid by default. Returns the errors of
+    each recipient, see send_email.
+    """
+    with Bundle(bundle_filename) as bundle:
+        metadata = bundle.read_attributes()
+        text = ""
+        html = None
+        if "text" in metadata:
+            text = bundle.read_file(metadata["text"]).decode()
+        if "html" in metadata:
+            html = bundle.read_file(metadata["html"]).decode()
+    if "uuid" in metadata:
+        uuid_str = metadata["uuid"]
+    else:
+        logger.warning("missing metadata uuid")
+        uuid_str = str(uuid.uuid1())
+
+    if title is None:
+        title = uuid_str
+
+    files = [(bundle_filename, os.path.basename(bundle_filename), None)]
+    logger.info("Publishing '{}' to {}".format(title, to_addrs))
+    return send_email(
+        from_addr, to_addrs, title, text, files=files, session=session,
+        html_body=html, **kwargs)
+
+
+def _json_value(value):
+    """
+    Converts numpy scalars to the equivalent python values for json.
+    """
+    import numpy as np
+
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _merge_bound(func, bound, value):
+    """
+    Combines a running min or max with a new value, skipping NaNs.
+    """
+    import pandas as pd
+
+    if bound is None or pd.isna(bound):
+        return value
+    if pd.isna(value):
+        return bound
+    return func(bound, value)
+
+
+def _merge_dtypes(dtypes, new_dtypes):
+    """
+    Combines running column dtypes with those of another chunk, promoting
+    numeric types and falling back to object for mismatches.
+    """
+    import numpy as np
+
+    if dtypes is None:
+        return dict(new_dtypes.items())
+    for column, dtype in new_dtypes.items():
+        if dtypes[column] != dtype:
+            try:
+                dtypes[column] = np.result_type(dtypes[column], dtype)
+            except TypeError:
+                dtypes[column] = np.dtype(object)
+    return dtypes
+
+
+def _axis_columns(chart, axis):
+    """
+    Returns the data columns plotted on a chart axis ("x" or "y").
+    """
+    if axis == "y" and chart.get("y_columns"):
+        return [series["column"] for series in chart["y_columns"]]
+    return [chart["{}_column".format(axis)]]
+
+
+def _autoscale(chart, axes):
+    """
+    Sets chart bounds for each axis ("x" or "y") from the statistics of
+    the axis columns.
+    """
+    for axis in axes:
+        stats = [
+            chart["column_stats"][column]
+            for column in _axis_columns(chart, axis)]
+        mins = [s["min"] for s in stats if s["min"] is not None]
+        maxs = [s["max"] for s in stats if s["max"] is not None]
+        chart["{}_min".format(axis)] = min(mins) if mins else None
+        chart["{}_max".format(axis)] = max(maxs) if maxs else None
+
+
+def rescale_transform(stats, mode="minmax", feature_range=(0, 1)):
+    """
+    Returns the (offset, scale, shift) that rescale a column with the
+    specified statistics as (x - offset) * scale + shift. "minmax" maps
+    the column's min and max onto feature_range, "relative" shifts it so
+    its min is zero and "zscore" centers it on its mean in units of its
+    standard deviation. Constant columns are only shifted.
+    """
+    if mode == "relative":
+        return stats["min"], 1, 0
+    if mode == "minmax":
+        low, high = feature_range
+        extent = stats["max"] - stats["min"]
+        return stats["min"], (high - low) / extent if extent else 1, low
+    if mode == "zscore":
+        return stats["mean"], 1 / stats["std"] if stats["std"] else 1, 0
+    raise BundleError("Unsupported rescale mode: {}".format(mode))
+
+
+def rescale_values(values, offset, scale, shift):
+    """
+    Rescales a numpy array in place as (values - offset) * scale + shift.
+    """
+    import numpy as np
+
+    np.subtract(values, offset, out=values)
+    if scale != 1:
+        np.multiply(values, scale, out=values)
+    if shift:
+        np.add(values, shift, out=values)
+    return values
+
+
+def _rescaled_stats(stats, values, offset, scale, shift):
+    """
+    Returns column statistics after a rescale, derived from the ones
+    before it without scanning the data again.
+    """
+    import numpy as np
+
+    bounds = np.array([stats["min"], stats["max"]], dtype=values.dtype)
+    low, high = rescale_values(bounds, offset, scale, shift).tolist()
+    monotonic = stats["monotonic"]
+    if scale < 0:
+        low, high = high, low
+        monotonic = {"increasing": "decreasing",
+                     "decreasing": "increasing"}.get(monotonic)
+    return dict(
+        stats, min=low, max=high, monotonic=monotonic,
+        mean=(stats["mean"] - offset) * scale + shift,
+        std=None if stats["std"] is None else stats["std"] * abs(scale))
+
+
+def downsample_indices(values, buckets):
+    """
+    Returns the sorted row indices that keep the first and last rows and
+    the min and max of each column of values within each of the
+    specified number of equal sized buckets of rows.
+    """
+    import numpy as np
+
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    num_rows = len(values)
+    if not num_rows:
+        return np.array([], dtype=np.int64)
+    size = -(-num_rows // buckets)
+    padded = np.full((size * buckets, values.shape[1]), np.nan)
+    padded[:num_rows] = values
+    blocks = padded.reshape(buckets, size, values.shape[1])
+    nans = np.isnan(blocks)
+    offsets = np.arange(buckets)[:, np.newaxis] * size
+    indices = np.concatenate([
+        (offsets + np.where(nans, np.inf, blocks).argmin(axis=1)).ravel(),
+        (offsets + np.where(nans, -np.inf, blocks).argmax(axis=1)).ravel(),
+        [0, num_rows - 1]])
+    return np.unique(indices[indices < num_rows])
+
+
+def _drop_zero_rows(df, columns):
+    """
+    Returns the rows of df that aren't zero in any of the columns.
+    """
+    return df[(df[columns] != 0).all(axis=1)]
+
+
+def _smtp_error(code, message):
+    """
+    Formats an SMTP error reply as "code message".
+    """
+    if isinstance(message, bytes):
+        message = message.decode(errors="replace")
+    return "{} {}".format(code, message)
 
 
 class OvalObj(object):
     pass
 
 
+class CompressionPolicy(OvalObj):
+    """
+    Chooses the zip compression method and level of each bundle entry.
+    Entries matching the glob pattern of one of the rules, given as
+    (pattern, method, level) tuples, use its method and level. Entries
+    matching COMPRESSED_PATTERNS are stored, and the rest use the default
+    method and level.
+    """
+    def __init__(self, method="stored", level=None, rules=()):
+        self.method = method
+        self.level = level
+        self.rules = [
+            *rules, *[(pattern, "stored", None)
+                      for pattern in COMPRESSED_PATTERNS]]
+        for _, rule_method, _ in self.rules + [(None, method, None)]:
+            if rule_method not in COMPRESSION_METHODS:
+                raise BundleError(
+                    "Unsupported compression method: {}".format(rule_method))
+
+    @classmethod
+    def parse(cls, spec, rules=()):
+        """
+        Returns the policy for a "method[:level]" string and rules given
+        as "pattern=method[:level]" strings.
+        """
+        def method_level(text):
+            method, _, level = text.partition(":")
+            return method, int(level) if level else None
+
+        parsed_rules = []
+        for rule in rules:
+            pattern, sep, rule_spec = rule.rpartition("=")
+            if not sep:
+                raise BundleError(
+                    "Compression rules are pattern=method[:level]: {}".format(
+                        rule))
+            parsed_rules.append((pattern, *method_level(rule_spec)))
+        return cls(*method_level(spec or "stored"), rules=parsed_rules)
+
+    def entry(self, arcname):
+        """
+        Returns the zipfile compress type and level for an entry.
+        """
+        method, level = self.method, self.level
+        for pattern, rule_method, rule_level in self.rules:
+            if fnmatch.fnmatch(arcname, pattern):
+                method, level = rule_method, rule_level
+                break
+        return COMPRESSION_METHODS[method], level
+
+    def apply(self, archive, arcname):
+        """
+        Sets the compression the open archive uses for new entries to the
+        one for the entry.
+        """
+        archive.compression, archive.compresslevel = self.entry(arcname)
+
+
+class SMTPSession(OvalObj):
+    """
+    SMTP connection that is opened, secured and authenticated once, on
+    first use, and reused for every message sent over it. It reconnects
+    if the server dropped the connection.
+    """
+    def __init__(self, smtp_host, smtp_port=587, smtp_user=None,
+                 smtp_password=None, smtp_starttls=True):
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.smtp_user = smtp_user
+        self.smtp_password = smtp_password
+        self.smtp_starttls = smtp_starttls
+        self._smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        """
+        Opens the connection, doing STARTTLS and login if configured.
+        """
+        import smtplib
+        import ssl
+
+        self.close()
+        with span("smtp_connect", host=self.smtp_host):
+            smtp = smtplib.SMTP(self.smtp_host, self.smtp_port)
+            try:
+                if self.smtp_starttls:
+                    smtp.starttls(context=ssl.create_default_context())
+                if self.smtp_user:
+                    smtp.login(self.smtp_user, self.smtp_password)
+            except BaseException:
+                smtp.close()
+                raise
+        self._smtp = smtp
+
+    def close(self):
+        """
+        Closes the connection if it is open.
+        """
+        import smtplib
+
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+    def send(self, from_addr, to_addrs, msg):
+        """
+        Sends a message string or StreamingEmail to all recipients in one
+        transaction. Returns a dict of the error of each recipient, None
+        if the message was accepted for it. Errors are logged rather than
+        raised.
+        """
+        import smtplib
+
+        errors = dict.fromkeys(to_addrs)
+        with span("smtp_send", recipients=len(to_addrs)) as s:
+            try:
+                refused = self._sendmail(from_addr, to_addrs, msg)
+                s.bytes_written = msg.size if isinstance(
+                    msg, StreamingEmail) else len(msg)
+            except smtplib.SMTPRecipientsRefused as e:
+                refused = e.recipients
+            except Exception as e:
+                logger.exception("failed to send email from {}".format(
+                    from_addr))
+                if isinstance(e, smtplib.SMTPResponseException):
+                    error = _smtp_error(e.smtp_code, e.smtp_error)
+                else:
+                    # the connection is in an unknown state
+                    self.close()
+                    error = str(e) or type(e).__name__
+                return dict.fromkeys(to_addrs, error)
+
+        for to_addr, (code, message) in refused.items():
+            errors[to_addr] = _smtp_error(code, message)
+            logger.error("recipient refused: {}: {}".format(
+                to_addr, errors[to_addr]))
+        return errors
+
+    def _sendmail(self, from_addr, to_addrs, msg):
+        import smtplib
+
+        if self._smtp is None:
+            self.connect()
+        send = self._smtp.sendmail
+        if isinstance(msg, StreamingEmail):
+            send = self._stream_mail
+        try:
+            return send(from_addr, to_addrs, msg)
+        except smtplib.SMTPServerDisconnected:
+            logger.debug("reconnecting to {}".format(self.smtp_host))
+            self.connect()
+            send = self._smtp.sendmail
+            if isinstance(msg, StreamingEmail):
+                send = self._stream_mail
+            return send(from_addr, to_addrs, msg)
+
+    def _stream_mail(self, from_addr, to_addrs, msg):
+        """
+        Like smtplib's sendmail, but streams the DATA of a StreamingEmail
+        instead of holding the message in memory.
+        """
+        import smtplib
+
+        smtp = self._smtp
+        smtp.ehlo_or_helo_if_needed()
+        code, response = smtp.mail(from_addr)
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, response, from_addr)
+        refused = {}
+        for to_addr in to_addrs:
+            code, response = smtp.rcpt(to_addr)
+            if code not in (250, 251):
+                refused[to_addr] = (code, response)
+        if len(refused) == len(to_addrs):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, response = smtp.docmd("data")
+        if code != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, response)
+        # escape periods starting lines, including at chunk boundaries
+        last = b"\r\n"
+        for chunk in msg.iter_chunks():
+            stuffed = (last + chunk).replace(b"\r\n.", b"\r\n..")
+            smtp.send(stuffed[len(last):])
+            last = (last + chunk)[-2:]
+        smtp.send(b".\r\n" if last == b"\r\n" else b"\r\n.\r\n")
+        code, response = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+
+class StreamingEmail(OvalObj):
+    """
+    An email message made of byte strings and the names of files to
+    insert between them, so it can be sent without reading the files
+    into memory.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    @property
+    def size(self):
+        return sum(
+            len(part) if isinstance(part, bytes) else os.path.getsize(part)
+            for part in self.parts)
+
+    def iter_chunks(self, chunk_size=ENCODE_CHUNK_SIZE):
+        """
+        Yields the message a chunk at a time.
+        """
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, "rb") as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def as_bytes(self):
+        return b"".join(self.iter_chunks())
+
+
+class Span(OvalObj):
+    """
+    A timed phase of a bundle operation, see span().
+    """
+    def __init__(self, name, fields=None, parent=None):
+        self.name = name
+        self.fields = fields or {}
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "seconds": self.seconds,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "fields": {
+                key: _json_value(value)
+                for key, value in self.fields.items()}}
+
+
+class SpanRecorder(OvalObj):
+    """
+    Span collector that keeps every span it receives, for writing them
+    out with totals per span name.
+    """
+    def __init__(self):
+        self.spans = []
+
+    def __call__(self, span):
+        self.spans.append(span.to_dict())
+
+    def summary(self):
+        """
+        Returns the count, seconds and bytes of the spans totalled by
+        name.
+        """
+        summary = {}
+        for item in self.spans:
+            totals = summary.setdefault(item["name"], {
+                "count": 0, "seconds": 0.0, "bytes_read": 0,
+                "bytes_written": 0})
+            totals["count"] += 1
+            for key in ("seconds", "bytes_read", "bytes_written"):
+                totals[key] += item[key]
+        return summary
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(
+                {"summary": self.summary(), "spans": self.spans}, f,
+                indent=2)
+
+
+class ColumnStatistics(OvalObj):
+    """
+    Per-column summary statistics of chart data: count, NaN count, min,
+    max, mean, population standard deviation and monotonicity. Chunks of
+    the same data can be accumulated with update().
+    """
+    def __init__(self, df=None):
+        self._stats = {}
+        self._last = {}
+        self._unordered = set()
+        if df is not None:
+            self.update(df)
+
+    def update(self, df):
+        """
+        Adds the rows of a DataFrame to the statistics.
+        """
+        import numpy as np
+        import pandas as pd
+
+        numeric = [
+            column for column in df.columns
+            if pd.api.types.is_numeric_dtype(df[column]) and
+            not pd.api.types.is_bool_dtype(df[column])]
+        if numeric and len(df):
+            values = df[numeric].to_numpy(dtype=np.float64)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                nans = np.isnan(values)
+                counts = len(values) - nans.sum(axis=0)
+                mins = np.fmin.reduce(values, axis=0)
+                maxs = np.fmax.reduce(values, axis=0)
+                means = np.nansum(values, axis=0) / counts
+                variances = np.nansum(
+                    (values - means) ** 2, axis=0) / counts
+                diffs = np.diff(values, axis=0)
+                increasing = (diffs >= 0).all(axis=0)
+                decreasing = (diffs <= 0).all(axis=0)
+            for i, column in enumerate(numeric):
+                chunk = {
+                    "count": int(counts[i]),
+                    "nan_count": int(nans[:, i].sum()),
+                    "min": mins[i],
+                    "max": maxs[i],
+                    "mean": means[i],
+                    "var": variances[i],
+                    "increasing": bool(increasing[i]),
+                    "decreasing": bool(decreasing[i]),
+                    "integer": df[column].dtype.kind in "iu"}
+                first, last = values[0, i], values[-1, i]
+                native = np.asarray(df[column].to_numpy())
+                if native.dtype.kind in "iu":
+                    # float64 rounds large integers such as epoch
+                    # nanoseconds, so bounds and order use the integers
+                    chunk["min"], chunk["max"] = native.min(), native.max()
+                    chunk["increasing"] = bool(
+                        (native[1:] >= native[:-1]).all())
+                    chunk["decreasing"] = bool(
+                        (native[1:] <= native[:-1]).all())
+                    first, last = native[0], native[-1]
+                self._merge(column, chunk, first, last)
+
+        for column in df.columns:
+            if column in numeric and len(df):
+                continue
+            series = df[column]
+            nan_count = int(series.isna().sum())
+            try:
+                col_min, col_max = series.min(), series.max()
+            except TypeError:
+                col_min = col_max = None
+            self._merge(column, {
+                "count": len(series) - nan_count,
+                "nan_count": nan_count,
+                "min": col_min,
+                "max": col_max,
+                "mean": None,
+                "var": None,
+                "increasing": bool(series.is_monotonic_increasing),
+                "decreasing": bool(series.is_monotonic_decreasing),
+                "integer": False},
+                *((series.iloc[0], series.iloc[-1]) if len(series)
+                  else (None, None)))
+
+    def _merge(self, column, chunk, first, last):
+        """
+        Merges the statistics of a chunk of a column into the totals.
+        """
+        stats = self._stats.get(column)
+        if stats is None or not (stats["count"] or stats["nan_count"]):
+            self._stats[column] = chunk
+        elif chunk["count"] or chunk["nan_count"]:
+            n_a, n_b = stats["count"], chunk["count"]
+            if chunk["mean"] is None and n_b:
+                # the column has text in this chunk, so it isn't numeric
+                stats["mean"] = stats["var"] = None
+            elif stats["mean"] is not None and n_b:
+                if n_a:
+                    delta = chunk["mean"] - stats["mean"]
+                    stats["var"] = (
+                        stats["var"] * n_a + chunk["var"] * n_b +
+                        delta ** 2 * n_a * n_b / (n_a + n_b)) / (n_a + n_b)
+                    stats["mean"] += delta * n_b / (n_a + n_b)
+                else:
+                    stats["mean"], stats["var"] = chunk["mean"], chunk["var"]
+            try:
+                if column not in self._unordered:
+                    stats["min"] = _merge_bound(
+                        min, stats["min"], chunk["min"])
+                    stats["max"] = _merge_bound(
+                        max, stats["max"], chunk["max"])
+            except TypeError:
+                # mixed numbers and text have no min or max
+                self._unordered.add(column)
+                stats["min"] = stats["max"] = None
+            stats["integer"] = stats["integer"] and chunk["integer"]
+            previous = self._last.get(column)
+            joined = previous is None or first is None
+            try:
+                increasing = joined or bool(previous <= first)
+                decreasing = joined or bool(previous >= first)
+            except TypeError:
+                increasing = decreasing = False
+            stats["increasing"] = stats["increasing"] and \
+                chunk["increasing"] and increasing
+            stats["decreasing"] = stats["decreasing"] and \
+                chunk["decreasing"] and decreasing
+            stats["count"] = n_a + n_b
+            stats["nan_count"] += chunk["nan_count"]
+        if last is not None:
+            self._last[column] = last
+
+    def result(self):
+        """
+        Returns the statistics as a json friendly dict keyed by column.
+        """
+        import math
+
+        import pandas as pd
+
+        def value(v, integer=False):
+            v = _json_value(v)
+            if v is None or (not isinstance(v, str) and pd.isna(v)):
+                return None
+            return int(v) if integer else v
+
+        result = {}
+        for column, stats in self._stats.items():
+            monotonic = None
+            if stats["increasing"]:
+                monotonic = "increasing"
+            elif stats["decreasing"]:
+                monotonic = "decreasing"
+            var = value(stats["var"])
+            result[column] = {
+                "count": stats["count"],
+                "nan_count": stats["nan_count"],
+                "min": value(stats["min"], stats["integer"]),
+                "max": value(stats["max"], stats["integer"]),
+                "mean": value(stats["mean"]),
+                "std": None if var is None else math.sqrt(var),
+                "monotonic": monotonic}
+        return result
+
+
+class _Transaction(OvalObj):
+    """
+    Pending changes of a Bundle transaction.
+    """
+    def __init__(self):
+        self.metadata = None
+        self.metadata_changed = False
+        self.files = {}
+        self.frames = {}
+        # temporary files of streamed entries, written on commit
+        self.spools = {}
+
+
 class Bundle(OvalObj):
     """
     Collection of oval.bio generated chart data.
     """
-    def __init__(self, bundle_filename):
+    def __init__(self, bundle_filename, compression=None):
         self._filename = bundle_filename
+        self._compression = None
+        if compression is not None:
+            self._compression = compression_policy(compression)
         self._metadata_filename = "metadata.json"
+        self._transaction = None
+        self._reader = None
+        self._reader_fp = None
+        self._reader_key = None
+        self._metadata_cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Closes the cached read handle on the bundle file.
+        """
+        self.refresh()
+
+    def refresh(self):
+        """
+        Drops the cached read handle and metadata so the next read goes
+        back to the bundle file.
+        """
+        if self._reader is not None:
+            self._reader.close()
+            self._reader_fp.close()
+        self._reader = None
+        self._reader_fp = None
+        self._reader_key = None
+        self._metadata_cache = None
+
+    def _archive(self):
+        """
+        Returns an open read handle on the bundle, reopening it if the
+        file's mtime, size or inode changed since it was opened.
+        """
+        if self._reader is not None:
+            st = os.stat(self._filename)
+            if self._reader_key != (st.st_mtime_ns, st.st_size, st.st_ino):
+                logger.debug("bundle changed: {}".format(self._filename))
+                self.refresh()
+        if self._reader is None:
+            fp = open(self._filename, "rb")
+            try:
+                with span("zip_open", filename=self._filename):
+                    st = os.fstat(fp.fileno())
+                    self._reader = zipfile.ZipFile(fp, mode="r")
+            except BaseException:
+                fp.close()
+                raise
+            self._reader_fp = fp
+            self._reader_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        return self._reader
+
+    def _cached_metadata(self):
+        """
+        Returns the parsed metadata of the committed bundle, parsing it
+        only when the bundle file changed.
+        """
+        archive = self._archive()
+        if self._metadata_cache is None:
+            data = self._extract(archive, self._metadata_filename)
+            with span("metadata_parse") as s:
+                s.bytes_read = len(data)
+                self._metadata_cache = json.loads(data)
+        return self._metadata_cache
+
+    def _extract(self, archive, arcname):
+        """
+        Reads an entry of the open archive.
+        """
+        with span("extract", arcname=arcname) as s:
+            data = archive.read(arcname)
+            s.bytes_read = len(data)
+        return data
 
     def filename(self):
         """
@@ -197,7 +1541,7 @@ class Bundle(OvalObj):
         """
         Edit archive context
         """
-        with edit_archive(self.filename()) as arc_dir:
+        with edit_archive(self.filename(), self._compression) as arc_dir:
             yield arc_dir
 
     def create(self, **kwargs):
@@ -219,61 +1563,246 @@ class Bundle(OvalObj):
 
         self._set_metadata(bundle_metadata)
 
+    @contextmanager
+    def transaction(self):
+        """
+        Buffers metadata and file changes made inside the context in memory
+        and commits them to the bundle with a single append on exit. Chart
+        data streamed from csv is buffered in temporary files instead.
+        Nothing is written if the context raises. Nested transactions join
+        the outermost one.
+        """
+        if self._transaction is not None:
+            yield self
+            return
+
+        txn = self._transaction = _Transaction()
+        try:
+            try:
+                yield self
+            finally:
+                self._transaction = None
+            if txn.files or txn.spools or txn.metadata_changed:
+                self._append(
+                    txn.files, txn.metadata if txn.metadata_changed else None,
+                    txn.spools)
+        finally:
+            for spool in txn.spools.values():
+                spool.close()
+
     def attributes(self):
         """
         Returns the attribute names of the bundle.
         """
-        with zipfile.ZipFile(self._filename, mode="r") as session:
-            return list(
-                json.loads(session.read(self._metadata_filename)).keys())
+        return list(self._read_metadata().keys())
 
     def read_file(self, arcname):
         """
         Returns the contents of the specified file in the bundle.
         """
-        with zipfile.ZipFile(self._filename, mode="r") as session:
-            return session.read(arcname)
+        fp = self._open_pending(arcname)
+        if fp is not None:
+            with fp:
+                return fp.read()
+        return self._extract(self._archive(), arcname)
+
+    def _is_pending(self, arcname):
+        """
+        Returns whether an entry is buffered by an open transaction.
+        """
+        return self._transaction is not None and (
+            arcname in self._transaction.files or
+            arcname in self._transaction.spools)
+
+    def _open_pending(self, arcname):
+        """
+        Returns a binary file reading an entry buffered by an open
+        transaction, or None if it isn't buffered.
+        """
+        if not self._is_pending(arcname):
+            return None
+        if arcname in self._transaction.files:
+            data = self._transaction.files[arcname]
+            return io.BytesIO(data.encode() if isinstance(data, str) else data)
+        spool = self._transaction.spools[arcname]
+        spool.seek(0)
+        # the duplicate shares the spool's offset but closes on its own
+        return open(os.dup(spool.fileno()), "rb")
 
     def read_attributes(self):
         """
         Returns entire bundle metadata.
         """
-        with zipfile.ZipFile(self._filename, mode="r") as session:
-            return json.loads(session.read(self._metadata_filename))
+        return copy.deepcopy(self._read_metadata())
 
     def has_attribute(self, attribute):
         """
         Return whether the attribute exists in the bundle metadata.
         """
-        return attribute in self.attributes()
+        return attribute in self._read_metadata()
 
     def read_attribute(self, attribute):
         """
         Returns the specified attribute from the bundle.
         """
-        with zipfile.ZipFile(self._filename, mode="r") as session:
-            return json.loads(
-                session.read(self._metadata_filename))[attribute]
+        return copy.deepcopy(self._read_metadata()[attribute])
+
+    def _read_metadata(self):
+        """
+        Returns current metadata, including changes buffered by an open
+        transaction. The result must not be modified.
+        """
+        if self._transaction is not None:
+            return self._get_metadata()
+        return self._cached_metadata()
 
     def _get_metadata(self):
         """
         Return existing attributes
         """
-        with zipfile.ZipFile(self._filename, mode="r") as session:
-            return json.loads(session.read(self._metadata_filename))
+        if self._transaction is not None:
+            if self._transaction.metadata is None:
+                self._transaction.metadata = copy.deepcopy(
+                    self._cached_metadata())
+            return self._transaction.metadata
+        return copy.deepcopy(self._cached_metadata())
 
     def _set_metadata(self, metadata):
         """
         Sets bundle metadata
         """
-        with edit_archive(self._filename) as arc_dir:
-            # update timestamp
-            metadata["timestamp"] = str(datetime.datetime.now())
+        self._append(metadata=metadata)
 
-            # replace the metadata file
-            with open(os.path.join(
-                    arc_dir, self._metadata_filename), "w") as json_file:
-                json.dump(metadata, json_file, indent=4, sort_keys=True)
+    def _append(self, files=None, metadata=None, spools=None):
+        """
+        Appends file entries, given as a dict of archive names to
+        contents, entries copied from the binary files in spools, and
+        optionally new metadata to the bundle. Existing entries are left
+        in place; shadowed ones are dropped on compact(). Inside a
+        transaction the changes are buffered instead, and the transaction
+        closes the spools.
+        """
+        if self._transaction is not None:
+            self._transaction.files.update(files or {})
+            self._transaction.spools.update(spools or {})
+            if metadata is not None:
+                self._transaction.metadata = metadata
+                self._transaction.metadata_changed = True
+            return
+
+        self.refresh()
+        with span("archive_write", filename=self._filename) as s, \
+                append_archive(self._filename) as archive:
+            compression = compression_policy(self._compression)
+            for arcname, data in (files or {}).items():
+                logger.debug("appending: {}".format(arcname))
+                compression.apply(archive, arcname)
+                archive.writestr(arcname, data)
+                s.bytes_written += len(data)
+            for arcname, spool in (spools or {}).items():
+                logger.debug("appending: {}".format(arcname))
+                compression.apply(archive, arcname)
+                spool.seek(0)
+                with archive.open(arcname, "w", force_zip64=True) as entry:
+                    shutil.copyfileobj(spool, entry, COPY_CHUNK_SIZE)
+                s.bytes_written += spool.tell()
+            if metadata is not None:
+                # update timestamp
+                metadata["timestamp"] = str(datetime.datetime.now())
+
+                # shadow the previous metadata file
+                data = json.dumps(metadata, indent=4, sort_keys=True)
+                compression.apply(archive, self._metadata_filename)
+                archive.writestr(self._metadata_filename, data)
+                s.bytes_written += len(data)
+
+    def _read_csv(self, csv_filename):
+        """
+        Parses a csv file. Inside a transaction the parsed frame is reused
+        by later calls for the same unchanged file.
+        """
+        import pandas as pd
+
+        def read_csv():
+            with span("csv_parse", filename=csv_filename) as s:
+                s.bytes_read = os.path.getsize(csv_filename)
+                return pd.read_csv(csv_filename)
+
+        if self._transaction is None:
+            return read_csv()
+        st = os.stat(csv_filename)
+        key = (os.path.abspath(csv_filename), st.st_mtime_ns, st.st_size)
+        if key not in self._transaction.frames:
+            self._transaction.frames[key] = read_csv()
+        return self._transaction.frames[key]
+
+    def add_file(self, filename, arcname=None):
+        """
+        Copies a file into the bundle, returning its archive name.
+        """
+        if arcname is None:
+            arcname = os.path.basename(filename)
+        with open(filename, "rb") as fil:
+            self._append({arcname: fil.read()})
+        return arcname
+
+    def compact(self):
+        """
+        Rewrites the bundle dropping entries shadowed by later writes and
+        chart data no chart references anymore. Entries are recompressed
+        if the bundle has a compression policy. Returns the number of
+        bytes reclaimed. Can't run inside a transaction, whose buffered
+        changes could still be rolled back.
+        """
+        if self._transaction is not None:
+            raise BundleError("Can't compact a bundle inside a transaction")
+        referenced = self.referenced_files()
+        self.refresh()
+        return compact_archive(
+            self._filename,
+            keep=lambda name: (
+                not name.startswith(CHART_DATA_DIR) or name in referenced),
+            compression=self._compression)
+
+    def referenced_files(self):
+        """
+        Returns the set of archive names referenced by the bundle
+        metadata.
+        """
+        metadata = self._read_metadata()
+        referenced = {self._metadata_filename}
+        for attribute in ("text", "html"):
+            if isinstance(metadata.get(attribute), str):
+                referenced.add(metadata[attribute])
+        for chart in metadata.get("chart_data", []):
+            referenced.add(chart["filename"])
+            for level in chart.get("lod", []):
+                referenced.add(level["filename"])
+        return referenced
+
+    def _has_file(self, arcname):
+        """
+        Return whether the bundle, including changes buffered by an open
+        transaction, has an entry with the specified name.
+        """
+        if self._is_pending(arcname):
+            return True
+        try:
+            self._archive().getinfo(arcname)
+        except (FileNotFoundError, zipfile.BadZipFile, KeyError):
+            return False
+        return True
+
+    def _chart_data_files(self, data, extension):
+        """
+        Returns the content addressed name of chart data and the files to
+        append for it, which are none if the bundle already has it.
+        """
+        arcname = chart_data_name(data, extension)
+        if self._has_file(arcname):
+            logger.debug("chart data already stored: {}".format(arcname))
+            return arcname, {}
+        return arcname, {arcname: data}
 
     def update_metadata(self, new_metadata):
         """
@@ -314,16 +1843,102 @@ class Bundle(OvalObj):
 
     def add_chart(self, csv_filename, **kwargs):
         """
-        Add csv data to the bundle. Keyword args are added
-        to chart metadata.
+        Add csv data to the bundle, titled with the file's name by default.
+        See add_chart_frame for the keyword args. Passing a chunksize
+        streams the csv into the bundle that many rows at a time, so
+        memory use doesn't grow with the size of the file. Streamed chunks
+        are stored as parsed, without going through add_chart_frame; csv
+        column names are strings and dates aren't parsed, so the stored
+        data is the same.
         """
+        import pandas as pd
+
         logger.debug("Adding chart: {}".format(csv_filename))
 
-        # TODO: support types that pandas supports
-        df = pd.read_csv(csv_filename)
+        kwargs.setdefault("title", os.path.basename(csv_filename))
+        chunksize = kwargs.pop("chunksize", None)
+        if chunksize:
+            return self._add_chart(
+                pd.read_csv(csv_filename, nrows=0),
+                stream=(csv_filename, chunksize), **kwargs)
+        return self.add_chart_frame(self._read_csv(csv_filename), **kwargs)
+
+    def add_chart_frame(self, df, **kwargs):
+        """
+        Add the data of a DataFrame, or of anything the DataFrame
+        constructor takes, to the bundle. Keyword args are added to chart
+        metadata. By default the first column is the x axis and the second
+        the y axis. Passing a list of y_columns, either column names or
+        dicts with "column", "stroke" and "stroke_width" keys, adds a
+        multi_line chart overlaying all of them. data_format picks the
+        storage format, see CHART_FORMATS, and lod builds levels of
+        detail, see build_lod. The frame's index isn't stored, column
+        names are stored as strings, so a 2D array's columns are named
+        "0", "1", ..., and datetime columns are stored as ISO strings.
+        """
+        import pandas as pd
+
+        if not isinstance(df, pd.DataFrame):
+            df = pd.DataFrame(df)
+        if not isinstance(df.index, pd.RangeIndex) or \
+           df.index.start != 0 or df.index.step != 1:
+            df = df.reset_index(drop=True)
+        # column names are json object keys in the chart metadata
+        if any(not isinstance(column, str) for column in df.columns):
+            df = df.set_axis([str(column) for column in df.columns], axis=1)
+            for key in ("x_column", "y_column"):
+                if key in kwargs:
+                    kwargs[key] = str(kwargs[key])
+            if kwargs.get("y_columns"):
+                kwargs["y_columns"] = [
+                    dict(series, column=str(series["column"]))
+                    if isinstance(series, dict) else str(series)
+                    for series in kwargs["y_columns"]]
+        datetimes = [
+            column for column in df.columns if df[column].dtype.kind == "M"]
+        if datetimes:
+            df = df.assign(**{
+                column: df[column].dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+                for column in datetimes})
+        return self._add_chart(df, **kwargs)
+
+    def add_chart_arrays(self, arrays, **kwargs):
+        """
+        Add chart data given as a dict of column name to one dimensional
+        array, in column order, to the bundle. See add_chart_frame for
+        the keyword args.
+        """
+        import numpy as np
+
+        arrays = {
+            str(name): np.asarray(values) for name, values in arrays.items()}
+        lengths = {len(values) for values in arrays.values()}
+        if len(lengths) > 1 or \
+           any(values.ndim != 1 for values in arrays.values()):
+            raise BundleError(
+                "Chart arrays must be one dimensional and the same length")
+        return self.add_chart_frame(arrays, **kwargs)
+
+    def _add_chart(self, df, stream=None, **kwargs):
+        """
+        Adds a chart of the DataFrame's data, or of the (csv filename,
+        chunksize) to stream, of which df only has the columns.
+        """
+        chunksize = stream[1] if stream else None
+        lod = kwargs.pop("lod", False)
+        data_format = kwargs.pop("data_format", DEFAULT_CHART_FORMAT)
+        if data_format not in CHART_FORMATS:
+            raise BundleError(
+                "Unsupported chart data format: {}".format(data_format))
+        if chunksize and data_format != "csv":
+            raise BundleError("Only csv chart data can be streamed")
+        if chunksize and lod:
+            raise BundleError(
+                "Build level of detail for streamed charts with build_lod")
+        mimetype, extension = CHART_FORMATS[data_format]
 
         if len(df.columns) < 2:
-            raise BundleError("Not enough columns in csv")
+            raise BundleError("Not enough columns in chart data")
 
         x_column = df.columns[0]
         y_column = df.columns[1]
@@ -331,23 +1946,40 @@ class Bundle(OvalObj):
             x_column = kwargs["x_column"]
         if "y_column" in kwargs:
             y_column = kwargs["y_column"]
-        if "remove_zero" in kwargs and kwargs["remove_zero"]:
-            logger.debug("Removing zero")
-            df = df.query('{} != 0'.format(y_column))
-        x_min = df[x_column].min()
-        if isinstance(x_min, np.int64):
-            x_min = int(x_min)
-        x_max = df[x_column].max()
-        if isinstance(x_max, np.int64):
-            x_max = int(x_max)
-        y_min = df[y_column].min()
-        if isinstance(y_min, np.int64):
-            y_min = int(y_min)
-        y_max = df[y_column].max()
-        if isinstance(y_max, np.int64):
-            y_max = int(y_max)
-        columns = list(df.columns)
-        column_types = dict(zip(columns, [str(t) for t in df.dtypes]))
+        y_series = []
+        for series in kwargs.get("y_columns") or []:
+            if not isinstance(series, dict):
+                series = {"column": series}
+            y_series.append({
+                "stroke": kwargs.get("stroke", "steelblue"),
+                "stroke_width": kwargs.get("stroke_width", 1.5),
+                **series})
+        if y_series:
+            kwargs["y_columns"] = y_series
+            y_column = y_series[0]["column"]
+        y_columns = [series["column"] for series in y_series] or [y_column]
+        remove_zero = "remove_zero" in kwargs and kwargs["remove_zero"]
+
+        files = {}
+        blocks = None
+        if chunksize:
+            column_stats, dtypes, arcname, blocks = self._stream_csv(
+                stream[0], chunksize, y_columns if remove_zero else None,
+                x_column)
+        else:
+            if remove_zero:
+                logger.debug("Removing zero")
+                df = _drop_zero_rows(df, y_columns)
+            with span("statistics", rows=len(df)):
+                column_stats = ColumnStatistics(df).result()
+            dtypes = dict(df.dtypes.items())
+            data = encode_chart_data(df, data_format)
+            arcname, files = self._chart_data_files(data, extension)
+            if data_format == "csv" and x_column in df.columns and \
+               column_stats[x_column]["monotonic"] == "increasing":
+                blocks = csv_block_index(data, df[x_column].to_numpy())
+        columns = list(dtypes.keys())
+        column_types = dict(zip(columns, [str(t) for t in dtypes.values()]))
 
         # valid scale values: linear, time
         x_scale = "linear"
@@ -357,38 +1989,27 @@ class Bundle(OvalObj):
         if "y_scale" in kwargs:
             y_scale = kwargs["y_scale"]
 
-        if pd.isna(x_min):
-            logger.warning("x_min is NaN for column {}".format(x_column))
-        if pd.isna(x_max):
-            logger.warning("x_max is NaN for column {}".format(x_column))
-        if pd.isna(y_min):
-            logger.warning("y_min is NaN for column {}".format(y_column))
-        if pd.isna(y_max):
-            logger.warning("y_max is NaN for column {}".format(y_column))
-
-        arcname = os.path.basename(csv_filename)
-        if "remove_zero" in kwargs and kwargs["remove_zero"]:
-            arcname = "nz_{}".format(arcname)
-
-        default_title = os.path.basename(csv_filename)
+        metadata = self._get_metadata()
+        if "chart_data" not in metadata or \
+           type(metadata["chart_data"]) != list:
+            metadata["chart_data"] = []
+        idx = len(metadata["chart_data"])
+        default_title = "chart {}".format(idx)
         now = datetime.datetime.now()
         chart_metadata = {
-            "chart_type": "line",
+            "chart_type": "multi_line" if y_series else "line",
             "source": "default",
             "create_time": str(now),
             "modify_time": str(now),
             "filename": arcname,
-            "mimetype": "text/csv",
+            "mimetype": mimetype,
             "title": default_title,
             "columns": columns,
             "column_types": column_types,
+            "column_stats": column_stats,
             "x_label": x_column,
-            "x_min": x_min,
-            "x_max": x_max,
             "x_scale": x_scale,
             "y_label": y_column,
-            "y_min": y_min,
-            "y_max": y_max,
             "y_scale": y_scale,
             "x_column": x_column,
             "y_column": y_column,
@@ -396,27 +2017,145 @@ class Bundle(OvalObj):
             "stroke": "steelblue",
             "stroke_width": 1.5}
         chart_metadata.update(kwargs)
-
-        metadata = self._get_metadata()
-        idx = len(metadata["chart_data"])
-        if "chart_data" not in metadata or \
-           type(metadata["chart_data"]) != list:
-            metadata["chart_data"] = []
+        _index_x(chart_metadata, blocks)
+        _autoscale(chart_metadata, "xy")
+        # bounds passed in take precedence
+        chart_metadata.update({
+            key: value for key, value in kwargs.items()
+            if key in ("x_min", "x_max", "y_min", "y_max")})
+        for axis in ("x", "y"):
+            for bound in ("min", "max"):
+                key = "{}_{}".format(axis, bound)
+                if chart_metadata[key] is None:
+                    logger.warning("{} is NaN for column {}".format(
+                        key, chart_metadata["{}_column".format(axis)]))
+
+        if lod:
+            lod_buckets = DEFAULT_LOD_BUCKETS if lod is True else lod
+            chart_metadata["lod"], lod_files = self._lod_levels(
+                df, _axis_columns(chart_metadata, "y"), lod_buckets)
+            files.update(lod_files)
         metadata["chart_data"].append(chart_metadata)
-        self._set_metadata(metadata)
-
-        with edit_archive(self._filename) as arc_dir:
-            df.to_csv(os.path.join(arc_dir, arcname))
+        self._append(files, metadata)
 
         return idx
 
+    def build_lod(self, index, buckets=DEFAULT_LOD_BUCKETS):
+        """
+        Builds the downsampled level of detail series of the chart at the
+        specified index, one per bucket count. Each keeps the min and max
+        of every y column within each bucket of rows, so a renderer can
+        load the level matching its pixel width instead of all the data.
+        """
+        metadata = self._get_metadata()
+        chart = metadata["chart_data"][index]
+        chart["lod"], files = self._lod_levels(
+            self.read_chart_data(index), _axis_columns(chart, "y"),
+            buckets)
+        chart["modify_time"] = str(datetime.datetime.now())
+        self._append(files, metadata)
+
+    def _lod_levels(self, df, y_columns, buckets):
+        """
+        Returns level of detail metadata for chart data and the files to
+        append for it. Levels that wouldn't reduce the data are skipped.
+        """
+        import pandas as pd
+
+        values = pd.DataFrame({
+            column: pd.to_numeric(df[column], errors="coerce")
+            for column in y_columns})
+        levels = []
+        files = {}
+        for num_buckets in sorted(buckets):
+            if 2 * num_buckets * len(y_columns) + 2 >= len(df):
+                continue
+            rows = downsample_indices(values, num_buckets)
+            arcname, level_files = self._chart_data_files(
+                encode_chart_data(df.iloc[rows], "csv"),
+                CHART_FORMATS["csv"][1])
+            files.update(level_files)
+            levels.append({
+                "buckets": num_buckets,
+                "rows": len(rows),
+                "filename": arcname,
+                "mimetype": CHART_FORMATS["csv"][0]})
+        return levels, files
+
+    def _stream_csv(self, csv_filename, chunksize, nonzero_columns=None,
+                    x_column=None):
+        """
+        Copies a csv file into a new chart data entry a chunk at a time,
+        dropping rows that are zero in any of nonzero_columns. The chunks
+        are spooled to a temporary file to find the entry's content
+        addressed name. Returns the column statistics and dtypes
+        accumulated over the chunks, the entry name, and the block index
+        of x_column, see csv_block_index, or None. Inside a transaction the
+        spool is kept until the commit writes it.
+        """
+        import pandas as pd
+
+        stats = ColumnStatistics()
+        dtypes = None
+        digest = hashlib.sha256()
+        blocks = []
+        num_rows = 0
+        spool = tempfile.TemporaryFile()
+        try:
+            with pd.read_csv(csv_filename, chunksize=chunksize) as reader:
+                header = True
+                while True:
+                    with span("csv_parse", filename=csv_filename):
+                        chunk = next(reader, None)
+                    if chunk is None:
+                        break
+                    if nonzero_columns:
+                        chunk = _drop_zero_rows(chunk, nonzero_columns)
+                    with span("statistics", rows=len(chunk)):
+                        stats.update(chunk)
+                    dtypes = _merge_dtypes(dtypes, chunk.dtypes)
+                    with span("csv_write", format="csv") as s:
+                        data = chunk.to_csv(header=header).encode()
+                        s.bytes_written = len(data)
+                    if blocks is not None and x_column in chunk.columns:
+                        chunk_blocks = csv_block_index(
+                            data, chunk[x_column].to_numpy(), num_rows,
+                            spool.tell(), header)
+                        blocks = None if chunk_blocks is None else \
+                            blocks + chunk_blocks
+                    num_rows += len(chunk)
+                    digest.update(data)
+                    spool.write(data)
+                    header = False
+
+            arcname = chart_data_name(digest, CHART_FORMATS["csv"][1])
+            if not self._has_file(arcname):
+                # outside a transaction the entry is unreferenced until the
+                # chart metadata is committed
+                self._append(spools={arcname: spool})
+                if self._transaction is not None:
+                    spool = None
+        finally:
+            if spool is not None:
+                spool.close()
+        column_stats = stats.result()
+        if (column_stats.get(x_column) or {}).get("monotonic") != \
+           "increasing":
+            blocks = None
+        return column_stats, dtypes, arcname, blocks
+
     def edit_chart(self, chart_idx, **new_attributes):
         """
         Update chart with specified attributes.
         """
         metadata = self._get_metadata()
         new_attributes["modify_time"] = str(datetime.datetime.now())
-        metadata["chart_data"][chart_idx].update(new_attributes)
+        chart = metadata["chart_data"][chart_idx]
+        x_column = chart.get("x_column")
+        chart.update(new_attributes)
+        if chart.get("x_column") != x_column:
+            # the block index is of the old x column
+            _index_x(chart)
         self._set_metadata(metadata)
 
     def remove_chart(self, index):
@@ -429,9 +2168,9 @@ class Bundle(OvalObj):
 
     def remove_charts(self, indices):
         """
-        Removes charts at the specified indices all at once.
+        Removes charts at the specified indices all at once. Their data
+        stays in the bundle until compact() finds nothing references it.
         """
-        # TODO: add a flag to remove the file too
         metadata = self._get_metadata()
         metadata["chart_data"] = [
             i for j, i in enumerate(metadata["chart_data"])
@@ -442,14 +2181,13 @@ class Bundle(OvalObj):
         """
         Returns chart at the specified index.
         """
-        metadata = self._get_metadata()
-        return metadata["chart_data"][index]
+        return copy.deepcopy(self._read_metadata()["chart_data"][index])
 
     def list_charts(self):
         """
         Return a list of indexes and chart titles.
         """
-        metadata = self._get_metadata()
+        metadata = self._read_metadata()
         chart_titles = []
         for chart_data in metadata["chart_data"]:
             chart_titles.append(chart_data["title"])
@@ -458,75 +2196,241 @@ class Bundle(OvalObj):
     def copy_chart(self, index, new_filename):
         """
         Copies chart at specified index and adds it to the end,
-        using the title name specified.
+        using the title name specified. The copy shares the chart's
+        stored data.
         """
-        chart = self.get_chart(index)
-        with tempfile.TemporaryDirectory() as copy_dir:
-            with edit_archive(self._filename) as arc_dir:
-                shutil.copy2(
-                    os.path.join(arc_dir, chart["filename"]),
-                    os.path.join(copy_dir, new_filename))
-            return self.add_chart(
-                os.path.join(copy_dir, new_filename))
+        metadata = self._get_metadata()
+        chart = copy.deepcopy(metadata["chart_data"][index])
+        now = str(datetime.datetime.now())
+        chart.update({
+            "title": os.path.basename(new_filename),
+            "create_time": now,
+            "modify_time": now})
+        metadata["chart_data"].append(chart)
+        self._set_metadata(metadata)
+        return len(metadata["chart_data"]) - 1
+
+    def read_chart_data(self, index, columns=None, x_range=None):
+        """
+        Returns the data of the chart at the specified index as a
+        DataFrame, whatever format it is stored in, streaming the one
+        entry from the bundle. Only columns (default all) are parsed. If
+        x_range (min, max) is given only the rows whose x column value is
+        within it are returned; either bound may be None. The x column's
+        stored statistics skip reading when the range is outside the data,
+        and when they show it's increasing reading stops after the range.
+        """
+        chart, x_range, x_sorted = self._chart_x_range(
+            index, columns, x_range)
+        if x_range is False:
+            return _empty_chart_frame(chart, columns)
+        return self._read_chart_entry(chart, columns, x_range, x_sorted)
+
+    def read_chart_arrays(self, index, columns=None, x_range=None,
+                          mmap=True):
+        """
+        Returns the data of the chart at the specified index as a dict of
+        column name to numpy array, reading columns and x_range as
+        read_chart_data does. With mmap, the arrays of npz chart data in a
+        stored entry are memory mapped read only straight from the bundle
+        file, without copying or parsing, so processes reading the same
+        bundle share its pages. Slicing an increasing x range keeps them
+        mapped. Other chart data is read into memory, including npz in
+        deflated entries; a '*.npz=stored' compression rule keeps them
+        stored.
+        """
+        import numpy as np
+
+        chart, x_range, x_sorted = self._chart_x_range(
+            index, columns, x_range)
+        names = list(columns or chart["columns"])
+        if x_range is False:
+            df = _empty_chart_frame(chart, names)
+            return {name: df[name].to_numpy() for name in names}
+
+        arrays = None
+        arcname = chart["filename"]
+        if mmap and chart.get("mimetype") == CHART_FORMATS["npz"][0] and \
+           not self._is_pending(arcname):
+            arrays = _map_npz_arrays(
+                self._filename, self._archive(), arcname,
+                set(names) | ({chart["x_column"]} if x_range else set()))
+        if arrays is None:
+            logger.debug("reading chart data of {} into memory".format(
+                arcname))
+            df = self.read_chart_data(index, columns=names, x_range=x_range)
+            return {name: df[name].to_numpy() for name in names}
+
+        if x_range is not None:
+            x_values = arrays[chart["x_column"]]
+            rows = _x_range_slice(x_values, x_range) if x_sorted \
+                else _x_range_mask(np.asarray(x_values), x_range)
+            arrays = {name: arrays[name][rows] for name in names}
+        return {name: arrays[name] for name in names}
+
+    def _chart_x_range(self, index, columns, x_range):
+        """
+        Returns the chart at the specified index, the x range left to
+        read, None if all rows are in it or False if none are, according
+        to the x column's statistics, and whether the x column is known
+        to be increasing.
+        """
+        chart = self._read_metadata()["chart_data"][index]
+        if columns is not None:
+            unknown = [c for c in columns if c not in chart["columns"]]
+            if unknown:
+                raise BundleError("No such columns: {}".format(
+                    ", ".join(unknown)))
+        if x_range is None:
+            return chart, None, False
+
+        x_stats = (chart.get("column_stats") or {}).get(
+            chart["x_column"]) or {}
+        lo, hi = x_range
+        x_sorted = chart.get(
+            "x_sorted", x_stats.get("monotonic") == "increasing")
+        if x_stats.get("min") is not None:
+            if x_stats.get("count") and not x_stats.get("nan_count") and \
+               (lo is None or lo <= x_stats["min"]) and \
+               (hi is None or hi >= x_stats["max"]):
+                return chart, None, x_sorted
+            if (lo is not None and lo > x_stats["max"]) or \
+               (hi is not None and hi < x_stats["min"]):
+                return chart, False, x_sorted
+        return chart, (lo, hi), x_sorted
+
+    def _read_chart_entry(self, chart, columns, x_range, x_sorted=False):
+        arcname = chart["filename"]
+        fp = self._open_pending(arcname)
+        if fp is None:
+            fp = self._archive().open(arcname)
+        with span("csv_parse", arcname=arcname) as s, fp:
+            df = read_chart_entry(
+                fp, chart.get("mimetype", "text/csv"), columns=columns,
+                x_column=chart["x_column"], x_range=x_range,
+                x_sorted=x_sorted, x_index=chart.get("x_index"))
+            s.bytes_read = fp.tell()
+        return df
 
     def rescale_chart_data(self, index, *columns, **kwargs):
         """
-        Rescales chart data to specified feature_range keyword argument.
-        Default is (0, 1).
-        """
-        feature_range = (0, 1)
-        if "feature_range" in kwargs:
-            feature_range = kwargs["feature_range"]
-
-        with edit_archive(self._filename) as arc_dir:
-            # get bundle metadata
-            with open(os.path.join(
-                    arc_dir, self._metadata_filename), "r") as fp:
-                metadata = json.load(fp)
-            chart_data_filename = metadata["chart_data"][index]["filename"]
-            x_column = metadata["chart_data"][index]["x_column"]
-            x_min = metadata["chart_data"][index]["x_min"]
-            x_max = metadata["chart_data"][index]["x_max"]
-            y_column = metadata["chart_data"][index]["y_column"]
-            y_min = metadata["chart_data"][index]["y_min"]
-            y_max = metadata["chart_data"][index]["y_max"]
-
-            # rescale the data
-            fn = os.path.join(arc_dir, chart_data_filename)
-            df = pd.read_csv(fn)
-            min_max_scaler = MinMaxScaler(feature_range=feature_range)
-            df[[*columns]] = min_max_scaler.fit_transform(df[[*columns]])
-            df.to_csv(fn)
-
-            # update chart metadata for new min/max if data for x or y
-            # columns is altered
-            # TODO: we really need to separate data attributes like column
-            # min/max from chart bounding box
-            if x_column in columns:
-                x_min = df[x_column].min()
-                if isinstance(x_min, np.int64):
-                    x_min = int(x_min)
-                x_max = df[x_column].max()
-                if isinstance(x_max, np.int64):
-                    x_max = int(x_max)
-            if y_column in columns:
-                y_min = df[y_column].min()
-                if isinstance(y_min, np.int64):
-                    y_min = int(y_min)
-                y_max = df[y_column].max()
-                if isinstance(y_max, np.int64):
-                    y_max = int(y_max)
-
-            # update chart metadata
-            metadata["chart_data"][index].update({
-                "modify_time": str(datetime.datetime.now()),
-                "x_min": x_min,
-                "x_max": x_max,
-                "y_min": y_min,
-                "y_max": y_max})
-            with open(os.path.join(
-                    arc_dir, self._metadata_filename), "w") as fp:
-                json.dump(metadata, fp, indent=4, sort_keys=True)
+        Rescales columns of the chart at the specified index to the
+        feature_range keyword argument, default (0, 1). See rescale_charts
+        for the other keyword arguments.
+        """
+        self.rescale_charts({index: columns}, **kwargs)
+
+    def rescale_charts(
+            self, chart_columns, mode="minmax", feature_range=(0, 1),
+            column_ranges=None):
+        """
+        Rescales columns of several charts, given as a dict of chart index
+        to column names, in one commit. The mode is one of RESCALE_MODES,
+        see rescale_transform. column_ranges maps column names to feature
+        ranges that override feature_range. The rescaling uses the column
+        statistics stored with the charts, so each chart's data is only
+        decoded and encoded once.
+        """
+        if mode not in RESCALE_MODES:
+            raise BundleError("Unsupported rescale mode: {}".format(mode))
+        column_ranges = column_ranges or {}
+        with self.transaction():
+            for index, columns in chart_columns.items():
+                self._rescale_chart(
+                    index, columns, mode, feature_range, column_ranges)
+
+    def _rescale_chart(self, index, columns, mode, feature_range,
+                       column_ranges):
+        """
+        Rescales columns of one chart, see rescale_charts.
+        """
+        metadata = self._get_metadata()
+        chart = metadata["chart_data"][index]
+        mimetype = chart.get("mimetype", "text/csv")
+        df = self.read_chart_data(index)
+
+        # charts stored without statistics get them from the data
+        column_stats = chart.get("column_stats") or {}
+        missing = [column for column in columns if column not in column_stats]
+        if missing:
+            with span("statistics", rows=len(df)):
+                column_stats.update(ColumnStatistics(df[missing]).result())
+
+        for column in columns:
+            if df[column].dtype.kind not in "biuf":
+                raise BundleError(
+                    "Can't rescale non-numeric column: {}".format(column))
+            stats = column_stats[column]
+            if stats["min"] is None:
+                logger.warning("nothing to rescale in column {}".format(
+                    column))
+                continue
+            offset, scale, shift = rescale_transform(
+                stats, mode, column_ranges.get(column, feature_range))
+            # integer columns stay integers only when shifted by an integer,
+            # zscore always gives floats
+            integral = mode != "zscore" and scale == 1 and not shift and \
+                float(offset).is_integer()
+            values = df[column].to_numpy(
+                dtype=None if integral else "float64", copy=True)
+            column_stats[column] = _rescaled_stats(
+                stats, values, offset, scale, shift)
+            df[column] = rescale_values(values, offset, scale, shift)
+            chart.setdefault("column_types", {})[column] = str(
+                df[column].dtype)
+
+        # update the chart bounds for the x or y columns if their data was
+        # altered
+        chart["column_stats"] = column_stats
+        _autoscale(chart, [
+            axis for axis in ("x", "y")
+            if set(_axis_columns(chart, axis)) & set(columns)])
+        chart["modify_time"] = str(datetime.datetime.now())
+
+        # the data may be shared, so it's stored under a new name
+        data_format = chart_format(mimetype)
+        data = encode_chart_data(df, data_format)
+        chart["filename"], files = self._chart_data_files(
+            data, CHART_FORMATS[data_format][1])
+        _index_x(chart, csv_block_index(
+            data, df[chart["x_column"]].to_numpy())
+            if data_format == "csv" and chart["x_column"] in df.columns
+            else None)
+        if chart.get("lod"):
+            chart["lod"], lod_files = self._lod_levels(
+                df, _axis_columns(chart, "y"),
+                [level["buckets"] for level in chart["lod"]])
+            files.update(lod_files)
+        self._append(files, metadata)
+
+    def column_statistics(self, index):
+        """
+        Returns the per-column statistics of the chart at the specified
+        index. They are read from the chart metadata, falling back to
+        scanning the chart data for charts stored without them.
+        """
+        chart = self.get_chart(index)
+        column_stats = chart.get("column_stats") or {}
+        if any(column not in column_stats for column in chart["columns"]):
+            logger.debug("computing column statistics for chart {}".format(
+                index))
+            df = self.read_chart_data(index)
+            with span("statistics", rows=len(df)):
+                column_stats = ColumnStatistics(df).result()
+        return column_stats
+
+    def autoscale_chart(self, index, axes="xy"):
+        """
+        Sets the bounds of the chart's axes to the min/max of their
+        columns.
+        """
+        column_stats = self.column_statistics(index)
+        metadata = self._get_metadata()
+        chart = metadata["chart_data"][index]
+        chart["column_stats"] = column_stats
+        _autoscale(chart, axes)
+        chart["modify_time"] = str(datetime.datetime.now())
+        self._set_metadata(metadata)
 
     def chart_data_columns(self, index):
         """
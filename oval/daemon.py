@@ -0,0 +1,363 @@
+"""
+Watch folder ingest daemon, adding CSVs dropped into directories to
+bundles as charts.
+"""
+import asyncio
+import fnmatch
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import time
+
+import oval.core
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DAEMON_CONFIG = {
+    "watch": ["."],
+    "rules": [],
+    "poll_interval": 1.0,
+    "settle_seconds": 1.0,
+    "window": 5.0,
+    "workers": None,
+    "done_dir": None,
+    "compression": None,
+    "stats_file": None,
+    "state_file": ".oval-ingest-state.json"}
+
+
+def load_config(filename):
+    """
+    Loads a daemon config from a JSON file. Relative paths in it are
+    relative to the file's directory.
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    config.setdefault(
+        "base_dir", os.path.dirname(os.path.abspath(filename)))
+    return config
+
+
+def ingest_files(bundle_filename, files, compression=None):
+    """
+    Adds a chart to the bundle for each (csv_filename, chart_kwargs) of
+    files in one commit, creating the bundle if needed. Returns the
+    error message of each file, or None for the ones that were added.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(bundle_filename)),
+                exist_ok=True)
+    errors = []
+    with oval.core.Bundle(bundle_filename, compression=compression) as bundle:
+        if not os.path.exists(bundle_filename):
+            bundle.create()
+        with bundle.transaction():
+            for csv_filename, chart_kwargs in files:
+                try:
+                    bundle.add_chart(csv_filename, **chart_kwargs)
+                    errors.append(None)
+                except Exception as e:
+                    logger.debug("failed to ingest {}".format(
+                        csv_filename), exc_info=True)
+                    errors.append(str(e) or type(e).__name__)
+    return errors
+
+
+class IngestDaemon(oval.core.OvalObj):
+    """
+    Polls the watch directories for new CSV files and maps each to a
+    bundle by the first rule whose glob pattern matches its path relative
+    to the watch directory. A rule is a dict with "pattern", "bundle" and
+    optional "chart" keys. "chart" holds add_chart keyword arguments.
+    "bundle" and string chart arguments are formatted with the file's
+    {name}, {stem}, {dir} (relative to the watch directory) and {parent}
+    (its directory's name). Files are parsed and committed on a pool of
+    worker processes, with the files of a bundle that arrive within the
+    window committed together. Ingested files are moved to the same
+    relative path in done_dir, if set. The daemon's own bundles, state and
+    stats files are never ingested. The files that were committed, or
+    matched no rule, are recorded in state_file by mtime and size so a
+    restarted daemon doesn't ingest them again; set it to None to keep
+    them in memory only.
+    """
+    def __init__(self, config):
+        self.config = dict(DEFAULT_DAEMON_CONFIG, **config)
+        self._base_dir = self.config.get("base_dir") or os.getcwd()
+        self._outputs = self._output_patterns()
+        self._state = self._load_state()
+        self._seen = dict(self._state)
+        self._pending = {}
+        self._locks = {}
+        self._tasks = set()
+        self._stop = None
+        self._executor = None
+        self._start_time = time.monotonic()
+        self.counters = {
+            "files_seen": 0,
+            "files_ingested": 0,
+            "files_failed": 0,
+            "files_unmatched": 0,
+            "commits": 0,
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "latency_total_seconds": 0.0,
+            "latency_max_seconds": 0.0}
+
+    def _path(self, path):
+        return os.path.join(self._base_dir, path)
+
+    def _output_patterns(self):
+        """
+        Returns glob patterns of the absolute paths the daemon writes, so
+        scans skip them: the state and stats files, and the bundles of
+        the rules with their fields as wildcards.
+        """
+        patterns = []
+        for key in ("state_file", "stats_file"):
+            if self.config[key]:
+                filename = os.path.abspath(self._path(self.config[key]))
+                patterns.extend(
+                    (glob.escape(filename), glob.escape(filename) + ".tmp"))
+        for rule in self.config["rules"]:
+            patterns.append(os.path.abspath(self._path(
+                re.sub(r"\{[^}]*\}", "*", glob.escape(rule["bundle"])))))
+        return patterns
+
+    def _load_state(self):
+        """
+        Returns the (mtime_ns, size) of the files handled by earlier runs.
+        """
+        if not self.config["state_file"]:
+            return {}
+        try:
+            with open(self._path(self.config["state_file"])) as f:
+                return {
+                    filename: tuple(key)
+                    for filename, key in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+
+    def _save_state(self):
+        """
+        Writes the handled files that still exist to the state file.
+        """
+        if not self.config["state_file"]:
+            return
+        self._state = {
+            filename: key for filename, key in self._state.items()
+            if os.path.exists(filename)}
+        filename = self._path(self.config["state_file"])
+        with open(filename + ".tmp", "w") as f:
+            json.dump(self._state, f)
+        os.replace(filename + ".tmp", filename)
+
+    def stats(self):
+        """
+        Returns the counters along with the mean commit latency of the
+        files, from being found to being committed, and the throughput.
+        """
+        stats = dict(self.counters)
+        done = stats["files_ingested"] + stats["files_failed"]
+        uptime = time.monotonic() - self._start_time
+        stats["uptime_seconds"] = uptime
+        stats["latency_mean_seconds"] = \
+            stats["latency_total_seconds"] / done if done else None
+        stats["files_per_second"] = stats["files_ingested"] / uptime
+        return stats
+
+    def match(self, watch_dir, filename):
+        """
+        Returns the bundle filename and chart keyword arguments of the
+        first rule matching the file, or None.
+        """
+        relpath = os.path.relpath(filename, watch_dir)
+        for rule in self.config["rules"]:
+            if not fnmatch.fnmatch(relpath, rule["pattern"]):
+                continue
+            name = os.path.basename(filename)
+            fields = {
+                "name": name,
+                "stem": os.path.splitext(name)[0],
+                "dir": os.path.dirname(relpath),
+                "parent": os.path.basename(os.path.dirname(filename))}
+            chart_kwargs = {
+                key: value.format(**fields) if isinstance(value, str)
+                else value
+                for key, value in rule.get("chart", {}).items()}
+            return self._path(rule["bundle"].format(**fields)), chart_kwargs
+        return None
+
+    def _scan_files(self):
+        """
+        Returns the new files in the watch directories that haven't been
+        modified for settle_seconds, as (path, watch_dir, stat key).
+        """
+        settled = time.time() - self.config["settle_seconds"]
+        done_dir = self.config["done_dir"]
+        done_dir = os.path.abspath(self._path(done_dir)) if done_dir else None
+        found = []
+        for watch_dir in self.config["watch"]:
+            watch_dir = self._path(watch_dir)
+            for root, dirs, files in os.walk(watch_dir):
+                if done_dir is not None:
+                    dirs[:] = [
+                        d for d in dirs
+                        if os.path.abspath(os.path.join(root, d)) != done_dir]
+                for name in files:
+                    filename = os.path.join(root, name)
+                    if any(fnmatch.fnmatchcase(os.path.abspath(filename), p)
+                           for p in self._outputs):
+                        continue
+                    try:
+                        st = os.stat(filename)
+                    except FileNotFoundError:
+                        continue
+                    key = (st.st_mtime_ns, st.st_size)
+                    if self._seen.get(filename) == key or \
+                       st.st_mtime > settled:
+                        continue
+                    found.append((filename, watch_dir, key))
+        return found
+
+    async def scan(self):
+        """
+        Queues new files for ingest, scheduling a commit of their bundle
+        after the window.
+        """
+        loop = asyncio.get_running_loop()
+        unmatched = False
+        for filename, watch_dir, key in await loop.run_in_executor(
+                None, self._scan_files):
+            self._seen[filename] = key
+            matched = self.match(watch_dir, filename)
+            if matched is None:
+                self.counters["files_unmatched"] += 1
+                self._state[filename] = key
+                unmatched = True
+                continue
+            bundle_filename, chart_kwargs = matched
+            relpath = os.path.relpath(filename, watch_dir)
+            logger.debug("queued {} for {}".format(filename, bundle_filename))
+            self.counters["files_seen"] += 1
+            self.counters["queue_depth"] += 1
+            self.counters["max_queue_depth"] = max(
+                self.counters["max_queue_depth"],
+                self.counters["queue_depth"])
+            if bundle_filename not in self._pending:
+                self._pending[bundle_filename] = []
+                task = asyncio.ensure_future(self._commit(bundle_filename))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            self._pending[bundle_filename].append(
+                (filename, relpath, chart_kwargs, key, time.monotonic()))
+        if unmatched:
+            self._save_state()
+
+    async def _commit(self, bundle_filename):
+        """
+        Waits for the window, or until the daemon stops, then commits the
+        files queued for the bundle after any earlier commit of it.
+        """
+        try:
+            await asyncio.wait_for(
+                self._stop.wait(), self.config["window"])
+        except asyncio.TimeoutError:
+            pass
+        lock = self._locks.setdefault(bundle_filename, asyncio.Lock())
+        async with lock:
+            pending = self._pending.pop(bundle_filename)
+            files = [
+                (filename, kwargs) for filename, _, kwargs, _, _ in pending]
+            loop = asyncio.get_running_loop()
+            try:
+                errors = await loop.run_in_executor(
+                    self._executor, ingest_files, bundle_filename, files,
+                    self.config["compression"])
+            except Exception as e:
+                logger.exception("failed to commit {}".format(
+                    bundle_filename))
+                errors = [str(e) or type(e).__name__] * len(files)
+            self.counters["commits"] += 1
+
+        now = time.monotonic()
+        for (filename, relpath, _, key, queued), error in zip(
+                pending, errors):
+            self._state[filename] = key
+            latency = now - queued
+            self.counters["queue_depth"] -= 1
+            self.counters["latency_total_seconds"] += latency
+            self.counters["latency_max_seconds"] = max(
+                self.counters["latency_max_seconds"], latency)
+            if error is not None:
+                logger.error("failed to ingest {}: {}".format(
+                    filename, error))
+                self.counters["files_failed"] += 1
+                continue
+            self.counters["files_ingested"] += 1
+            logger.info("ingested {} into {} in {:.3f}s".format(
+                filename, bundle_filename, latency))
+            self._done(filename, relpath)
+        self._save_state()
+
+    def _done(self, filename, relpath):
+        """
+        Moves an ingested file to its relative path in the done directory,
+        if there is one.
+        """
+        if not self.config["done_dir"]:
+            return
+        target = os.path.join(self._path(self.config["done_dir"]), relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(filename, target)
+        self._seen.pop(filename, None)
+        self._state.pop(filename, None)
+
+    def _write_stats(self):
+        if self.config["stats_file"]:
+            with open(self._path(self.config["stats_file"]), "w") as f:
+                json.dump(self.stats(), f, indent=2)
+
+    def stop(self):
+        """
+        Stops the daemon after committing the files it has queued.
+        """
+        self._stop.set()
+
+    async def run(self, once=False):
+        """
+        Runs until stopped or interrupted, or for a single scan if once is
+        set.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        if once:
+            self._stop.set()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        with ProcessPoolExecutor(
+                max_workers=self.config["workers"]) as executor:
+            self._executor = executor
+            while True:
+                await self.scan()
+                self._write_stats()
+                if self._stop.is_set():
+                    break
+                try:
+                    await asyncio.wait_for(
+                        self._stop.wait(), self.config["poll_interval"])
+                except asyncio.TimeoutError:
+                    pass
+            while self._tasks:
+                await asyncio.gather(*self._tasks)
+        self._write_stats()
+        return self.stats()
@@ -0,0 +1,324 @@
+"""
+Persistent outbox of bundles to publish by email, drained by a pool of
+workers that retry failed sends.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import oval.core
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTBOX = os.environ.get("OVAL_OUTBOX", "outbox.sqlite")
+
+# seconds before the first retry of a failed send, doubling for each
+# later retry up to the max
+DEFAULT_RETRY_DELAY = 30.0
+DEFAULT_MAX_RETRY_DELAY = 3600.0
+DEFAULT_MAX_ATTEMPTS = 8
+
+# sends claimed longer ago than this are assumed to belong to a worker
+# that died, and are queued again
+STALE_CLAIM_SECONDS = 3600.0
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    bundle TEXT NOT NULL,
+    from_addr TEXT NOT NULL,
+    to_addrs TEXT NOT NULL,
+    title TEXT,
+    smtp_host TEXT NOT NULL,
+    smtp_port INTEGER NOT NULL,
+    smtp_user TEXT,
+    smtp_starttls INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueue_time REAL NOT NULL,
+    next_attempt_time REAL NOT NULL,
+    claim_time REAL,
+    sent_time REAL,
+    errors TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_queued
+    ON messages (status, next_attempt_time);
+"""
+
+
+class Outbox(oval.core.OvalObj):
+    """
+    SQLite table of bundles to publish. Messages are queued, claimed by
+    a worker while sending, then sent or failed, or queued again for a
+    retry. SMTP passwords aren't stored.
+    """
+    def __init__(self, filename=DEFAULT_OUTBOX):
+        self.filename = filename
+        self._db = sqlite3.connect(filename, timeout=30, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(OUTBOX_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def enqueue(
+            self, bundle_filename, from_addr, to_addrs, title=None,
+            smtp_host="localhost", smtp_port=587, smtp_user=None,
+            smtp_starttls=True):
+        """
+        Queues a bundle to be published, returning the message id.
+        """
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO messages (bundle, from_addr, to_addrs, title, "
+            "smtp_host, smtp_port, smtp_user, smtp_starttls, enqueue_time, "
+            "next_attempt_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (os.path.abspath(bundle_filename), from_addr,
+             json.dumps(list(to_addrs)), title, smtp_host, smtp_port,
+             smtp_user, int(smtp_starttls), now, now))
+        return cursor.lastrowid
+
+    def claim(self):
+        """
+        Marks the queued message that is due first as being sent and
+        returns it as a dict, with attempts counting this one, or None if
+        no message is due.
+        """
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute(
+                "SELECT * FROM messages WHERE status = 'queued' AND "
+                "next_attempt_time <= ? ORDER BY next_attempt_time, id "
+                "LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                row = dict(
+                    row, status="sending", claim_time=now,
+                    attempts=row["attempts"] + 1)
+                self._db.execute(
+                    "UPDATE messages SET status = ?, claim_time = ?, "
+                    "attempts = ? WHERE id = ?",
+                    (row["status"], now, row["attempts"], row["id"]))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return row
+
+    def next_due(self):
+        """
+        Returns the time the next queued message is due, or None if no
+        messages are queued or being sent.
+        """
+        row = self._db.execute(
+            "SELECT MIN(next_attempt_time), "
+            "SUM(status = 'sending') FROM messages "
+            "WHERE status IN ('queued', 'sending')").fetchone()
+        if row[0] is None and not row[1]:
+            return None
+        return row[0] if row[0] is not None else time.time()
+
+    def requeue_stale(self, max_age=STALE_CLAIM_SECONDS):
+        """
+        Queues again messages claimed more than max_age seconds ago.
+        """
+        self._db.execute(
+            "UPDATE messages SET status = 'queued' WHERE status = 'sending' "
+            "AND claim_time < ?", (time.time() - max_age,))
+
+    def finish(self, message_id, status, errors, to_addrs=None,
+               retry_time=None):
+        """
+        Records the outcome of a send. A message queued for a retry is
+        only sent again to the recipients in to_addrs.
+        """
+        now = time.time()
+        self._db.execute(
+            "UPDATE messages SET status = ?, errors = ?, "
+            "sent_time = CASE WHEN ? = 'sent' THEN ? ELSE sent_time END, "
+            "next_attempt_time = COALESCE(?, next_attempt_time), "
+            "to_addrs = COALESCE(?, to_addrs) WHERE id = ?",
+            (status, json.dumps(errors), status, now, retry_time,
+             None if to_addrs is None else json.dumps(to_addrs),
+             message_id))
+
+    def messages(self, status=None):
+        """
+        Returns the messages, optionally only those with a status.
+        """
+        if status is None:
+            return self._db.execute(
+                "SELECT * FROM messages ORDER BY id").fetchall()
+        return self._db.execute(
+            "SELECT * FROM messages WHERE status = ? ORDER BY id",
+            (status,)).fetchall()
+
+    def stats(self):
+        """
+        Returns message counts by status, the queue depth, the age of the
+        oldest queued message, and the mean and max latency from enqueue
+        to sent.
+        """
+        stats = {status: 0 for status in ("queued", "sending", "sent",
+                                          "failed")}
+        for status, count in self._db.execute(
+                "SELECT status, COUNT(*) FROM messages GROUP BY status"):
+            stats[status] = count
+        stats["queue_depth"] = stats["queued"] + stats["sending"]
+        oldest, retries = self._db.execute(
+            "SELECT MIN(CASE WHEN status = 'queued' THEN enqueue_time END), "
+            "SUM(MAX(attempts - 1, 0)) FROM messages").fetchone()
+        stats["oldest_queued_seconds"] = \
+            None if oldest is None else time.time() - oldest
+        stats["retries"] = retries or 0
+        mean, longest = self._db.execute(
+            "SELECT AVG(sent_time - enqueue_time), "
+            "MAX(sent_time - enqueue_time) FROM messages "
+            "WHERE status = 'sent'").fetchone()
+        stats["latency_mean_seconds"] = mean
+        stats["latency_max_seconds"] = longest
+        return stats
+
+
+class HostRateLimiter(oval.core.OvalObj):
+    """
+    Spaces out sends to each SMTP host to at most rate per second, across
+    threads. A rate of None doesn't limit sends.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(host, now))
+            self._next[host] = slot + 1.0 / self.rate
+        time.sleep(slot - now)
+
+
+def _is_permanent(error):
+    """
+    Returns whether a recipient error is a permanent SMTP rejection
+    (a 5xx reply) that retrying won't fix.
+    """
+    return error[:1] == "5" and error[1:3].isdigit()
+
+
+class OutboxRunner(oval.core.OvalObj):
+    """
+    Drains an outbox with a pool of worker threads, each keeping its own
+    SMTP sessions open across messages. Sends that fail for some
+    recipients with transient errors are retried for those recipients
+    with exponential backoff, up to max_attempts.
+    """
+    def __init__(
+            self, filename=DEFAULT_OUTBOX, workers=4, rate=None,
+            smtp_password=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+            retry_delay=DEFAULT_RETRY_DELAY,
+            max_retry_delay=DEFAULT_MAX_RETRY_DELAY, poll_interval=1.0):
+        self.filename = filename
+        self.workers = workers
+        self.smtp_password = smtp_password
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self._limiter = HostRateLimiter(rate)
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, wait=True):
+        """
+        Sends queued messages until none are left, waiting for scheduled
+        retries if wait is set, otherwise only sending the messages that
+        are already due.
+        """
+        with Outbox(self.filename) as outbox:
+            outbox.requeue_stale()
+        threads = [
+            threading.Thread(target=self._work, args=(wait,), daemon=True)
+            for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _work(self, wait):
+        sessions = {}
+        try:
+            with Outbox(self.filename) as outbox:
+                while not self._stop.is_set():
+                    message = outbox.claim()
+                    if message is not None:
+                        self._send(outbox, message, sessions)
+                        continue
+                    due = outbox.next_due() if wait else None
+                    if due is None:
+                        return
+                    self._stop.wait(min(
+                        max(due - time.time(), 0.01), self.poll_interval))
+        finally:
+            for session in sessions.values():
+                session.close()
+
+    def _send(self, outbox, message, sessions):
+        key = (message["smtp_host"], message["smtp_port"],
+               message["smtp_user"], message["smtp_starttls"])
+        if key not in sessions:
+            sessions[key] = oval.core.SMTPSession(
+                message["smtp_host"], message["smtp_port"],
+                smtp_user=message["smtp_user"],
+                smtp_password=self.smtp_password,
+                smtp_starttls=bool(message["smtp_starttls"]))
+        to_addrs = json.loads(message["to_addrs"])
+
+        self._limiter.wait(message["smtp_host"])
+        try:
+            errors = oval.core.publish_bundle(
+                message["bundle"], message["from_addr"], to_addrs,
+                title=message["title"], session=sessions[key])
+        except Exception as e:
+            # the bundle can't be read, which retrying won't fix
+            logger.exception("can't publish {}".format(message["bundle"]))
+            outbox.finish(
+                message["id"], "failed",
+                dict.fromkeys(to_addrs, "bundle: {}".format(e)))
+            return
+
+        failed = {addr: error for addr, error in errors.items() if error}
+        transient = [
+            addr for addr, error in failed.items()
+            if not _is_permanent(error)]
+        if transient and message["attempts"] < self.max_attempts:
+            delay = min(
+                self.retry_delay * 2 ** (message["attempts"] - 1),
+                self.max_retry_delay)
+            logger.warning("retrying {} to {} in {:.0f}s".format(
+                message["bundle"], transient, delay))
+            outbox.finish(
+                message["id"], "queued", failed, to_addrs=transient,
+                retry_time=time.time() + delay)
+        elif failed:
+            logger.error("failed to publish {}: {}".format(
+                message["bundle"], failed))
+            outbox.finish(message["id"], "failed", failed)
+        else:
+            logger.info("published {} to {}".format(
+                message["bundle"], to_addrs))
+            outbox.finish(message["id"], "sent", {})
@@ -0,0 +1,123 @@
+"""
+Minimal local SMTP server for benchmarks and tests.
+"""
+import logging
+import socketserver
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib to deliver messages.
+    """
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server.stub
+        server.connections += 1
+        mail_from = None
+        rcpt_tos = []
+        self.reply("220 localhost oval SMTP stub")
+        for raw_line in self.rfile:
+            line = raw_line.decode("utf-8", "replace").rstrip("\r\n")
+            command = line.split(" ", 1)[0].upper()
+            arg = line[len(command):].strip()
+            if command == "EHLO":
+                self.reply("250-localhost")
+                self.reply("250-8BITMIME")
+                self.reply("250 AUTH PLAIN")
+            elif command == "HELO":
+                self.reply("250 localhost")
+            elif command == "AUTH":
+                self.reply("235 Authentication successful")
+            elif command == "MAIL":
+                mail_from = arg.split(":", 1)[-1].strip().strip("<>")
+                rcpt_tos = []
+                if mail_from in server.reject:
+                    self.reply("550 Sender rejected")
+                else:
+                    self.reply("250 OK")
+            elif command == "RCPT":
+                rcpt_to = arg.split(":", 1)[-1].strip().strip("<>")
+                if rcpt_to in server.reject:
+                    self.reply("550 No such user")
+                else:
+                    rcpt_tos.append(rcpt_to)
+                    self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                size = 0
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    if data_line.startswith(b".."):
+                        data_line = data_line[1:]
+                    size += len(data_line)
+                    if server.keep_data:
+                        data.append(data_line)
+                server.messages.append((mail_from, rcpt_tos, b"".join(data)))
+                server.message_sizes.append(size)
+                self.reply("250 OK")
+            elif command in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class _ThreadingSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPStub(object):
+    """
+    Local SMTP server that accepts messages without TLS and records them in
+    messages as (from, recipients, data) tuples, and counts connections.
+    Senders and recipients in reject are refused. Message data is only kept if
+    keep_data is set, otherwise just its size is recorded in
+    message_sizes. Use as a context manager or with start() and stop().
+    """
+    def __init__(self, host="127.0.0.1", port=0, reject=(), keep_data=True):
+        self.reject = set(reject)
+        self.keep_data = keep_data
+        self.messages = []
+        self.message_sizes = []
+        self.connections = 0
+        self._server = _ThreadingSMTPServer((host, port), _SMTPHandler)
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.debug("SMTP stub listening on {}:{}".format(
+            self.host, self.port))
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,114 @@
+"""
+Synthetic chart data and bundle generation for tests and load testing.
+"""
+import logging
+import os
+
+import oval.core
+
+
+logger = logging.getLogger(__name__)
+
+WAVEFORMS = ("sine", "square", "sawtooth", "triangle")
+
+
+def generate_signal(
+        num_samples=1000, start_time=1.0, end_time=11.0, waveform="sine",
+        amplitude=0.5, frequency=4, phase=0.0, y_offset=0.0, noise=0.0,
+        seed=None, start_datetime=None, x_column="time",
+        y_column="sample"):
+    """
+    Returns a DataFrame of num_samples evenly spaced samples of a waveform
+    between start_time and end_time seconds, with gaussian noise of the
+    specified standard deviation added. If start_datetime is specified,
+    the x column holds ISO 8601 timestamps counting from it instead of
+    seconds.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if waveform not in WAVEFORMS:
+        raise ValueError("Unknown waveform: {}".format(waveform))
+
+    inc = (end_time - start_time) / num_samples
+    sample_time = start_time + inc * np.arange(num_samples)
+    cycles = frequency * sample_time + phase / (2 * np.pi)
+    if waveform == "sine":
+        wave = np.sin(2 * np.pi * cycles)
+    elif waveform == "square":
+        wave = np.where(np.sin(2 * np.pi * cycles) >= 0, 1.0, -1.0)
+    else:
+        wave = 2 * (cycles - np.floor(cycles + 0.5))
+        if waveform == "triangle":
+            wave = 2 * np.abs(wave) - 1
+    yt = amplitude * wave + y_offset
+    if noise:
+        yt += noise * np.random.default_rng(seed).standard_normal(num_samples)
+
+    if start_datetime is None:
+        x = sample_time
+    else:
+        offsets = ((sample_time - start_time) * 1000).astype("timedelta64[ms]")
+        x = np.datetime_as_string(
+            np.datetime64(pd.Timestamp(start_datetime), "ms") + offsets)
+    return pd.DataFrame({x_column: x, y_column: yt})
+
+
+def gen_bundle(
+        filename, num_charts=1, data_format=oval.core.DEFAULT_CHART_FORMAT,
+        seed=None, compression=None, **signal_kwargs):
+    """
+    Creates a bundle of num_charts synthetic charts with increasing
+    frequencies, compressed according to the compression policy. Keyword
+    args are passed on to generate_signal.
+    """
+    frequency = signal_kwargs.pop("frequency", 4)
+    x_scale = "linear"
+    if signal_kwargs.get("start_datetime") is not None:
+        x_scale = "time"
+
+    with oval.core.Bundle(filename, compression=compression) as bundle:
+        bundle.create(title=os.path.basename(filename), synthetic=True)
+        for i in range(num_charts):
+            df = generate_signal(
+                frequency=frequency * (i + 1),
+                seed=None if seed is None else seed + i,
+                **signal_kwargs)
+            bundle.add_chart_frame(
+                df, title="Synthetic {}".format(i), x_scale=x_scale,
+                data_format=data_format)
+    return filename
+
+
+def _gen_bundle(args):
+    """
+    Process pool entry point for gen_bundle.
+    """
+    filename, kwargs = args
+    return gen_bundle(filename, **kwargs)
+
+
+def gen_bundles(directory, count, jobs=None, seed=None, **bundle_kwargs):
+    """
+    Writes count synthetic bundles into directory using a pool of jobs
+    processes, defaulting to one per cpu. Keyword args are passed on to
+    gen_bundle. Returns the bundle filenames.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    os.makedirs(directory, exist_ok=True)
+    tasks = []
+    for i in range(count):
+        kwargs = dict(bundle_kwargs)
+        if seed is not None:
+            kwargs["seed"] = seed + i * bundle_kwargs.get("num_charts", 1)
+        tasks.append((
+            os.path.join(directory, "synthetic_{:05d}.zip".format(i)),
+            kwargs))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        filenames = []
+        for filename in executor.map(_gen_bundle, tasks):
+            logger.debug("generated bundle: {}".format(filename))
+            filenames.append(filename)
+    return filenames
@@ -0,0 +1,44 @@
+import copy
+import unittest
+
+import oval.bench
+
+
+class TestBench(unittest.TestCase):
+    def test_run_benchmarks(self):
+        # when
+        results = oval.bench.run_benchmarks(
+            charts=[2], rows=[50], repeat=1, compressions=["deflate"])
+
+        # then
+        self.assertEqual(len(results["cases"]), 1)
+        case = results["cases"][0]
+        self.assertEqual(case["num_charts"], 2)
+        self.assertEqual(case["num_rows"], 50)
+        self.assertEqual(case["compression"], "deflate")
+        self.assertEqual(
+            sorted(case["operations"]), sorted(oval.bench.BENCH_OPERATIONS))
+        for measured in case["operations"].values():
+            self.assertGreater(measured["median_seconds"], 0)
+            self.assertGreater(measured["peak_memory_bytes"], 0)
+
+    def test_compare_results(self):
+        # with
+        baseline = {"cases": [{
+            "num_charts": 1, "num_rows": 10, "operations": {
+                "create": {"median_seconds": 1.0, "peak_memory_bytes": 100},
+                "list_charts": {
+                    "median_seconds": 1.0, "peak_memory_bytes": 100}}}]}
+        results = copy.deepcopy(baseline)
+        results["cases"][0]["operations"]["create"]["median_seconds"] = 1.1
+        results["cases"][0]["operations"]["list_charts"][
+            "peak_memory_bytes"] = 200
+
+        # when
+        regressions = oval.bench.compare_results(
+            results, baseline, threshold=0.25)
+
+        # then
+        self.assertEqual(len(regressions), 1)
+        self.assertEqual(regressions[0]["operation"], "list_charts")
+        self.assertEqual(regressions[0]["metric"], "peak_memory_bytes")
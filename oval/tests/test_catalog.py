@@ -0,0 +1,114 @@
+import os
+import tempfile
+import time
+import unittest
+
+import oval.catalog
+import oval.core
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._bundles = os.path.join(self._tmpdir.name, "bundles")
+        self._catalog = os.path.join(self._tmpdir.name, "catalog.sqlite")
+        os.makedirs(os.path.join(self._bundles, "acme"))
+        self._csv_filename = os.path.join(self._tmpdir.name, "data.csv")
+        with open(self._csv_filename, "w") as f:
+            f.write("time,temperature\n")
+            for i in range(20):
+                f.write("{},{}\n".format(i, 20 + i))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _bundle(self, relpath, charts=(), **kwargs):
+        filename = os.path.join(self._bundles, relpath)
+        with oval.core.Bundle(filename) as bundle:
+            bundle.create(**kwargs)
+            for title in charts:
+                bundle.add_chart(self._csv_filename, title=title)
+        return filename
+
+    def test_catalog_find(self):
+        # with
+        acme = self._bundle(
+            "acme/a.zip", charts=["Temperature"], client="acme",
+            create_time="2026-01-02 10:00:00")
+        self._bundle(
+            "b.zip", client="other", create_time="2026-03-01 10:00:00")
+
+        # when
+        with oval.catalog.Catalog(self._catalog) as catalog:
+            counts = catalog.index(self._bundles)
+            by_client = catalog.find(attributes=[("client", "ac*")])
+            by_column = catalog.find(column="temperature", min_rows=20)
+            by_date = catalog.find(created_after="2026-02")
+            by_time = catalog.find(
+                created_after="2026-01-02T09:00",
+                created_before="2026-01-02T10:00:01")
+            none = catalog.find(column="temperature", min_rows=21)
+
+        # then
+        self.assertEqual(counts["added"], 2)
+        self.assertEqual([b["path"] for b in by_client], [acme])
+        self.assertEqual([b["path"] for b in by_column], [acme])
+        chart = by_column[0]["charts"][0]
+        self.assertEqual(chart["title"], "Temperature")
+        self.assertEqual(chart["columns"], ["time", "temperature"])
+        self.assertEqual(chart["num_rows"], 20)
+        self.assertEqual(chart["y_max"], 39)
+        self.assertEqual([b["title"] for b in by_date], ["b.zip"])
+        self.assertEqual([b["path"] for b in by_time], [acme])
+        self.assertEqual(none, [])
+
+    def test_catalog_refresh(self):
+        """
+        Test indexing again only re-reads changed bundles and drops
+        removed ones.
+        """
+        # with
+        changed = self._bundle("a.zip", client="acme")
+        removed = self._bundle("b.zip")
+        self._bundle("c.zip")
+        with oval.catalog.Catalog(self._catalog) as catalog:
+            catalog.index(self._bundles)
+        time.sleep(0.01)
+        with oval.core.Bundle(changed) as bundle:
+            bundle.update_metadata({"client": "initech"})
+        os.remove(removed)
+
+        # when
+        with oval.catalog.Catalog(self._catalog) as catalog:
+            counts = catalog.index(self._bundles)
+            found = catalog.find(attributes=[("client", "initech")])
+            stats = catalog.stats()
+
+        # then
+        self.assertEqual(counts["updated"], 1)
+        self.assertEqual(counts["unchanged"], 1)
+        self.assertEqual(counts["removed"], 1)
+        self.assertEqual([b["path"] for b in found], [changed])
+        self.assertEqual(stats["bundles"], 2)
+
+    def test_catalog_index_case(self):
+        """
+        Test indexing a directory leaves bundles of directories whose
+        names only differ in case.
+        """
+        # with
+        os.makedirs(os.path.join(self._bundles, "Sess"))
+        self._bundle("Sess/a.zip")
+        os.makedirs(os.path.join(self._bundles, "sess"))
+        self._bundle("sess/b.zip")
+        with oval.catalog.Catalog(self._catalog) as catalog:
+            catalog.index(os.path.join(self._bundles, "Sess"))
+
+            # when
+            counts = catalog.index(os.path.join(self._bundles, "sess"))
+            stats = catalog.stats()
+
+        # then
+        self.assertEqual(counts["added"], 1)
+        self.assertEqual(counts["removed"], 0)
+        self.assertEqual(stats["bundles"], 2)
@@ -0,0 +1,205 @@
+"""
+Tests for the oval command line interface.
+"""
+import json
+import os
+import tempfile
+import unittest
+import zipfile
+
+from click.testing import CliRunner
+
+import oval.core
+import oval.smtpstub
+from oval.__main__ import root
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._bundle_filename = os.path.join(self._tmpdir.name, "session.zip")
+        self._csv_filename = os.path.join(self._tmpdir.name, "data.csv")
+        with open(self._csv_filename, "w") as f:
+            f.write("time,y1,y2\n")
+            for i in range(10):
+                f.write("{},{},{}\n".format(i, i * i, -i))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _invoke(self, *args, **kwargs):
+        runner = CliRunner()
+        result = runner.invoke(
+            root, ["--bundle", self._bundle_filename, *args], **kwargs)
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result
+
+    def test_cli_batch(self):
+        """
+        Test running several commands as one batch commit.
+        """
+        # with
+        self._invoke("create")
+        commands = "\n".join([
+            "# ingest",
+            "set -k client -v Smith",
+            "add-chart -f {} time y1 y2".format(self._csv_filename),
+            "edit-chart 1 title second",
+            ""])
+
+        # when
+        self._invoke("batch", input=commands)
+
+        # then
+        bundle = oval.core.Bundle(self._bundle_filename)
+        self.assertEqual(bundle.read_attribute("client"), "Smith")
+        self.assertEqual(bundle.list_charts(), ["data.csv", "second"])
+        with zipfile.ZipFile(self._bundle_filename, mode="r") as archive:
+            names = archive.namelist()
+        self.assertEqual(names.count("metadata.json"), 2)
+        self.assertEqual(
+            len([name for name in names if name.startswith("data/")]), 1)
+
+    def test_cli_batch_excluded_command(self):
+        """
+        Test that a batch refuses commands it can't run.
+        """
+        # with
+        self._invoke("create")
+
+        # when
+        result = CliRunner().invoke(
+            root, ["--bundle", self._bundle_filename, "batch"],
+            input="set -k a -v b\npublish\n")
+        compact = CliRunner().invoke(
+            root, ["--bundle", self._bundle_filename, "batch"],
+            input="set -k a -v b\ncompact\n")
+
+        # then
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertNotEqual(compact.exit_code, 0)
+        bundle = oval.core.Bundle(self._bundle_filename)
+        self.assertFalse(bundle.has_attribute("a"))
+
+    def test_cli_add_chart_multi(self):
+        """
+        Test adding several y columns as one overlay chart.
+        """
+        # with
+        self._invoke("create")
+
+        # when
+        self._invoke(
+            "add-chart", "-f", self._csv_filename, "--multi",
+            "-s", "red", "-s", "blue", "time", "y1", "y2")
+
+        # then
+        bundle = oval.core.Bundle(self._bundle_filename)
+        self.assertEqual(bundle.num_charts(), 1)
+        chart = bundle.get_chart(0)
+        self.assertEqual(
+            [s["stroke"] for s in chart["y_columns"]], ["red", "blue"])
+        self.assertEqual((chart["y_min"], chart["y_max"]), (-9, 81))
+
+    def test_cli_metrics_json(self):
+        """
+        Test writing the timing spans of a command to a file.
+        """
+        # with
+        self._invoke("create")
+        metrics_filename = os.path.join(self._tmpdir.name, "metrics.json")
+
+        # when
+        self._invoke(
+            "--metrics-json", metrics_filename,
+            "add-chart", "-f", self._csv_filename, "time", "y1")
+
+        # then
+        with open(metrics_filename) as f:
+            metrics = json.load(f)
+        self.assertEqual(metrics["summary"]["command"]["count"], 1)
+        self.assertIn("csv_parse", metrics["summary"])
+        self.assertEqual(
+            [span["fields"]["command"] for span in metrics["spans"]
+             if span["name"] == "command"], ["add-chart"])
+        self.assertFalse(oval.core._span_collectors)
+
+    def test_cli_map(self):
+        """
+        Test running a command over many bundles, continuing past one
+        that fails.
+        """
+        # with
+        bundle_filenames = [
+            os.path.join(self._tmpdir.name, "map_{}.zip".format(i))
+            for i in range(3)]
+        for filename in bundle_filenames:
+            oval.core.Bundle(filename).create()
+        with open(os.path.join(self._tmpdir.name, "map_bad.zip"), "w") as f:
+            f.write("not a zip")
+
+        # when
+        result = CliRunner().invoke(root, [
+            "map", "-j", "2", os.path.join(self._tmpdir.name, "map_*.zip"),
+            "--", "set", "-k", "site", "-v", "lab2"])
+
+        # then
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn("4 bundles, 1 failed", result.output)
+        self.assertIn("error", result.output)
+        for filename in bundle_filenames:
+            self.assertEqual(
+                oval.core.Bundle(filename).read_attribute("site"), "lab2")
+
+    def test_cli_publish(self):
+        """
+        Test publishing several bundles over one SMTP connection, with one
+        transaction per bundle for all recipients.
+        """
+        # with
+        bundle_filenames = [
+            os.path.join(self._tmpdir.name, "publish_{}.zip".format(i))
+            for i in range(2)]
+        for filename in bundle_filenames:
+            oval.core.Bundle(filename).create()
+
+        # when
+        with oval.smtpstub.SMTPStub(reject=["nobody@localhost"]) as smtp:
+            result = CliRunner().invoke(root, [
+                "publish", "-f", "from@localhost", "-t", "a@localhost",
+                "-t", "nobody@localhost", "-t", "b@localhost",
+                "-s", smtp.host, "-p", str(smtp.port), "--no-starttls",
+                *bundle_filenames])
+
+        # then
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn("failed {} to nobody@localhost: 550".format(
+            bundle_filenames[0]), result.output)
+        self.assertEqual(smtp.connections, 1)
+        self.assertEqual(len(smtp.messages), 2)
+        for from_addr, to_addrs, data in smtp.messages:
+            self.assertEqual(to_addrs, ["a@localhost", "b@localhost"])
+
+    def test_cli_publish_queue(self):
+        """
+        Test queueing bundles to publish and sending them from the outbox.
+        """
+        # with
+        outbox = os.path.join(self._tmpdir.name, "outbox.sqlite")
+        oval.core.Bundle(self._bundle_filename).create()
+
+        # when
+        with oval.smtpstub.SMTPStub() as smtp:
+            self._invoke(
+                "publish", "--queue", "--outbox", outbox,
+                "-f", "from@localhost", "-t", "a@localhost",
+                "-s", smtp.host, "-p", str(smtp.port), "--no-starttls")
+            queued = len(smtp.messages)
+            result = self._invoke(
+                "outbox", "--outbox", outbox, "run", "-j", "2")
+
+        # then
+        self.assertEqual(queued, 0)
+        self.assertEqual(len(smtp.messages), 1)
+        self.assertRegex(result.output, r"sent\s+1")
+        self.assertRegex(result.output, r"queue_depth\s+0")
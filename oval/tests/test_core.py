@@ -1,12 +1,16 @@
 """
 Tests for the atxcf.core module.
 """
+import importlib.util
+import json
 import os
 import tempfile
 import unittest
 import zipfile
+from unittest import mock
 
 import oval.core
+import oval.smtpstub
 
 
 class TestCore(unittest.TestCase):
@@ -17,6 +21,17 @@ class TestCore(unittest.TestCase):
     def tearDown(self):
         os.remove(self._tmpfile)
 
+    def _write_csv(self, dirname, filename="data.csv", num_rows=10):
+        """
+        Writes a small two column csv file for chart tests.
+        """
+        csv_filename = os.path.join(dirname, filename)
+        with open(csv_filename, "w") as f:
+            f.write("time,sample\n")
+            for i in range(num_rows):
+                f.write("{},{}\n".format(i, i * i))
+        return csv_filename
+
     def test_core_bundle_create(self):
         """
         Test creating an oval data bundle.
@@ -145,3 +160,961 @@ class TestCore(unittest.TestCase):
                 archive.extractall(tmpdir)
                 self.assertTrue(
                     os.path.exists(os.path.join(tmpdir, "testfile")))
+
+    def test_core_bundle_append_keeps_entries(self):
+        """
+        Test that mutations append without rewriting existing entries.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bundle.add_chart(self._write_csv(tmpdir, num_rows=1000))
+        with zipfile.ZipFile(self._tmpfile, mode="r") as archive:
+            offsets = [info.header_offset for info in archive.infolist()]
+        old_size = os.path.getsize(self._tmpfile)
+
+        # when
+        bundle.write_attribute("test_value", 1)
+
+        # then
+        with zipfile.ZipFile(self._tmpfile, mode="r") as archive:
+            infos = archive.infolist()
+            self.assertEqual(
+                [info.header_offset for info in infos[:len(offsets)]],
+                offsets)
+            new_bytes = sum(
+                info.compress_size for info in infos[len(offsets):])
+        self.assertLess(new_bytes, old_size)
+        self.assertEqual(bundle.read_attribute("test_value"), 1)
+        self.assertEqual(bundle.num_charts(), 1)
+
+    def test_core_bundle_compact(self):
+        """
+        Test compacting drops shadowed entries.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        for i in range(5):
+            bundle.write_attribute("test_value", i)
+
+        # when
+        reclaimed = bundle.compact()
+
+        # then
+        self.assertGreater(reclaimed, 0)
+        with zipfile.ZipFile(self._tmpfile, mode="r") as archive:
+            self.assertEqual(archive.namelist(), ["metadata.json"])
+        self.assertEqual(bundle.read_attribute("test_value"), 4)
+
+    def test_core_bundle_compact_in_transaction(self):
+        """
+        Test compacting refuses to run inside a transaction, which could
+        roll back to metadata referencing the data it dropped.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bundle.add_chart(self._write_csv(tmpdir))
+
+        # when
+        with self.assertRaises(RuntimeError):
+            with bundle.transaction():
+                bundle.remove_chart(0)
+                with self.assertRaises(oval.core.BundleError):
+                    bundle.compact()
+                raise RuntimeError("rollback")
+
+        # then
+        self.assertEqual(len(bundle.read_chart_data(0)), 10)
+
+    def test_core_bundle_transaction(self):
+        """
+        Test that a transaction commits all changes in one append.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with zipfile.ZipFile(self._tmpfile, mode="r") as archive:
+            num_entries = len(archive.infolist())
+
+        # when
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir)
+            with bundle.transaction():
+                bundle.write_attribute("test_value", 1)
+                bundle.add_chart(csv_filename, y_column="sample")
+                bundle.add_chart(csv_filename, title="second")
+                bundle.edit_chart(0, title="first")
+                self.assertEqual(bundle.list_charts(), ["first", "second"])
+
+        # then
+        with zipfile.ZipFile(self._tmpfile, mode="r") as archive:
+            new_names = [
+                info.filename for info in archive.infolist()[num_entries:]]
+        self.assertEqual(
+            new_names, [bundle.get_chart(0)["filename"], "metadata.json"])
+        self.assertEqual(bundle.read_attribute("test_value"), 1)
+        self.assertEqual(bundle.list_charts(), ["first", "second"])
+
+    def test_core_bundle_transaction_rollback(self):
+        """
+        Test that a failed transaction writes nothing.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        size = os.path.getsize(self._tmpfile)
+
+        # when
+        with self.assertRaises(KeyError):
+            with bundle.transaction():
+                bundle.write_attribute("test_value", 1)
+                bundle.remove_attribute("missing")
+
+        # then
+        self.assertEqual(os.path.getsize(self._tmpfile), size)
+        self.assertFalse(bundle.has_attribute("test_value"))
+
+    def test_core_bundle_transaction_stream(self):
+        """
+        Test that chart data streamed in a transaction is only written on
+        commit, and can be read before it.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        size = os.path.getsize(self._tmpfile)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir, num_rows=100)
+
+            # when
+            with self.assertRaises(RuntimeError):
+                with bundle.transaction():
+                    bundle.add_chart(csv_filename, chunksize=10)
+                    raise RuntimeError()
+            rolled_back_size = os.path.getsize(self._tmpfile)
+            with bundle.transaction():
+                idx = bundle.add_chart(csv_filename, chunksize=10)
+                pending = bundle.read_chart_data(idx, x_range=(10, 12))
+                pending_size = os.path.getsize(self._tmpfile)
+
+        # then
+        self.assertEqual(rolled_back_size, size)
+        self.assertEqual(pending_size, size)
+        self.assertEqual(pending["sample"].tolist(), [100, 121, 144])
+        self.assertEqual(bundle.read_chart_data(idx)["time"].tolist(),
+                         list(range(100)))
+        with zipfile.ZipFile(self._tmpfile, mode="r") as archive:
+            self.assertEqual(
+                [info.filename for info in archive.infolist()].count(
+                    bundle.get_chart(idx)["filename"]), 1)
+
+    def test_core_bundle_metadata_cache(self):
+        """
+        Test that repeated reads don't re-parse metadata.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create(test_value=1)
+        bundle.read_attribute("test_value")
+
+        # when
+        with mock.patch.object(
+                oval.core.json, "loads", wraps=json.loads) as loads:
+            for _ in range(100):
+                bundle.has_attribute("test_value")
+                bundle.read_attribute("test_value")
+                bundle.num_charts()
+                bundle.list_charts()
+
+        # then
+        self.assertEqual(loads.call_count, 0)
+        bundle.close()
+
+    def test_core_bundle_metadata_cache_invalidation(self):
+        """
+        Test that cached metadata is refreshed when the file changes.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create(test_value=1)
+        self.assertEqual(bundle.read_attribute("test_value"), 1)
+
+        # when
+        other = oval.core.Bundle(self._tmpfile)
+        other.write_attribute("test_value", 2)
+
+        # then
+        self.assertEqual(bundle.read_attribute("test_value"), 2)
+        bundle.close()
+
+    def test_core_add_chart_npz(self):
+        """
+        Test storing chart data in the npz format.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+
+        # when
+        with tempfile.TemporaryDirectory() as tmpdir:
+            idx = bundle.add_chart(
+                self._write_csv(tmpdir), data_format="npz")
+        bundle.rescale_chart_data(idx, "sample")
+
+        # then
+        chart = bundle.get_chart(idx)
+        self.assertTrue(chart["filename"].startswith("data/"))
+        self.assertTrue(chart["filename"].endswith(".npz"))
+        self.assertEqual(chart["mimetype"], "application/x-npz")
+        self.assertNotIn("data_format", chart)
+        self.assertEqual(chart["y_max"], 1.0)
+        df = bundle.read_chart_data(idx)
+        self.assertEqual(list(df.columns), ["time", "sample"])
+        self.assertEqual(df["time"].tolist(), list(range(10)))
+
+    def test_core_read_chart_data(self):
+        """
+        Test reading some columns and an x range of chart data in each
+        format, sorted or not.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir, num_rows=100)
+            with bundle.transaction():
+                charts = [
+                    bundle.add_chart(csv_filename, data_format=data_format)
+                    for data_format in ("csv", "npz")]
+                charts.append(bundle.add_chart(
+                    csv_filename, x_column="sample", y_column="time"))
+                # read back before the commit
+                pending = bundle.read_chart_data(0, x_range=(10, 12))
+
+        # when
+        results = [
+            bundle.read_chart_data(idx, columns=["sample"], x_range=(10, 12))
+            for idx in charts[:2]]
+        unsorted = bundle.read_chart_data(
+            charts[2], columns=["time"], x_range=(100, 400))
+        outside = bundle.read_chart_data(0, x_range=(200, None))
+        everything = bundle.read_chart_data(1, x_range=(None, 1000))
+
+        # then
+        self.assertEqual(pending["time"].tolist(), [10, 11, 12])
+        for df in results:
+            self.assertEqual(list(df.columns), ["sample"])
+            self.assertEqual(df.index.tolist(), [10, 11, 12])
+            self.assertEqual(df["sample"].tolist(), [100, 121, 144])
+        self.assertEqual(unsorted["time"].tolist(), list(range(10, 21)))
+        self.assertEqual(list(outside.columns), ["time", "sample"])
+        self.assertEqual(len(outside), 0)
+        self.assertEqual(outside["time"].dtype.kind, "i")
+        self.assertEqual(len(everything), 100)
+        with self.assertRaises(oval.core.BundleError):
+            bundle.read_chart_data(0, columns=["missing"])
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("pyarrow"), "requires pyarrow")
+    def test_core_read_chart_data_parquet(self):
+        """
+        Test parquet chart data round trips, and reads some columns and an
+        x range.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            idx = bundle.add_chart(
+                self._write_csv(tmpdir, num_rows=100), data_format="parquet")
+
+        # when
+        df = bundle.read_chart_data(idx)
+        window = bundle.read_chart_data(
+            idx, columns=["sample"], x_range=(10, 12))
+        tail = bundle.read_chart_data(idx, x_range=(95, None))
+
+        # then
+        self.assertEqual(
+            bundle.get_chart(idx)["mimetype"],
+            "application/vnd.apache.parquet")
+        self.assertEqual(list(df.columns), ["time", "sample"])
+        self.assertEqual(df["time"].tolist(), list(range(100)))
+        self.assertEqual(df["sample"].dtype.kind, "i")
+        self.assertEqual(list(window.columns), ["sample"])
+        self.assertEqual(window["sample"].tolist(), [100, 121, 144])
+        self.assertEqual(tail["time"].tolist(), list(range(95, 100)))
+
+    def test_core_read_chart_arrays(self):
+        """
+        Test npz chart data in stored entries is memory mapped from the
+        bundle, and deflated entries are read into memory.
+        """
+        import numpy
+
+        # with
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir, num_rows=100)
+            bundle = oval.core.Bundle(self._tmpfile)
+            bundle.create()
+            idx = bundle.add_chart(csv_filename, data_format="npz")
+            deflated = oval.core.Bundle(
+                os.path.join(tmpdir, "deflated.zip"), compression="deflate")
+            deflated.create()
+            deflated.add_chart(csv_filename, data_format="npz")
+
+            # when
+            arrays = bundle.read_chart_arrays(idx)
+            window = bundle.read_chart_arrays(
+                idx, columns=["sample"], x_range=(10, 12))
+            copied = deflated.read_chart_arrays(0, columns=["sample"])
+
+        # then
+        self.assertIsInstance(arrays["time"], numpy.memmap)
+        self.assertEqual(arrays["time"].tolist(), list(range(100)))
+        self.assertFalse(arrays["sample"].flags.writeable)
+        self.assertIsInstance(window["sample"], numpy.memmap)
+        self.assertEqual(window["sample"].tolist(), [100, 121, 144])
+        self.assertNotIsInstance(copied["sample"], numpy.memmap)
+        self.assertEqual(copied["sample"].tolist()[:3], [0, 1, 4])
+
+    @mock.patch("oval.core.X_INDEX_BLOCK_ROWS", 8)
+    def test_core_x_index(self):
+        """
+        Test increasing x columns are indexed in blocks, streamed or not,
+        and x ranges are read from the block they start in.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir, num_rows=100)
+            shuffled_filename = os.path.join(tmpdir, "shuffled.csv")
+            with open(shuffled_filename, "w") as f:
+                f.write("time,sample\n")
+                for i in range(100):
+                    f.write("{},{}\n".format((i * 37) % 100, i))
+
+            # when
+            with bundle.transaction():
+                idx = bundle.add_chart(csv_filename)
+                streamed = bundle.add_chart(
+                    csv_filename, chunksize=30, title="streamed")
+                unsorted = bundle.add_chart(shuffled_filename)
+            window = bundle.read_chart_data(idx, x_range=(41.5, 50))
+            tail = bundle.read_chart_data(streamed, x_range=(95, None))
+
+        # then
+        chart = bundle.get_chart(idx)
+        self.assertTrue(chart["x_sorted"])
+        blocks = chart["x_index"]["blocks"]
+        self.assertEqual(len(blocks), 13)
+        self.assertEqual(
+            bundle.get_chart(streamed)["x_index"]["blocks"], blocks)
+        data = bundle.read_file(chart["filename"])
+        for x, row, offset in blocks:
+            self.assertEqual(row, x)
+            self.assertTrue(data[offset:].startswith(
+                "{0},{0},".format(row).encode()))
+        self.assertFalse(bundle.get_chart(unsorted)["x_sorted"])
+        self.assertNotIn("x_index", bundle.get_chart(unsorted))
+        self.assertEqual(window["time"].tolist(), list(range(42, 51)))
+        self.assertEqual(window.index.tolist(), list(range(42, 51)))
+        self.assertEqual(
+            tail["sample"].tolist(), [i * i for i in range(95, 100)])
+
+    def test_core_add_chart_frame(self):
+        """
+        Test adding charts from memory stores the same data as from csv.
+        """
+        import numpy
+        import pandas
+
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir)
+            from_csv = bundle.add_chart(csv_filename)
+        time = numpy.arange(10)
+        df = pandas.DataFrame(
+            {"time": time, "sample": time * time}, index=time + 5)
+
+        # when
+        from_frame = bundle.add_chart_frame(df, title="frame")
+        from_arrays = bundle.add_chart_arrays(
+            {"time": time, "sample": time * time}, data_format="npz")
+        dated = bundle.add_chart_frame({
+            "date": pandas.date_range("2026-01-01", periods=3, freq="D"),
+            "value": [1.0, 2.0, 3.0]})
+
+        # then
+        charts = [bundle.get_chart(idx) for idx in range(4)]
+        self.assertEqual(charts[from_frame]["filename"],
+                         charts[from_csv]["filename"])
+        self.assertEqual(charts[from_frame]["title"], "frame")
+        self.assertEqual(charts[from_frame]["column_stats"],
+                         charts[from_csv]["column_stats"])
+        self.assertEqual(charts[from_arrays]["title"], "chart 2")
+        self.assertEqual(charts[from_arrays]["y_max"], 81)
+        self.assertEqual(
+            bundle.read_chart_data(from_arrays)["sample"].tolist(),
+            (time * time).tolist())
+        self.assertEqual(
+            bundle.read_chart_data(dated)["date"].tolist()[1],
+            "2026-01-02T00:00:00.000000")
+        with self.assertRaises(oval.core.BundleError):
+            bundle.add_chart_arrays({"time": time, "sample": time[:5]})
+
+    def test_core_add_chart_frame_ndarray(self):
+        """
+        Test a 2D array's columns are named by their position as strings.
+        """
+        import numpy
+
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        values = numpy.column_stack([numpy.arange(20), numpy.arange(20) * 2])
+
+        # when
+        idx = bundle.add_chart_frame(values, y_column=1)
+        bundle.rescale_chart_data(idx, "1")
+        bundle.build_lod(idx, [4])
+        window = bundle.read_chart_data(idx, x_range=(5, 7))
+
+        # then
+        chart = bundle.get_chart(idx)
+        self.assertEqual(chart["x_column"], "0")
+        self.assertEqual(chart["columns"], ["0", "1"])
+        self.assertEqual(window["0"].tolist(), [5, 6, 7])
+        self.assertEqual(chart["column_stats"]["1"]["max"], 1.0)
+
+    def test_core_add_chart_frame_ndarray_y_columns(self):
+        """
+        Test a multi_line chart of a 2D array's columns by position.
+        """
+        import numpy
+
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        values = numpy.arange(30).reshape(10, 3)
+
+        # when
+        idx = bundle.add_chart_frame(
+            values, x_column=0, y_columns=[1, {"column": 2, "stroke": "red"}])
+
+        # then
+        chart = bundle.get_chart(idx)
+        self.assertEqual(chart["chart_type"], "multi_line")
+        self.assertEqual(chart["y_column"], "1")
+        self.assertEqual(
+            [series["column"] for series in chart["y_columns"]], ["1", "2"])
+        self.assertEqual(chart["y_columns"][1]["stroke"], "red")
+        self.assertEqual(
+            bundle.read_chart_data(idx, columns=["2"])["2"].tolist(),
+            values[:, 2].tolist())
+
+    def test_core_rescale_csv_round_trip(self):
+        """
+        Test rescaling csv chart data keeps its columns.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            idx = bundle.add_chart(self._write_csv(tmpdir))
+
+        # when
+        bundle.rescale_chart_data(idx, "sample", feature_range=(0, 2))
+        bundle.rescale_chart_data(idx, "sample")
+
+        # then
+        df = bundle.read_chart_data(idx)
+        self.assertEqual(list(df.columns), ["time", "sample"])
+        self.assertEqual(df["sample"].max(), 1.0)
+
+    def test_core_rescale_constant_column(self):
+        """
+        Test zscore rescaling a constant integer column.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        idx = bundle.add_chart_frame({"time": range(5), "sample": [3] * 5})
+
+        # when
+        bundle.rescale_chart_data(idx, "sample", mode="zscore")
+
+        # then
+        df = bundle.read_chart_data(idx)
+        self.assertEqual(df["sample"].tolist(), [0.0] * 5)
+        self.assertEqual(
+            bundle.chart_data_column_types(idx)["sample"], "float64")
+
+    def test_core_rescale_charts(self):
+        """
+        Test rescaling several charts and modes in one commit.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir)
+            with bundle.transaction():
+                for _ in range(3):
+                    bundle.add_chart(csv_filename)
+
+        # when
+        bundle.rescale_charts(
+            {0: ["time", "sample"]}, column_ranges={"sample": (-1, 1)})
+        bundle.rescale_charts(
+            {1: ["time"], 2: ["sample"]}, mode="relative")
+        bundle.rescale_charts({1: ["sample"]}, mode="zscore")
+
+        # then
+        first = bundle.read_chart_data(0)
+        self.assertEqual(first["time"].tolist()[-1], 1.0)
+        self.assertEqual(first["sample"].min(), -1.0)
+        self.assertEqual(first["sample"].max(), 1.0)
+        second = bundle.read_chart_data(1)
+        self.assertEqual(second["time"].tolist(), list(range(10)))
+        self.assertAlmostEqual(second["sample"].mean(), 0.0)
+        self.assertAlmostEqual(second["sample"].std(ddof=0), 1.0)
+        for idx in range(3):
+            stats = bundle.get_chart(idx)["column_stats"]
+            scanned = oval.core.ColumnStatistics(
+                bundle.read_chart_data(idx)).result()
+            for column in ("time", "sample"):
+                for key in ("monotonic", "count"):
+                    self.assertEqual(stats[column][key], scanned[column][key])
+                # csv parsing may round the last digit differently
+                for key in ("min", "max", "mean", "std"):
+                    self.assertAlmostEqual(
+                        stats[column][key], scanned[column][key])
+        self.assertEqual(bundle.get_chart(0)["y_min"], -1.0)
+        types = {
+            idx: bundle.chart_data_column_types(idx) for idx in range(3)}
+        self.assertEqual(types[0], {"time": "float64", "sample": "float64"})
+        self.assertEqual(types[1], {"time": "int64", "sample": "float64"})
+        self.assertEqual(types[2], {"time": "int64", "sample": "int64"})
+        with zipfile.ZipFile(self._tmpfile) as archive:
+            names = [info.filename for info in archive.infolist()]
+        self.assertEqual(names.count("metadata.json"), 5)
+
+    def test_core_add_chart_streaming(self):
+        """
+        Test streamed ingest matches reading the whole csv.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+
+        # when
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir)
+            full_idx = bundle.add_chart(
+                csv_filename, remove_zero=True, y_column="sample")
+            full_data = bundle.read_file(bundle.get_chart(0)["filename"])
+            stream_idx = bundle.add_chart(
+                csv_filename, remove_zero=True, y_column="sample",
+                chunksize=3)
+
+        # then
+        full_chart = bundle.get_chart(full_idx)
+        stream_chart = bundle.get_chart(stream_idx)
+        for key in ("x_min", "x_max", "y_min", "y_max", "column_types"):
+            self.assertEqual(full_chart[key], stream_chart[key])
+        self.assertEqual(stream_chart["y_min"], 1)
+        self.assertEqual(
+            bundle.read_file(stream_chart["filename"]), full_data)
+
+    def test_core_column_statistics(self):
+        """
+        Test column statistics are stored at ingest and kept up to date.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir)
+            idx = bundle.add_chart(csv_filename)
+            stream_idx = bundle.add_chart(csv_filename, chunksize=4)
+
+        # when
+        stats = bundle.get_chart(idx)["column_stats"]
+        bundle.rescale_chart_data(idx, "sample", feature_range=(0, 2))
+
+        # then
+        self.assertEqual(stats, bundle.get_chart(stream_idx)["column_stats"])
+        self.assertEqual(stats["time"]["count"], 10)
+        self.assertEqual(stats["time"]["min"], 0)
+        self.assertEqual(stats["time"]["max"], 9)
+        self.assertEqual(stats["time"]["mean"], 4.5)
+        self.assertEqual(stats["time"]["monotonic"], "increasing")
+        self.assertEqual(stats["sample"]["max"], 81)
+        rescaled = bundle.column_statistics(idx)["sample"]
+        self.assertEqual(rescaled["max"], 2.0)
+        self.assertEqual(bundle.get_chart(idx)["y_max"], 2.0)
+
+    def test_core_column_statistics_mixed_chunks(self):
+        """
+        Test streaming a column that turns from numbers to text.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = os.path.join(tmpdir, "mixed.csv")
+            with open(csv_filename, "w") as f:
+                f.write("time,sample,z\n")
+                for i in range(12):
+                    f.write("{},{},{}\n".format(
+                        i, i * i, i if i < 10 else "abc"))
+
+            # when
+            idx = bundle.add_chart(csv_filename, chunksize=5)
+
+        # then
+        stats = bundle.get_chart(idx)["column_stats"]
+        self.assertEqual(stats["z"]["count"], 12)
+        self.assertIsNone(stats["z"]["mean"])
+        self.assertIsNone(stats["z"]["min"])
+        self.assertIsNone(stats["z"]["max"])
+        self.assertIsNone(stats["z"]["monotonic"])
+        self.assertEqual(stats["sample"]["max"], 121)
+
+    def test_core_column_statistics_large_integers(self):
+        """
+        Test integers too large for float64 keep exact bounds, so x ranges
+        are read exactly.
+        """
+        # with
+        start = 1792193985364924589
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        idx = bundle.add_chart_frame(
+            {"x": [start + i for i in range(1000)], "y": [1] * 1000})
+
+        # when
+        stats = bundle.get_chart(idx)["column_stats"]
+        streamed = oval.core.ColumnStatistics()
+        streamed.update(bundle.read_chart_data(idx).iloc[:500])
+        streamed.update(bundle.read_chart_data(idx).iloc[500:])
+        window = bundle.read_chart_data(idx, x_range=(start + 50, None))
+
+        # then
+        self.assertEqual(stats["x"]["min"], start)
+        self.assertEqual(stats["x"]["max"], start + 999)
+        self.assertEqual(stats["x"]["monotonic"], "increasing")
+        self.assertEqual(bundle.get_chart(idx)["x_min"], start)
+        for key in ("min", "max", "monotonic"):
+            self.assertEqual(streamed.result()["x"][key], stats["x"][key])
+        self.assertEqual(len(window), 950)
+        self.assertEqual(window["x"].min(), start + 50)
+
+    def test_core_autoscale_chart(self):
+        """
+        Test autoscaling chart bounds from column statistics.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            idx = bundle.add_chart(self._write_csv(tmpdir))
+        bundle.edit_chart(idx, x_min=-100, y_max=1000)
+
+        # when
+        bundle.autoscale_chart(idx, "y")
+
+        # then
+        chart = bundle.get_chart(idx)
+        self.assertEqual(chart["x_min"], -100)
+        self.assertEqual(chart["y_max"], 81)
+
+    def test_core_add_multi_chart(self):
+        """
+        Test adding a chart overlaying several y columns.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        csv_filename = os.path.join(os.path.dirname(self._tmpfile), "m.csv")
+        with open(csv_filename, "w") as f:
+            f.write("time,y1,y2\n0,1,-5\n1,0,3\n2,2,4\n")
+
+        # when
+        try:
+            idx = bundle.add_chart(
+                csv_filename, remove_zero=True,
+                y_columns=["y1", {"column": "y2", "stroke": "red"}])
+        finally:
+            os.remove(csv_filename)
+
+        # then
+        chart = bundle.get_chart(idx)
+        self.assertEqual(chart["chart_type"], "multi_line")
+        self.assertEqual(chart["y_column"], "y1")
+        self.assertEqual(
+            [(s["column"], s["stroke"]) for s in chart["y_columns"]],
+            [("y1", "steelblue"), ("y2", "red")])
+        self.assertEqual((chart["y_min"], chart["y_max"]), (-5, 4))
+        self.assertEqual(chart["column_stats"]["time"]["count"], 2)
+        with zipfile.ZipFile(self._tmpfile, mode="r") as archive:
+            self.assertEqual(archive.namelist().count(chart["filename"]), 1)
+
+    def test_core_chart_data_dedup(self):
+        """
+        Test identical chart data is stored once and shared by copies.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+
+        # when
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir)
+            bundle.add_chart(csv_filename, title="first")
+            bundle.add_chart(csv_filename, title="second")
+        copy_idx = bundle.copy_chart(0, "copy.csv")
+
+        # then
+        filenames = set(
+            bundle.get_chart(i)["filename"] for i in range(3))
+        self.assertEqual(len(filenames), 1)
+        self.assertEqual(bundle.get_chart(copy_idx)["title"], "copy.csv")
+        with zipfile.ZipFile(self._tmpfile, mode="r") as archive:
+            data_entries = [
+                info for info in archive.infolist()
+                if info.filename.startswith("data/")]
+            self.assertEqual(len(data_entries), 1)
+
+    def test_core_compact_prunes_unreferenced_data(self):
+        """
+        Test compacting drops chart data only once nothing references it.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            idx = bundle.add_chart(self._write_csv(tmpdir))
+        bundle.copy_chart(idx, "copy.csv")
+        filename = bundle.get_chart(idx)["filename"]
+
+        # when
+        bundle.remove_chart(idx)
+        bundle.compact()
+        shared_kept = bundle._has_file(filename)
+        bundle.remove_chart(0)
+        bundle.compact()
+
+        # then
+        self.assertTrue(shared_kept)
+        self.assertFalse(bundle._has_file(filename))
+
+    def test_core_downsample_indices(self):
+        """
+        Test min/max per bucket downsampling.
+        """
+        # with
+        values = [1, 5, 2, 8, 3, 0, 4, 4, float("nan"), 7]
+
+        # when
+        indices = oval.core.downsample_indices(values, 3)
+
+        # then
+        self.assertEqual(indices.tolist(), [0, 3, 5, 6, 9])
+
+    def test_core_build_lod(self):
+        """
+        Test building level of detail series for a chart.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            idx = bundle.add_chart(self._write_csv(tmpdir, num_rows=1000))
+
+        # when
+        bundle.build_lod(idx, buckets=[10, 100, 1000])
+
+        # then
+        levels = bundle.get_chart(idx)["lod"]
+        self.assertEqual([level["buckets"] for level in levels], [10, 100])
+        df = oval.core.decode_chart_data(
+            bundle.read_file(levels[0]["filename"]))
+        self.assertEqual(len(df), levels[0]["rows"])
+        self.assertLessEqual(len(df), 22)
+        self.assertEqual(df["sample"].max(), 999 * 999)
+        self.assertIn(levels[0]["filename"], bundle.referenced_files())
+
+    def test_core_spans(self):
+        """
+        Test that bundle operations report timed spans to collectors.
+        """
+        # with
+        bundle = oval.core.Bundle(self._tmpfile)
+        bundle.create()
+        recorder = oval.core.SpanRecorder()
+        oval.core.add_span_collector(recorder)
+
+        # when
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                bundle.add_chart(self._write_csv(tmpdir))
+        finally:
+            oval.core.remove_span_collector(recorder)
+
+        # then
+        summary = recorder.summary()
+        for name in ("zip_open", "extract", "metadata_parse", "csv_parse",
+                     "statistics", "csv_write", "archive_write"):
+            self.assertIn(name, summary)
+        self.assertGreater(summary["csv_parse"]["bytes_read"], 0)
+        self.assertGreater(
+            summary["archive_write"]["bytes_written"],
+            summary["csv_write"]["bytes_written"])
+
+    def test_core_compression(self):
+        """
+        Test compressing bundle entries by policy, and recompressing them
+        on compaction.
+        """
+        # with
+        policy = oval.core.CompressionPolicy.parse(
+            "deflate:9", ["*.txt=bzip2"])
+        bundle = oval.core.Bundle(self._tmpfile, compression=policy)
+        bundle.create()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = self._write_csv(tmpdir, num_rows=100)
+            idx = bundle.add_chart(csv_filename)
+            bundle.add_file(csv_filename, "notes.txt")
+            bundle.add_file(csv_filename, "image.png")
+
+        # when
+        with zipfile.ZipFile(self._tmpfile) as archive:
+            compressed = {
+                info.filename: info.compress_type
+                for info in archive.infolist()}
+        oval.core.Bundle(self._tmpfile, compression="stored").compact()
+
+        # then
+        chart = bundle.get_chart(idx)
+        self.assertEqual(compressed["metadata.json"], zipfile.ZIP_DEFLATED)
+        self.assertEqual(compressed[chart["filename"]], zipfile.ZIP_DEFLATED)
+        self.assertEqual(compressed["notes.txt"], zipfile.ZIP_BZIP2)
+        self.assertEqual(compressed["image.png"], zipfile.ZIP_STORED)
+        with zipfile.ZipFile(self._tmpfile) as archive:
+            self.assertEqual(
+                {info.compress_type for info in archive.infolist()},
+                {zipfile.ZIP_STORED})
+        self.assertEqual(len(bundle.read_chart_data(idx)), 100)
+
+    def test_core_send_email_streaming(self):
+        """
+        Test attachments are sent with memory use that doesn't grow with
+        their size, and that their encoding is cached.
+        """
+        import email
+        import tracemalloc
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # with
+            attachment = os.path.join(tmpdir, "bundle.zip")
+            with open(attachment, "wb") as f:
+                for i in range(8):
+                    f.write(os.urandom(1024 * 1024))
+            small = os.path.join(tmpdir, "small.zip")
+            with open(small, "wb") as f:
+                f.write(os.urandom(1024))
+            cache_dir = os.path.join(tmpdir, "cache")
+
+            def send(session, filename=attachment, cache_dir=cache_dir):
+                msg = oval.core.build_email(
+                    "from@localhost", ["to@localhost"], "subject", "body",
+                    files=[(filename, "bundle.zip", None)],
+                    cache_dir=cache_dir)
+                return session.send("from@localhost", ["to@localhost"], msg)
+
+            # when
+            with oval.smtpstub.SMTPStub(keep_data=False) as smtp, \
+                    oval.core.SMTPSession(
+                        smtp.host, smtp.port, smtp_starttls=False) as session:
+                # the first send imports the email modules
+                send(session, small, os.path.join(tmpdir, "small_cache"))
+                tracemalloc.start()
+                try:
+                    errors = send(session)
+                    peak_memory = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+                smtp.keep_data = True
+                with mock.patch("base64.encodebytes") as encodebytes:
+                    send(session)
+
+            # then
+            self.assertEqual(errors, {"to@localhost": None})
+            self.assertLess(peak_memory, 2 * 1024 * 1024)
+            self.assertFalse(encodebytes.called)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            message = email.message_from_bytes(smtp.messages[2][2])
+            payload = message.get_payload()[2].get_payload(decode=True)
+            with open(attachment, "rb") as f:
+                self.assertEqual(payload, f.read())
+
+    def test_core_smtp_stub(self):
+        # with
+        with oval.smtpstub.SMTPStub(reject=["nobody@localhost"]) as smtp:
+            # when
+            oval.core.send_email(
+                "from@localhost", ["to@localhost", "nobody@localhost"],
+                "subject", "body", smtp_host=smtp.host, smtp_port=smtp.port,
+                smtp_starttls=False)
+
+        # then
+        self.assertEqual(len(smtp.messages), 1)
+        from_addr, to_addrs, data = smtp.messages[0]
+        self.assertEqual(from_addr, "from@localhost")
+        self.assertEqual(to_addrs, ["to@localhost"])
+        self.assertIn(b"Subject: subject", data)
+
+    def test_core_smtp_stream(self):
+        """
+        Test streaming a message escapes periods across chunk boundaries.
+        """
+        # with
+        msg = oval.core.StreamingEmail([b"a\r\n.b", b"\r", b"\n.c\r\n", b"."])
+
+        # when
+        with oval.smtpstub.SMTPStub() as smtp, oval.core.SMTPSession(
+                smtp.host, smtp.port, smtp_starttls=False) as session:
+            errors = session.send("from@localhost", ["to@localhost"], msg)
+
+        # then
+        self.assertEqual(errors, {"to@localhost": None})
+        self.assertEqual(smtp.messages[0][2], b"a\r\n.b\r\n.c\r\n.\r\n")
+
+    def test_core_mime_cache_private(self):
+        """
+        Test attachments aren't cached in a directory other users can
+        write to.
+        """
+        # with
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, "cache")
+            os.mkdir(cache_dir)
+            os.chmod(cache_dir, 0o777)
+
+            # when, then
+            with self.assertRaises(oval.core.BundleError):
+                oval.core.encode_attachment(self._tmpfile, cache_dir)
+            os.chmod(cache_dir, 0o755)
+            encoded = oval.core.encode_attachment(self._tmpfile, cache_dir)
+            self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+            self.assertTrue(os.path.exists(encoded))
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import oval.core
+import oval.daemon
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _write_csv(self, relpath, num_rows=10):
+        filename = os.path.join(self._tmpdir.name, "incoming", relpath)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            f.write("time,sample\n")
+            for i in range(num_rows):
+                f.write("{},{}\n".format(i, i * i))
+        return filename
+
+    def test_daemon_ingest(self):
+        """
+        Test ingesting files into the bundles their rules map them to.
+        """
+        # with
+        for relpath in ("rig1/a.csv", "rig1/b.csv", "rig2/a.csv", "x.txt"):
+            self._write_csv(relpath)
+        daemon = oval.daemon.IngestDaemon({
+            "base_dir": self._tmpdir.name,
+            "watch": ["incoming"],
+            "settle_seconds": 0,
+            "workers": 1,
+            "done_dir": "done",
+            "rules": [{
+                "pattern": "rig*/*.csv",
+                "bundle": "bundles/{parent}.zip",
+                "chart": {"title": "{parent} {stem}"}}]})
+
+        # when
+        stats = asyncio.run(daemon.run(once=True))
+
+        # then
+        self.assertEqual(stats["files_ingested"], 3)
+        self.assertEqual(stats["files_unmatched"], 1)
+        self.assertEqual(stats["commits"], 2)
+        self.assertEqual(stats["queue_depth"], 0)
+        bundle = oval.core.Bundle(
+            os.path.join(self._tmpdir.name, "bundles", "rig1.zip"))
+        self.assertEqual(
+            sorted(bundle.list_charts()), ["rig1 a", "rig1 b"])
+        for relpath in ("rig1/a.csv", "rig1/b.csv", "rig2/a.csv"):
+            self.assertTrue(os.path.exists(
+                os.path.join(self._tmpdir.name, "done", relpath)))
+        self.assertTrue(os.path.exists(
+            os.path.join(self._tmpdir.name, "incoming", "x.txt")))
+
+    def test_daemon_restart(self):
+        """
+        Test that a restarted daemon doesn't ingest files again.
+        """
+        # with
+        self._write_csv("rig1/a.csv")
+        config = {
+            "base_dir": self._tmpdir.name,
+            "watch": ["incoming"],
+            "settle_seconds": 0,
+            "workers": 1,
+            "rules": [{
+                "pattern": "rig*/*.csv",
+                "bundle": "bundles/{parent}.zip"}]}
+        asyncio.run(oval.daemon.IngestDaemon(config).run(once=True))
+
+        # when
+        self._write_csv("rig1/b.csv")
+        stats = asyncio.run(oval.daemon.IngestDaemon(config).run(once=True))
+
+        # then
+        self.assertEqual(stats["files_ingested"], 1)
+        bundle = oval.core.Bundle(
+            os.path.join(self._tmpdir.name, "bundles", "rig1.zip"))
+        self.assertEqual(len(bundle.list_charts()), 2)
+
+    def test_daemon_skips_outputs(self):
+        """
+        Test that a daemon watching its base directory doesn't pick up
+        its own bundles, state and stats files.
+        """
+        # with
+        self._write_csv("rig1/a.csv")
+        config = {
+            "base_dir": self._tmpdir.name,
+            "settle_seconds": 0,
+            "workers": 1,
+            "stats_file": "stats.json",
+            "rules": [{
+                "pattern": "incoming/rig*/*.csv",
+                "bundle": "{parent}.zip"}]}
+        first = asyncio.run(oval.daemon.IngestDaemon(config).run(once=True))
+
+        # when
+        second = asyncio.run(oval.daemon.IngestDaemon(config).run(once=True))
+
+        # then
+        self.assertEqual(first["files_ingested"], 1)
+        self.assertEqual(first["files_unmatched"], 0)
+        self.assertEqual(second["files_seen"], 0)
+        self.assertEqual(second["files_unmatched"], 0)
+        self.assertTrue(os.path.exists(
+            os.path.join(self._tmpdir.name, "rig1.zip")))
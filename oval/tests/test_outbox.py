@@ -0,0 +1,130 @@
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+import oval.core
+import oval.outbox
+import oval.smtpstub
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._outbox = os.path.join(self._tmpdir.name, "outbox.sqlite")
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _bundle(self, name):
+        filename = os.path.join(self._tmpdir.name, name)
+        with oval.core.Bundle(filename) as bundle:
+            bundle.create(title=name)
+        return filename
+
+    def test_outbox_run(self):
+        """
+        Test sending queued bundles from several workers, failing
+        rejected recipients without retrying them.
+        """
+        # with
+        with oval.outbox.Outbox(self._outbox) as outbox, \
+                oval.smtpstub.SMTPStub(reject=["nobody@localhost"]) as smtp:
+            for i in range(4):
+                outbox.enqueue(
+                    self._bundle("{}.zip".format(i)), "from@localhost",
+                    ["to@localhost"], smtp_host=smtp.host,
+                    smtp_port=smtp.port, smtp_starttls=False)
+            rejected = outbox.enqueue(
+                self._bundle("rejected.zip"), "from@localhost",
+                ["nobody@localhost"], smtp_host=smtp.host,
+                smtp_port=smtp.port, smtp_starttls=False)
+
+            # when
+            oval.outbox.OutboxRunner(self._outbox, workers=2).run()
+
+            # then
+            stats = outbox.stats()
+            self.assertEqual(stats["sent"], 4)
+            self.assertEqual(stats["failed"], 1)
+            self.assertEqual(stats["queue_depth"], 0)
+            self.assertEqual(stats["retries"], 0)
+            self.assertGreater(stats["latency_max_seconds"], 0)
+            self.assertEqual(len(smtp.messages), 4)
+            self.assertLessEqual(smtp.connections, 2)
+            failed = outbox.messages("failed")[0]
+            self.assertEqual(failed["id"], rejected)
+            self.assertIn("550", failed["errors"])
+
+    def test_outbox_retry(self):
+        """
+        Test a send that fails to connect is retried after the backoff.
+        """
+        # with
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        with oval.outbox.Outbox(self._outbox) as outbox:
+            outbox.enqueue(
+                self._bundle("a.zip"), "from@localhost", ["to@localhost"],
+                smtp_host="127.0.0.1", smtp_port=port, smtp_starttls=False)
+            runner = oval.outbox.OutboxRunner(
+                self._outbox, workers=1, retry_delay=0.5)
+
+            # when
+            runner.run(wait=False)
+            queued = outbox.stats()["queued"]
+            with oval.smtpstub.SMTPStub(port=port) as smtp:
+                runner.run(wait=True)
+
+            # then
+            self.assertEqual(queued, 1)
+            stats = outbox.stats()
+            self.assertEqual(stats["sent"], 1)
+            self.assertEqual(stats["retries"], 1)
+            self.assertEqual(len(smtp.messages), 1)
+
+    def test_host_rate_limiter(self):
+        # with
+        limiter = oval.outbox.HostRateLimiter(rate=20)
+
+        # when
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.wait("a")
+        limiter.wait("b")
+
+        # then
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_outbox_max_attempts(self):
+        """
+        Test a message is failed after max_attempts sends, and a rejected
+        sender isn't retried.
+        """
+        # with
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        with oval.outbox.Outbox(self._outbox) as outbox, \
+                oval.smtpstub.SMTPStub(reject=["bad@localhost"]) as smtp:
+            unreachable = outbox.enqueue(
+                self._bundle("a.zip"), "from@localhost", ["to@localhost"],
+                smtp_host="127.0.0.1", smtp_port=port, smtp_starttls=False)
+            rejected = outbox.enqueue(
+                self._bundle("b.zip"), "bad@localhost", ["to@localhost"],
+                smtp_host=smtp.host, smtp_port=smtp.port,
+                smtp_starttls=False)
+
+            # when
+            oval.outbox.OutboxRunner(
+                self._outbox, workers=1, max_attempts=2,
+                retry_delay=0.01).run()
+
+            # then
+            messages = {m["id"]: m for m in outbox.messages("failed")}
+            self.assertEqual(messages[unreachable]["attempts"], 2)
+            self.assertEqual(messages[rejected]["attempts"], 1)
+            self.assertIn(
+                '"550 Sender rejected"', messages[rejected]["errors"])
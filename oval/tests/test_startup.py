@@ -0,0 +1,69 @@
+"""
+Startup cost benchmark for metadata-only CLI commands.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import oval.core
+
+
+# seconds allowed for importing the CLI and running a metadata-only command
+STARTUP_BUDGET = float(os.environ.get("OVAL_STARTUP_BUDGET", "0.5"))
+HEAVY_MODULES = ("numpy", "pandas", "sklearn", "email.mime", "smtplib")
+
+STARTUP_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from oval.__main__ import root
+import_time = time.perf_counter() - start
+root(args=sys.argv[1:], standalone_mode=False)
+total_time = time.perf_counter() - start
+print(json.dumps({
+    "import_time": import_time,
+    "total_time": total_time,
+    "modules": sorted(sys.modules)}))
+"""
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._bundle_filename = os.path.join(self._tmpdir.name, "session.zip")
+        oval.core.Bundle(self._bundle_filename).create()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _run(self, *args):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(oval.core.__file__))] +
+            sys.path)
+        output = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SCRIPT,
+             "--bundle", self._bundle_filename, *args],
+            env=env, universal_newlines=True)
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_startup_metadata_commands(self):
+        """
+        Test metadata-only commands skip heavy imports and stay in budget.
+        """
+        for command in ("version", "info", "list"):
+            # when
+            result = self._run(command)
+
+            # then
+            heavy = [
+                m for m in result["modules"]
+                if any(m == h or m.startswith(h + ".")
+                       for h in HEAVY_MODULES)]
+            self.assertEqual(heavy, [], command)
+            self.assertLess(result["total_time"], STARTUP_BUDGET, command)
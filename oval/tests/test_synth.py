@@ -0,0 +1,60 @@
+"""
+Tests for the oval.synth module.
+"""
+import math
+import os
+import tempfile
+import unittest
+
+import oval.core
+import oval.synth
+
+
+class TestSynth(unittest.TestCase):
+    def test_synth_generate_signal(self):
+        """
+        Test the vectorized sinusoid matches the sample formula.
+        """
+        # when
+        df = oval.synth.generate_signal(
+            num_samples=100, amplitude=2.0, frequency=3, phase=0.5,
+            y_offset=1.0)
+
+        # then
+        self.assertEqual(list(df.columns), ["time", "sample"])
+        self.assertEqual(len(df), 100)
+        for t, y in zip(df["time"], df["sample"]):
+            self.assertAlmostEqual(
+                y, 2.0 * math.sin(2 * math.pi * 3 * t + 0.5) + 1.0)
+
+    def test_synth_generate_signal_datetime(self):
+        """
+        Test generating a noisy waveform with a datetime x axis.
+        """
+        # when
+        df = oval.synth.generate_signal(
+            num_samples=10, start_time=0.0, end_time=5.0,
+            waveform="square", amplitude=1.0, noise=0.1, seed=1,
+            start_datetime="2021-08-23 12:00:00")
+
+        # then
+        self.assertEqual(df["time"][0], "2021-08-23T12:00:00.000")
+        self.assertEqual(df["time"][9], "2021-08-23T12:00:04.500")
+        self.assertTrue(((df["sample"].abs() - 1.0).abs() < 0.5).all())
+
+    def test_synth_gen_bundles(self):
+        """
+        Test generating bundles with a process pool.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # when
+            filenames = oval.synth.gen_bundles(
+                tmpdir, 3, jobs=2, num_charts=2, num_samples=50)
+
+            # then
+            self.assertEqual(len(filenames), 3)
+            for filename in filenames:
+                self.assertTrue(os.path.exists(filename))
+                bundle = oval.core.Bundle(filename)
+                self.assertEqual(bundle.num_charts(), 2)
+                bundle.close()